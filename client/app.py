@@ -4,96 +4,162 @@ import time
 import socket
 import random
 import requests
-from flask import Flask, jsonify
+from statistics import median
+from functools import partial
+from flask import Flask, jsonify, request
 from logs.logger import logger
 from file_gen import FileGenerator
+from uploader import ChunkUploader
+from jobs import JobRegistry
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 from concurrent.futures import ThreadPoolExecutor
 
 
 app = Flask(__name__)
-file_generator = FileGenerator()
+# FILE_SEED makes generated names, sizes and content repeat from run to run;
+# GENERATOR_WORKERS > 1 generates content in that many processes
+file_generator = FileGenerator(
+    seed=int(os.environ['FILE_SEED']) if os.getenv('FILE_SEED') else None,
+    dedup_ratio=float(os.getenv('DEDUP_RATIO', 0.5)),
+    workers=int(os.getenv('GENERATOR_WORKERS', 1))
+)
 
+# Only idempotent methods are retried: a POST /upload that failed or timed
+# out may still have started a job, and retrying it would start another
 retry_strategy = Retry(
     total=int(os.getenv('MAX_RETRIES', 3)),
     backoff_factor=float(os.getenv('RETRY_BACKOFF', 5)),
     status_forcelist=[429, 500, 502, 503, 504],
+    respect_retry_after_header=True,
 )
 
 session = requests.Session()
 adapter = HTTPAdapter(max_retries=retry_strategy)
 session.mount("http://", adapter)
 session.mount("https://", adapter)
+# Job status lookups fail fast instead of backing off, so one unreachable
+# container doesn't stall an aggregated status
+status_session = requests.Session()
 
 timeout = int(os.getenv('REQUESTS_TIMEOUT', 30))
 
-CHUNK_SIZE = 8 * 1024 * 1024
+# Unset, the API picks the chunk size and recommends the parallelism, and
+# requests grow or shrink with measured throughput (UPLOAD_ADAPTIVE)
+CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', 0)) or None
+UPLOAD_PARALLELISM = int(os.getenv('UPLOAD_PARALLELISM', 0)) or None
+
+uploader = ChunkUploader(
+    os.getenv('API_URL', 'http://api:8000'),
+    CHUNK_SIZE,
+    parallelism=UPLOAD_PARALLELISM,
+    adaptive=os.getenv('UPLOAD_ADAPTIVE', '1') == '1',
+    max_retries=int(os.getenv('MAX_RETRIES', 3)),
+    retry_backoff=float(os.getenv('RETRY_BACKOFF', 5)),
+    timeout=timeout,
+    finalize_timeout=int(os.getenv('FINALIZE_TIMEOUT', 600)),
+    dedup=os.getenv('UPLOAD_DEDUP', '1') == '1',
+    compression=os.getenv('UPLOAD_COMPRESSION', 'auto')
+)
+
+# Streamed uploads generate the file while sending it, so it never lands
+# on disk; UPLOAD_STREAMING=0 writes it out first and uploads from the file
+UPLOAD_STREAMING = os.getenv('UPLOAD_STREAMING', '1') == '1'
+FILE_CONTENT = os.getenv('FILE_CONTENT', 'sparse')  # see file_gen.CONTENTS
+STREAM_QUEUE_DEPTH = int(os.getenv('STREAM_QUEUE_DEPTH', 0)) or None
+
+# Peers are found by resolving the client service name, which Docker's DNS
+# answers with the address of every scaled replica
+CLIENT_SERVICE = os.getenv('CLIENT_SERVICE', 'client')
+CLIENT_PORT = int(os.getenv('CLIENT_PORT', 5000))
+# Set on job status requests one container forwards to another
+FORWARDED_HEADER = 'X-Job-Forwarded'
+MB = 1024 * 1024
+
 
 def get_container_id():
     return socket.gethostname()
 
+
+def get_container_address():
+    try:
+        return f"{socket.gethostbyname(socket.gethostname())}:{CLIENT_PORT}"
+    except socket.error:
+        return f"127.0.0.1:{CLIENT_PORT}"
+
+
+jobs = JobRegistry(get_container_address())
+
+
+def discover_clients():
+    """host:port of every client container, this one included."""
+    try:
+        infos = socket.getaddrinfo(CLIENT_SERVICE, CLIENT_PORT, type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        logger.warning(f"Could not resolve {CLIENT_SERVICE} ({str(e)}), triggering this container only")
+        return [jobs.owner]
+    hosts = sorted({info[4][0] for info in infos})
+    return [f"[{host}]:{CLIENT_PORT}" if ":" in host else f"{host}:{CLIENT_PORT}" for host in hosts]
+
 def create_and_upload_file():
     container_id = get_container_id()
-    api_url = os.getenv('API_URL', 'http://api:8000')
     
     try:
         logger.info(f"[Container {container_id}] Starting file generation...")
         start_time = time.time()
-        filepath = file_generator.create_file()
-        creation_duration = round(time.time() - start_time, 2)
-        file_size = os.path.getsize(filepath)
         creation_time = time.strftime("%Y-%m-%d %H:%M:%S")
-        logger.info(f"[Container {container_id}] File generated: {filepath} (Size: {file_size} bytes)")
+        if UPLOAD_STREAMING:
+            stream = file_generator.stream_file(content=FILE_CONTENT)
+            filepath, filename, file_size = None, stream.filename, stream.size
+        else:
+            filepath = file_generator.create_file(content=FILE_CONTENT)
+            filename, file_size = os.path.basename(filepath), os.path.getsize(filepath)
+            logger.info(f"[Container {container_id}] File generated: {filepath} (Size: {file_size} bytes)")
+        creation_duration = round(time.time() - start_time, 2)
         
         upload_start = time.time()
-        logger.info(f"[Container {container_id}] Initializing upload for {filepath}")
+        logger.info(f"[Container {container_id}] Initializing upload for {filename}")
         
         init_data = {
             'client_id': container_id,
             'timestamp': str(time.time()),
             'file_creation_time': creation_time,
-            'filename': os.path.basename(filepath),
-            'total_size': file_size,
+            'filename': filename,
             'creation_duration': creation_duration
         }
         
-        response = session.post(f"{api_url}/api/uploads/init", json=init_data)
-        upload_id = response.json()['upload_id']
-        logger.info(f"[Container {container_id}] Upload initialized with ID: {upload_id}")
-        
-        with open(filepath, 'rb') as f:
-            chunk_number = 0
-            while chunk := f.read(CHUNK_SIZE):
-                files = {'chunk': chunk}
-                data = {
-                    'chunk_number': chunk_number,
-                    'upload_id': upload_id
-                }
-                session.post(f"{api_url}/api/uploads/chunk", files=files, data=data)
-                logger.info(f"[Container {container_id}] Uploaded chunk {chunk_number} for upload {upload_id}")
-                chunk_number += 1
+        if UPLOAD_STREAMING:
+            upload_id, checksum = uploader.upload_stream(stream, file_size, init_data, STREAM_QUEUE_DEPTH)
+            # Generation overlapped with the upload, report the time spent generating
+            creation_duration = round(stream.generation_duration, 2)
+        else:
+            upload_id, checksum = uploader.upload(filepath, init_data)
+        logger.info(f"[Container {container_id}] All chunks acknowledged for upload {upload_id}")
         
         logger.info(f"[Container {container_id}] Finalizing upload {upload_id}")
         upload_duration = round(time.time() - upload_start, 2)
         
-        response = session.post(
-            f"{api_url}/api/uploads/finalize",
-            json={
-                'upload_id': upload_id,
-                'upload_duration': upload_duration,
-                'creation_duration': creation_duration
-            }
+        uploader.finalize(
+            upload_id,
+            checksum=checksum,
+            upload_duration=upload_duration,
+            creation_duration=creation_duration
         )
         
-        os.remove(filepath)
-        logger.info(f"[Container {container_id}] Upload completed in {upload_duration} seconds and file {filepath} removed")
+        if filepath is not None:
+            os.remove(filepath)
+            logger.info(f"[Container {container_id}] Upload completed in {upload_duration} seconds and file {filepath} removed")
+        else:
+            logger.info(f"[Container {container_id}] Streamed upload completed in {upload_duration} seconds")
         
         return {
             'status': 'success',
             'container_id': container_id,
             'upload_id': upload_id,
-            'upload_duration': upload_duration
+            'file_size': file_size,
+            'creation_duration': creation_duration,
+            'upload_duration': upload_duration,
+            'throughput_mb_s': round(file_size / MB / upload_duration, 2) if upload_duration else None
         }
         
     except Exception as e:
@@ -104,69 +170,159 @@ def create_and_upload_file():
             'error': str(e)
         }
 
-def trigger_single_container(container_url, container_name, timeout):
-    """
-    Helper function to trigger upload for a single container
-    """
+def run_upload_job():
+    result = create_and_upload_file()
+    if result['status'] == 'error':
+        raise RuntimeError(result['error'])
+    return result
+
+
+def trigger_single_container(address):
+    """Start an upload job on one container, returns where to follow it."""
     container_id = get_container_id()
     try:
-        response = session.post(container_url, timeout=timeout)
-        logger.info(f"[Container {container_id}] Triggered upload on {container_name}")
-        return {"status": "success", "container": container_name}
+        response = session.post(f"http://{address}/upload", timeout=timeout)
+        response.raise_for_status()
+        logger.info(f"[Container {container_id}] Triggered upload on {address}")
+        return {'address': address, 'status': 'triggered', 'job_id': response.json()['job_id']}
     except Exception as e:
-        logger.error(f"[Container {container_id}] Failed to trigger {container_name}")
-        return {"status": "failed", "container": container_name}
+        logger.error(f"[Container {container_id}] Failed to trigger {address}: {str(e)}")
+        return {'address': address, 'status': 'failed', 'error': str(e)}
 
-@app.route('/trigger-all')
-def trigger_all_containers():
+
+def trigger_all():
+    addresses = discover_clients()
+    logger.info(f"[Container {get_container_id()}] Initiating uploads across {len(addresses)} containers")
+    with ThreadPoolExecutor(max_workers=max(len(addresses), 1)) as executor:
+        return list(executor.map(trigger_single_container, addresses))
+
+
+def peer_owner(job_id, peers):
     """
-    Trigger file upload on all containers concurrently using ThreadPoolExecutor
+    The container to ask about a job this one doesn't have, or None. Only
+    addresses found by discover_clients() are asked, never whatever host a
+    caller-supplied job ID names, so the status endpoint can't be pointed
+    at other hosts or back at this container under another alias.
     """
-    start_time = time.time()
+    owner = JobRegistry.owner_of(job_id)
+    return owner if owner != jobs.owner and owner in peers else None
+
+
+def forward_job_status(owner, job_id):
+    # Marked so the peer answers from its own jobs and never forwards again
+    return status_session.get(f"http://{owner}/jobs/{job_id}", headers={FORWARDED_HEADER: '1'}, timeout=timeout)
+
+
+def fetch_job(job_id, peers):
+    if JobRegistry.owner_of(job_id) == jobs.owner:
+        return jobs.get(job_id) or {'job_id': job_id, 'status': 'unknown', 'error': "Job was forgotten"}
+    owner = peer_owner(job_id, peers)
+    if owner is None:
+        return {'job_id': job_id, 'status': 'unknown', 'error': "Job is not owned by a client container"}
     try:
-        container_id = get_container_id()
-        logger.info(f"[Container {container_id}] Initiating uploads across all containers")
-        
-        project_name = os.getenv('COMPOSE_PROJECT_NAME', 'file_upload')
-        container_urls = [
-            (f"http://{project_name}-client-{i}:5000/upload", f"client-{i}")
-            for i in range(1, 7)  # Assuming 6 containers
-        ]
-        
-        with ThreadPoolExecutor(max_workers=6) as executor:
-            futures = [
-                executor.submit(trigger_single_container, url, name, timeout)
-                for url, name in container_urls
-            ]
-            results = [future.result() for future in futures]
-
-        return jsonify({
-            'message': 'All client containers triggered successfully'
-        })
-        
+        response = forward_job_status(owner, job_id)
+        response.raise_for_status()
+        return response.json()
     except Exception as e:
-        total_time = round(time.time() - start_time, 2)
-        logger.error(f"[Container {container_id}] Error in trigger_all: {str(e)}", exc_info=True)
-        return jsonify({
-            'status': 'error',
-            'message': str(e)
-        }), 500
+        return {'job_id': job_id, 'status': 'unknown', 'error': str(e)}
+
+
+def aggregate_trigger(job):
+    """
+    Status of a trigger job with the upload job of every container it
+    triggered fetched concurrently, plus totals across containers.
+    """
+    triggered = job['result'] or []
+    job_ids = [t['job_id'] for t in triggered if t['status'] == 'triggered']
+    peers = discover_clients()
+    with ThreadPoolExecutor(max_workers=max(len(job_ids), 1)) as executor:
+        uploads = dict(zip(job_ids, executor.map(partial(fetch_job, peers=peers), job_ids)))
+
+    containers = []
+    for t in triggered:
+        upload = uploads.get(t.get('job_id'), {})
+        result = upload.get('result') or {}
+        containers.append({
+            'address': t['address'],
+            'container_id': result.get('container_id'),
+            'job_id': t.get('job_id'),
+            'status': upload.get('status', t['status']),
+            'file_size': result.get('file_size'),
+            'creation_duration': result.get('creation_duration'),
+            'upload_duration': result.get('upload_duration'),
+            'throughput_mb_s': result.get('throughput_mb_s'),
+            'finished_at': upload.get('finished_at'),
+            'error': upload.get('error') or t.get('error')
+        })
+
+    running = job['status'] == 'running' or any(c['status'] == 'running' for c in containers)
+    succeeded = [c for c in containers if c['status'] == 'succeeded']
+    finished_at = max([c['finished_at'] for c in containers if c['finished_at']], default=None)
+    duration = (time.time() if running or finished_at is None else finished_at) - job['created_at']
+    total_bytes = sum(c['file_size'] for c in succeeded)
+    rates = [c['throughput_mb_s'] for c in succeeded if c['throughput_mb_s'] is not None]
+    return {
+        **job,
+        'status': 'running' if running else 'completed',
+        'summary': {
+            'containers': len(containers),
+            'succeeded': len(succeeded),
+            'failed': sum(1 for c in containers if c['status'] in ('failed', 'unknown')),
+            'running': sum(1 for c in containers if c['status'] == 'running'),
+            'bytes_uploaded': total_bytes,
+            'duration': round(duration, 2),
+            'aggregate_mb_s': round(total_bytes / MB / duration, 2) if duration > 0 else None,
+            'throughput_mb_s': {
+                'min': min(rates, default=None),
+                'p50': median(rates) if rates else None,
+                'max': max(rates, default=None)
+            }
+        },
+        'containers': containers
+    }
+
+
+@app.route('/trigger-all', methods=['GET', 'POST'])
+def trigger_all_containers():
+    """
+    Start an upload job on every client container found through DNS and
+    return right away (202) with a job to follow at /jobs/<job_id>, which
+    aggregates per-container throughput, durations and failures.
+    """
+    job = jobs.submit('trigger', trigger_all)
+    return jsonify({**job, 'status_url': f"/jobs/{job['job_id']}"}), 202
+
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
     """
-    Handle single file upload request
+    Start a generate-and-upload job on this container and return its ID
+    right away (202). With ?wait=1 the request blocks until the upload is
+    done and returns its result.
     """
-    try:
+    if request.args.get('wait') == '1':
         result = create_and_upload_file()
-        return jsonify(result)
-    except Exception as e:
-        logger.error(f"[Container {get_container_id()}] Error in upload: {str(e)}", exc_info=True)
-        return jsonify({
-            'status': 'error',
-            'message': str(e),
-            'container_id': get_container_id()
-        }), 500
+        return jsonify(result), 200 if result['status'] == 'success' else 500
+    job = jobs.submit('upload', run_upload_job)
+    return jsonify({**job, 'status_url': f"/jobs/{job['job_id']}"}), 202
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        # Started on another container, e.g. when behind a load balancer
+        owner = None if request.headers.get(FORWARDED_HEADER) else peer_owner(job_id, discover_clients())
+        if owner is None:
+            return jsonify({'status': 'error', 'message': f"Unknown job {job_id}"}), 404
+        try:
+            response = forward_job_status(owner, job_id)
+        except requests.RequestException as e:
+            return jsonify({'status': 'error', 'message': f"Container {owner} unreachable: {str(e)}"}), 502
+        return app.response_class(response.content, status=response.status_code, mimetype='application/json')
+    if job['kind'] == 'trigger':
+        job = aggregate_trigger(job)
+    return jsonify(job)
 
 @app.route('/health')
 def health_check():
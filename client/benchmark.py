@@ -0,0 +1,406 @@
+"""
+Load generator and throughput benchmark for the upload API.
+
+Starts the API with uvicorn on localhost (or targets --api-url), uploads
+files made by FileGenerator through ChunkUploader for every combination of
+file size, chunk size and concurrency, and writes the results as JSON:
+
+    python client/benchmark.py --sizes-mb 64,256 --chunk-sizes-mb 1,8 --concurrency 1,4
+    python client/benchmark.py --output new.json --compare old.json
+
+Per scenario it reports aggregate MB/s, p50/p95/p99 latency per endpoint
+(init, chunk, dedup, zero_ranges, finalize, or single_shot) and, when the server PID is
+known, the peak RSS and CPU usage of it and its worker processes read from /proc.
+"""
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import requests
+from requests.adapters import HTTPAdapter
+from itertools import product
+from concurrent.futures import ThreadPoolExecutor
+from logs.logger import logger
+from file_gen import FileGenerator, CONTENTS
+from uploader import ChunkUploader
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MB = 1024 * 1024
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of an unsorted list, None when empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def endpoint_name(method, url):
+    path = url.split("/api/uploads/", 1)[-1]
+    if path == "init":
+        return "init"
+    if path == "finalize":
+        return "finalize"
+    if path.endswith("/dedup"):
+        return "dedup"
+    if path.endswith("/zero-ranges"):
+        return "zero_ranges"
+    if method == "PUT":
+        return "chunk"
+    return path
+
+
+class TimedUploader(ChunkUploader):
+    """ChunkUploader that records the latency of every API call by endpoint."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = {}
+        self._lock = threading.Lock()
+
+    def _send_with_retry(self, method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super()._send_with_retry(method, url, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.latencies.setdefault(endpoint_name(method, url), []).append(elapsed)
+
+
+class ProcessSampler:
+    """
+    Samples RSS and CPU time of a local process and all its descendants,
+    such as uvicorn's workers under WEB_CONCURRENCY, from /proc (Linux only).
+    """
+
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._cpu_start = None
+
+    @staticmethod
+    def _stat(pid):
+        with open(f"/proc/{pid}/stat") as f:
+            # Fields after the parenthesised command name, starting with state (field 3)
+            return f.read().rsplit(")", 1)[1].split()
+
+    def _pids(self):
+        """The sampled process followed by its live descendants."""
+        children = {}
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    children.setdefault(int(self._stat(entry)[1]), []).append(int(entry))
+                except (OSError, IndexError, ValueError):
+                    continue  # exited while listing
+        pids, pending = [], [self.pid]
+        while pending:
+            pid = pending.pop()
+            pids.append(pid)
+            pending.extend(children.get(pid, []))
+        return pids
+
+    def _rss(self):
+        total = 0
+        for pid in self._pids():
+            try:
+                with open(f"/proc/{pid}/statm") as f:
+                    total += int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+            except OSError:
+                continue
+        return total
+
+    def _cpu_seconds(self):
+        ticks = 0
+        for pid in self._pids():
+            try:
+                fields = self._stat(pid)
+            except OSError:
+                continue
+            # utime, stime, cutime and cstime are fields 14 to 17; a process that
+            # exits moves its time into its parent's cutime/cstime once reaped
+            ticks += sum(int(field) for field in fields[11:15])
+        return ticks / os.sysconf("SC_CLK_TCK")
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, self._rss())
+
+    def start(self):
+        self._cpu_start = self._cpu_seconds()
+        self.peak_rss = self._rss()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return {
+            'peak_rss_mb': round(self.peak_rss / MB, 1),
+            'cpu_seconds': round(self._cpu_seconds() - self._cpu_start, 2)
+        }
+
+
+def start_local_api(port, storage_dir):
+    """Run the API with uvicorn on localhost, storing uploads under storage_dir."""
+    env = {**os.environ, 'PYTHONPATH': os.path.join(REPO_ROOT, "file_upload_api")}
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=storage_dir,
+        env=env
+    )
+    api_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"API exited with code {process.returncode}")
+        try:
+            if requests.get(f"{api_url}/api/health", timeout=1).ok:
+                return process, api_url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("API did not become healthy within 30s")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run_scenario(api_url, server_pid, work_dir, size_mb, chunk_size_mb, concurrency, args):
+    generator = FileGenerator(
+        output_dir=os.path.join(work_dir, "generated_files"),
+        seed=args.seed,
+        dedup_ratio=args.dedup_ratio,
+        workers=args.generator_workers
+    )
+    # Chunk size 0 lets the server choose and the uploader adapt request sizes
+    uploader = TimedUploader(
+        api_url,
+        chunk_size_mb * MB or None,
+        parallelism=args.parallelism,
+        adaptive=not chunk_size_mb,
+        retry_backoff=0.5,
+        timeout=args.timeout,
+        dedup=args.dedup,
+        compression=args.compression
+    )
+    # One uploader is shared by all concurrent uploads, size its pool for all of them
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency * args.parallelism)
+    uploader.session.mount("http://", adapter)
+    uploader.session.mount("https://", adapter)
+    # Files are generated up front so only the upload itself is timed; streamed
+    # uploads generate as they send, so generation is part of what's timed
+    if args.stream:
+        files = [f"bench_{n}.dat" for n in range(args.uploads)]
+    else:
+        files = [
+            generator.create_file(f"bench_{n}.dat", size_mb / 1024, size_mb / 1024, content=args.content)
+            for n in range(args.uploads)
+        ]
+
+    def single_shot(filepath):
+        filename = f"bench_{time.time_ns()}_{os.path.basename(filepath)}"
+        start = time.perf_counter()
+        with open(filepath, 'rb') as f:
+            if args.single_shot == "raw":
+                response = uploader.session.put(
+                    f"{api_url}/api/uploads/files/{filename}", data=f, params={'client_id': 'benchmark'},
+                    timeout=args.timeout
+                )
+            else:
+                response = uploader.session.post(
+                    f"{api_url}/api/uploads/", files={'file': (filename, f)}, data={'client_id': 'benchmark'},
+                    timeout=args.timeout
+                )
+        response.raise_for_status()
+        elapsed = time.perf_counter() - start
+        with uploader._lock:
+            uploader.latencies.setdefault('single_shot', []).append(elapsed)
+        return os.path.getsize(filepath), elapsed
+
+    def upload(filepath):
+        if args.single_shot:
+            return single_shot(filepath)
+        start = time.perf_counter()
+        init_data = {
+            'client_id': 'benchmark',
+            'timestamp': str(time.time()),
+            'file_creation_time': time.strftime("%Y-%m-%d %H:%M:%S"),
+            'filename': f"bench_{time.time_ns()}_{os.path.basename(filepath)}"
+        }
+        if args.stream:
+            stream = generator.stream_file(filepath, size_mb / 1024, size_mb / 1024, content=args.content)
+            upload_id, checksum = uploader.upload_stream(stream, stream.size, init_data)
+            size = stream.size
+        else:
+            upload_id, checksum = uploader.upload(filepath, init_data)
+            size = os.path.getsize(filepath)
+        uploader.finalize(upload_id, checksum=checksum)
+        return size, time.perf_counter() - start
+
+    sampler = ProcessSampler(server_pid) if server_pid else None
+    if sampler:
+        sampler.start()
+    errors = 0
+    completed = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(upload, filepath) for filepath in files]:
+            try:
+                completed.append(future.result())
+            except Exception as e:
+                errors += 1
+                logger.error(f"Benchmark upload failed: {str(e)}")
+    wall = time.perf_counter() - start
+    server = sampler.stop() if sampler else None
+    uploader.close()
+    if not args.stream:
+        for filepath in files:
+            os.remove(filepath)
+
+    total_bytes = sum(size for size, _ in completed)
+    upload_rates = [size / MB / seconds for size, seconds in completed]
+    if server:
+        server['cpu_percent'] = round(100 * server['cpu_seconds'] / wall, 1)
+    return {
+        'scenario': {
+            'size_mb': size_mb,
+            'chunk_size_mb': chunk_size_mb,
+            'concurrency': concurrency,
+            'parallelism': args.parallelism,
+            'uploads': args.uploads,
+            'content': args.content,
+            'seed': args.seed,
+            'compression': args.compression,
+            'single_shot': args.single_shot,
+            'stream': args.stream
+        },
+        'uploads_ok': len(completed),
+        'errors': errors,
+        'wall_seconds': round(wall, 3),
+        'throughput_mb_s': round(total_bytes / MB / wall, 2),
+        'per_upload_mb_s': {
+            'p50': round(percentile(upload_rates, 50) or 0, 2),
+            'min': round(min(upload_rates, default=0), 2)
+        },
+        'latency_ms': {
+            endpoint: {
+                'count': len(values),
+                **{f"p{p}": round(percentile(values, p) * 1000, 2) for p in (50, 95, 99)}
+            }
+            for endpoint, values in sorted(uploader.latencies.items())
+        },
+        'server': server
+    }
+
+
+def scenario_key(result):
+    s = result['scenario']
+    return (
+        s['size_mb'], s['chunk_size_mb'], s['concurrency'], s['parallelism'], s['content'], s['compression'],
+        s.get('single_shot'), s.get('stream'), s.get('seed')
+    )
+
+
+def compare(results, baseline_path):
+    """Print throughput and chunk p95 changes against an earlier results file."""
+    with open(baseline_path) as f:
+        baseline = {scenario_key(r): r for r in json.load(f)['results']}
+    for result in results:
+        before = baseline.get(scenario_key(result))
+        if before is None:
+            continue
+        change = 100 * (result['throughput_mb_s'] / before['throughput_mb_s'] - 1) if before['throughput_mb_s'] else 0
+        chunk_now = result['latency_ms'].get('chunk', {}).get('p95')
+        chunk_before = before['latency_ms'].get('chunk', {}).get('p95')
+        print(
+            f"{scenario_key(result)}: {before['throughput_mb_s']} -> {result['throughput_mb_s']} MB/s ({change:+.1f}%), "
+            f"chunk p95 {chunk_before} -> {chunk_now} ms"
+        )
+
+
+def parse_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the upload API")
+    parser.add_argument("--api-url", help="Benchmark a running API instead of starting one on localhost")
+    parser.add_argument("--server-pid", type=int, help="PID of the running API, for RSS/CPU sampling with --api-url")
+    parser.add_argument("--sizes-mb", type=parse_list, default=[64])
+    parser.add_argument("--chunk-sizes-mb", type=parse_list, default=[8], help="0 for server-chosen, adaptive chunking")
+    parser.add_argument("--concurrency", type=parse_list, default=[4], help="Uploads in flight at once")
+    parser.add_argument("--parallelism", type=int, default=4, help="Chunks in flight per upload")
+    parser.add_argument("--uploads", type=int, default=8, help="Uploads per scenario")
+    parser.add_argument("--content", choices=CONTENTS, default="random")
+    parser.add_argument("--seed", type=int, help="Generate the same content on every run")
+    parser.add_argument("--dedup-ratio", type=float, default=0.5, help="Share of repeated blocks with --content dedup")
+    parser.add_argument("--generator-workers", type=int, default=os.cpu_count() or 1, help="Processes generating content")
+    parser.add_argument("--compression", default="none")
+    parser.add_argument("--dedup", action="store_true", help="Offer chunks for dedup when the server supports it")
+    parser.add_argument(
+        "--single-shot", choices=["multipart", "raw"],
+        help="Upload each file in one request (POST / or PUT /files/{name}) instead of in chunks"
+    )
+    parser.add_argument(
+        "--stream", action="store_true", help="Generate each file while uploading it instead of writing it to disk first"
+    )
+    parser.add_argument("--timeout", type=int, default=60)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    args = parser.parse_args()
+    if args.stream and args.single_shot:
+        parser.error("--stream only applies to chunked uploads")
+
+    started_at = time.strftime("%Y-%m-%d %H:%M:%S")
+    work_dir = tempfile.mkdtemp(prefix="upload_bench_")
+    process = None
+    try:
+        if args.api_url:
+            api_url, server_pid = args.api_url.rstrip("/"), args.server_pid
+        else:
+            process, api_url = start_local_api(free_port(), work_dir)
+            server_pid = process.pid
+
+        results = []
+        for size_mb, chunk_size_mb, concurrency in product(args.sizes_mb, args.chunk_sizes_mb, args.concurrency):
+            logger.info(f"Benchmark: {size_mb} MB files, {chunk_size_mb} MB chunks, {concurrency} concurrent uploads")
+            result = run_scenario(api_url, server_pid, work_dir, size_mb, chunk_size_mb, concurrency, args)
+            logger.info(f"Benchmark: {result['throughput_mb_s']} MB/s, chunk latency {result['latency_ms'].get('chunk')}")
+            results.append(result)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump({
+            'started_at': started_at,
+            'api_url': args.api_url or "local",
+            'results': results
+        }, f, indent=2)
+    logger.info(f"Benchmark results written to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,217 @@
 import os
 import sys
+import time
 import random
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from logs.logger import logger
 
+BLOCK_SIZE = 1024 * 1024
+CONTENTS = ("sparse", "random", "compressible", "csv", "dedup")
 
+# Share of "dedup" blocks that repeat an earlier block. Blocks are
+# BLOCK_SIZE apart, which matches the server's default chunk size, so
+# every repeat is a chunk the server can deduplicate.
+DEDUP_RATIO = 0.5
+# Blocks handed to a generator process per task, and tasks queued per process
+BLOCKS_PER_TASK = 8
+TASKS_PER_WORKER = 2
 
+CSV_HEADER = "id,date,category,amount\n"
+CSV_DATES = [f"2026-{month:02d}-{day:02d}" for month in range(1, 13) for day in range(1, 29)]
+CSV_CATEGORIES = ["alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel",
+                  "india", "juliet", "kilo", "lima", "mike", "november", "oscar", "papa"]
+CSV_AMOUNTS = [f"{cents // 100}.{cents % 100:02d}" for cents in range(100000)]
+CSV_ROWS_PER_BATCH = 8192
 
-class FileGenerator:
 
+def _block_random(seed, index):
+    # String seeds are hashed with sha512, the same in every process
+    return random.Random(f"{seed}:{index}")
+
+
+def _is_repeat(index, ratio):
+    # Repeats are spread evenly: exactly floor(n * ratio) of the first n blocks
+    return int((index + 1) * ratio) > int(index * ratio)
+
+
+def _dedup_source(index, seed, ratio):
+    """Index of the unique block that block index repeats, or index itself."""
+    while index > 0 and _is_repeat(index, ratio):
+        index = _block_random(seed, f"repeat:{index}").randrange(index)
+    return index
+
+
+def _csv_block(rng, size, index):
+    # Row IDs never collide between blocks since no block holds size rows
+    parts = [CSV_HEADER] if index == 0 else []
+    length = len(parts[0]) if parts else 0
+    row_id = index * size
+    while length < size:
+        n = CSV_ROWS_PER_BATCH
+        rows = "".join([
+            f"{row_id},{date},{category},{amount}\n"
+            for row_id, date, category, amount in zip(
+                range(row_id, row_id + n),
+                rng.choices(CSV_DATES, k=n),
+                rng.choices(CSV_CATEGORIES, k=n),
+                rng.choices(CSV_AMOUNTS, k=n)
+            )
+        ])
+        parts.append(rows)
+        length += len(rows)
+        row_id += n
+    # Cut to size, still ending on a line break
+    return "".join(parts).encode()[:size - 1] + b"\n"
+
+
+def generate_block(content, size, seed=None, index=0, dedup_ratio=DEDUP_RATIO):
+    """
+    Block number index (of size bytes) of a file with the given content:
+
+    - "sparse": all zeros
+    - "random": incompressible bytes
+    - "compressible": hex text that deflates to about half its size
+    - "csv": rows of CSV records
+    - "dedup": random blocks, dedup_ratio of which repeat an earlier block
+
+    With a seed the block is a pure function of (seed, index), so a file
+    comes out the same on every run and blocks can be generated in any
+    order or process. Without one, random content comes from os.urandom.
+    "dedup" needs a seed to find the blocks it repeats.
+    """
+    if content == "dedup":
+        if seed is None:
+            raise ValueError("dedup content needs a seed")
+        index = _dedup_source(index, seed, dedup_ratio)
+        content = "random"
+    if content == "random":
+        return os.urandom(size) if seed is None else _block_random(seed, index).randbytes(size)
+    if content == "compressible":
+        half = -(-size // 2)
+        raw = os.urandom(half) if seed is None else _block_random(seed, index).randbytes(half)
+        return raw.hex().encode()[:size]
+    if content == "csv":
+        return _csv_block(_block_random(seed, index) if seed is not None else random.Random(), size, index)
+    return bytes(size)
+
+
+def _generate_blocks(content, sizes, seed, first_index, dedup_ratio):
+    return [
+        generate_block(content, size, seed, first_index + n, dedup_ratio)
+        for n, size in enumerate(sizes)
+    ]
+
+
+class GeneratedStream:
+    """
+    A file that is generated block by block as it's iterated instead of
+    being written to disk. With workers > 1 blocks are generated ahead in a
+    process pool, a bounded number at a time, and still come out in order.
+    generation_duration adds up the time the consumer spent waiting for
+    blocks, not the time it spent between them.
+    """
+
+    def __init__(self, filename, size, content, block_size=BLOCK_SIZE, seed=None, dedup_ratio=DEDUP_RATIO, workers=1):
+        self.filename = filename
+        self.size = size
+        self.content = content
+        self.block_size = block_size
+        self.seed = seed if seed is not None or content != "dedup" else random.getrandbits(64)
+        self.dedup_ratio = dedup_ratio
+        self.workers = workers
+        self.generation_duration = 0.0
 
-    def __init__(self, output_dir="generated_files"):
+    def _block_sizes(self, first, count):
+        return [
+            min(self.block_size, self.size - index * self.block_size)
+            for index in range(first, min(first + count, -(-self.size // self.block_size)))
+        ]
+
+    def __iter__(self):
+        if self.content == "sparse":
+            return self._zero_blocks()
+        if self.workers > 1:
+            return self._pooled_blocks()
+        return self._blocks()
+
+    def _zero_blocks(self):
+        # Zero blocks are all alike, so one is reused
+        zeros = bytes(self.block_size)
+        for size in self._block_sizes(0, -(-self.size // self.block_size)):
+            yield zeros if size == self.block_size else zeros[:size]
+
+    def _blocks(self):
+        for index, size in enumerate(self._block_sizes(0, -(-self.size // self.block_size))):
+            start = time.perf_counter()
+            block = generate_block(self.content, size, self.seed, index, self.dedup_ratio)
+            self.generation_duration += time.perf_counter() - start
+            yield block
+
+    def _pooled_blocks(self):
+        # forkserver children don't inherit the upload threads and their locks
+        context = multiprocessing.get_context("forkserver")
+        executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        pending = deque()
+        next_index = 0
+        total_blocks = -(-self.size // self.block_size)
+        try:
+            while pending or next_index < total_blocks:
+                while next_index < total_blocks and len(pending) < self.workers * TASKS_PER_WORKER:
+                    sizes = self._block_sizes(next_index, BLOCKS_PER_TASK)
+                    pending.append(executor.submit(
+                        _generate_blocks, self.content, sizes, self.seed, next_index, self.dedup_ratio
+                    ))
+                    next_index += len(sizes)
+                start = time.perf_counter()
+                blocks = pending.popleft().result()
+                self.generation_duration += time.perf_counter() - start
+                yield from blocks
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+class FileGenerator:
+    """
+    Generates test files (see generate_block for the content). With a seed,
+    file names, sizes and content all repeat from run to run; workers > 1
+    generates content in that many processes.
+    """
+
+    def __init__(self, output_dir="generated_files", seed=None, dedup_ratio=DEDUP_RATIO, workers=1):
         self.output_dir = output_dir
         self.extensions = ['.txt', '.pdf', '.doc',
          '.docx', '.csv', '.dat', '.mp4', '.wav']
+        self.seed = seed
+        self.dedup_ratio = dedup_ratio
+        self.workers = workers
+        self._random = random.Random(seed)
         os.makedirs(output_dir, exist_ok=True)
         logger.info(f"Initialized FileGenerator with output directory: {output_dir}")
-        
 
-    def create_file(self, filename=None, min_size_gb=4, max_size_gb=8):
-        size_gb = random.uniform(min_size_gb, max_size_gb)
-        size_bytes = int(size_gb * 1024 * 1024 * 1024)  
-        
+    def _pick(self, filename, min_size_gb, max_size_gb):
+        size_gb = self._random.uniform(min_size_gb, max_size_gb)
+        size_bytes = int(size_gb * 1024 * 1024 * 1024)
+
         if filename is None:
-            timestamp = random.randint(1000000, 9999999)
-            extension = random.choice(self.extensions)
+            timestamp = self._random.randint(1000000, 9999999)
+            extension = self._random.choice(self.extensions)
             filename = f"file_{timestamp}__{extension}"
-            
+        return filename, size_bytes
+
+    def _stream(self, filename, size_bytes, content, block_size=BLOCK_SIZE):
+        # Each file gets its own content seed, drawn from the generator's seed
+        seed = self._random.getrandbits(64) if self.seed is not None else None
+        return GeneratedStream(filename, size_bytes, content, block_size, seed, self.dedup_ratio, self.workers)
+
+    def create_file(self, filename=None, min_size_gb=4, max_size_gb=8, content="sparse"):
+        """
+        content "sparse" only writes the last byte, so the file is one big
+        hole; any other content is written out in full.
+        """
+        filename, size_bytes = self._pick(filename, min_size_gb, max_size_gb)
+        size_gb = size_bytes / (1024 * 1024 * 1024)
         filepath = os.path.join(self.output_dir, filename)
         
         logger.info(f"Starting creation of {filename} ({size_gb:.2f} GB)")
@@ -33,8 +219,12 @@ class FileGenerator:
         
         try:
             with open(filepath, 'wb') as f:
-                f.seek(size_bytes - 1)
-                f.write(b'\0')
+                if content == "sparse":
+                    f.seek(size_bytes - 1)
+                    f.write(b'\0')
+                else:
+                    for block in self._stream(filename, size_bytes, content):
+                        f.write(block)
             logger.info(f"Successfully created {filename} ({size_gb:.2f} GB)")
             sys.stdout.flush()
         except Exception as e:
@@ -43,3 +233,12 @@ class FileGenerator:
             raise
             
         return filepath
+
+    def stream_file(self, filename=None, min_size_gb=4, max_size_gb=8, content="sparse", block_size=BLOCK_SIZE):
+        """
+        Like create_file, but nothing lands on disk: the returned stream
+        generates the content block by block as the uploader consumes it.
+        """
+        filename, size_bytes = self._pick(filename, min_size_gb, max_size_gb)
+        logger.info(f"Streaming {filename} ({size_bytes / (1024 * 1024 * 1024):.2f} GB of {content} content)")
+        return self._stream(filename, size_bytes, content, block_size)
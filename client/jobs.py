@@ -0,0 +1,61 @@
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from logs.logger import logger
+
+
+class JobRegistry:
+    """
+    Background jobs run on their own threads and tracked in memory. A job
+    ID ends in "@<host>:<port>" of the container running it, so a container
+    asked about a job it doesn't own knows where to forward the question.
+    Only the newest max_jobs jobs are kept; older finished ones are dropped.
+    """
+
+    def __init__(self, owner, max_jobs=1000):
+        self.owner = owner
+        self.max_jobs = max_jobs
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def owner_of(job_id):
+        _, separator, owner = job_id.rpartition("@")
+        return owner if separator and owner else None
+
+    def submit(self, kind, fn, *args):
+        """Run fn(*args) in the background and return a snapshot of the new job."""
+        job = {
+            'job_id': f"{uuid.uuid4().hex}@{self.owner}",
+            'kind': kind,
+            'status': 'running',
+            'created_at': time.time(),
+            'finished_at': None,
+            'result': None,
+            'error': None
+        }
+        with self._lock:
+            self._jobs[job['job_id']] = job
+            self._forget_old()
+        threading.Thread(target=self._run, args=(job, fn, args), daemon=True).start()
+        return dict(job)
+
+    def _run(self, job, fn, args):
+        try:
+            outcome = {'status': 'succeeded', 'result': fn(*args)}
+        except Exception as e:
+            logger.error(f"Job {job['job_id']} ({job['kind']}) failed: {str(e)}", exc_info=True)
+            outcome = {'status': 'failed', 'error': str(e)}
+        with self._lock:
+            job.update(outcome, finished_at=time.time())
+
+    def _forget_old(self):
+        excess = len(self._jobs) - self.max_jobs
+        for job_id in [job_id for job_id, job in self._jobs.items() if job['finished_at'] is not None][:max(excess, 0)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
@@ -0,0 +1,568 @@
+import os
+import mmap
+import zlib
+import errno
+import time
+import queue
+import hashlib
+import threading
+import requests
+from logs.logger import logger
+from requests.adapters import HTTPAdapter
+from functools import lru_cache
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# zstd and lz4 are optional, deflate (zlib) is always available
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+# Fast levels: the goal is to get ahead of the network, not to save disk.
+# All three release the GIL while compressing, so the upload threads
+# compress chunks in parallel.
+COMPRESSORS = {'deflate': lambda data: zlib.compress(data, 1)}
+if zstandard is not None:
+    COMPRESSORS['zstd'] = lambda data: zstandard.ZstdCompressor(level=3).compress(data)
+if lz4_frame is not None:
+    COMPRESSORS['lz4'] = lambda data: lz4_frame.compress(data)
+COMPRESSION_PREFERENCE = ('zstd', 'lz4', 'deflate')
+
+# Already compressed media is sent as is without trying
+INCOMPRESSIBLE_EXTENSIONS = {'.mp4', '.wav', '.mp3', '.jpg', '.png', '.zip', '.gz', '.zst'}
+# Each chunk is probed with a sample first, and only sent compressed when it
+# shrinks to at most MAX_COMPRESSED_RATIO of its size
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+MAX_COMPRESSED_RATIO = 0.9
+
+# Cap on how long a server-sent Retry-After can make a request wait
+MAX_RETRY_AFTER = 60
+# Statuses the server answers before doing anything, so even a request
+# that isn't idempotent can be sent again
+REFUSED_STATUSES = (429, 503)
+
+# Used when the server doesn't recommend a parallelism, and as the ceiling
+# on what it recommends
+DEFAULT_PARALLELISM = 4
+MAX_PARALLELISM = 16
+
+# Adaptive request sizing: each chunk request aims to take
+# REQUEST_RTT_MULTIPLE round trips and at least MIN_REQUEST_SECONDS, so
+# per-request latency is amortized while a failed request stays cheap to resend
+MIN_REQUEST_SECONDS = 0.5
+REQUEST_RTT_MULTIPLE = 20
+THROUGHPUT_SMOOTHING = 0.3
+
+
+class ChunkUploadError(Exception):
+    pass
+
+
+@lru_cache(maxsize=16)
+def zero_digest(size):
+    return hashlib.sha256(bytes(size)).hexdigest()
+
+
+def hole_ranges(fd, file_size):
+    """Byte ranges [start, end) of a sparse file that are holes, via SEEK_DATA/SEEK_HOLE."""
+    if not hasattr(os, 'SEEK_DATA'):
+        return []
+    holes = []
+    offset = 0
+    try:
+        while offset < file_size:
+            try:
+                data = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+                data = file_size
+            if data > offset:
+                holes.append((offset, min(data, file_size)))
+            if data >= file_size:
+                break
+            offset = os.lseek(fd, data, os.SEEK_HOLE)
+    except OSError:
+        # Filesystem can't report holes, every chunk gets read
+        return []
+    return holes
+
+
+def chunk_ranges(chunk_numbers):
+    """Inclusive [start, end] ranges of consecutive numbers in a sorted list."""
+    ranges = []
+    for n in chunk_numbers:
+        if ranges and ranges[-1][1] == n - 1:
+            ranges[-1][1] = n
+        else:
+            ranges.append([n, n])
+    return ranges
+
+
+class ChunkSizer:
+    """
+    Picks how many consecutive chunks each request carries, from 1 to
+    max_span. Starts from the server's recommendation, then resizes requests
+    to take a target time derived from the smallest round trip seen, using a
+    moving average of measured per-request throughput. It at most doubles
+    per step and halves when the server reports overload.
+    """
+
+    def __init__(self, chunk_size, span=1, max_span=1, adaptive=True):
+        self.chunk_size = chunk_size
+        self.max_span = max(1, max_span)
+        self.span = min(max(1, span), self.max_span)
+        self.adaptive = adaptive
+        self.rtt = None
+        self.throughput = None
+        self._lock = threading.Lock()
+
+    def observe_rtt(self, seconds):
+        with self._lock:
+            self.rtt = seconds if self.rtt is None else min(self.rtt, seconds)
+
+    def observe(self, size, seconds):
+        """Record a chunk request of size bytes that took seconds."""
+        if not self.adaptive or seconds <= 0:
+            return
+        with self._lock:
+            rate = size / seconds
+            if self.throughput is None:
+                self.throughput = rate
+            else:
+                self.throughput += THROUGHPUT_SMOOTHING * (rate - self.throughput)
+            target = max(MIN_REQUEST_SECONDS, REQUEST_RTT_MULTIPLE * (self.rtt or 0))
+            ideal = int(self.throughput * target // self.chunk_size)
+            self.span = max(1, min(self.max_span, self.span * 2, ideal))
+
+    def back_off(self):
+        if self.adaptive:
+            with self._lock:
+                self.span = max(1, self.span // 2)
+
+    @property
+    def request_size(self):
+        return self.span * self.chunk_size
+
+
+class _PendingChunks:
+    """Chunk numbers still to send, handed out to upload threads as runs of consecutive chunks."""
+
+    def __init__(self, chunk_numbers):
+        self._pending = deque(sorted(chunk_numbers))
+        self._lock = threading.Lock()
+
+    def take(self, count):
+        with self._lock:
+            run = []
+            while self._pending and len(run) < count and (not run or self._pending[0] == run[-1] + 1):
+                run.append(self._pending.popleft())
+            return run
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+
+
+class ChunkUploader:
+    """
+    Uploads a file through the API's init/chunk/finalize endpoints keeping
+    up to `parallelism` requests in flight over a pool of keep-alive
+    connections. Each request is retried on its own, and finalize is only
+    sent once every chunk has been acknowledged. When the server
+    deduplicates, each chunk is first offered by digest and only sent if it
+    is unknown.
+
+    With chunk_size None the server picks the chunk size, and with
+    parallelism None the server's recommendation is used. When adaptive,
+    consecutive chunks are batched into larger requests (up to the server's
+    max_chunk_size) as measured throughput allows, see ChunkSizer.
+
+    Chunks lying in holes of a sparse file are never read, and they and any
+    all-zero chunks are sent as zero ranges that the server recreates as
+    holes.
+
+    compression is "auto" (best codec both sides support), "none", or a
+    codec name; chunks that don't compress well are sent raw.
+
+    Chunk requests are idempotent and retried on any failure. /init is only
+    retried when the server refused it outright, so a lost response never
+    opens a second session. Finalize waits up to finalize_timeout, as
+    assembling a large file can outlast a chunk request.
+    """
+
+    def __init__(
+        self, api_url, chunk_size=None, parallelism=None, max_retries=3, retry_backoff=1.0, timeout=30,
+        dedup=True, compression="auto", adaptive=True, finalize_timeout=600
+    ):
+        self.api_url = api_url
+        self.chunk_size = chunk_size
+        self.parallelism = parallelism
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.timeout = timeout
+        self.finalize_timeout = finalize_timeout
+        self.dedup = dedup
+        self.compression = compression
+        self.adaptive = adaptive
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=parallelism or MAX_PARALLELISM)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _send_with_retry(self, method, url, on_overload=None, idempotent=True, timeout=None, **kwargs):
+        """
+        Send a request, retrying failures up to max_retries times. Unless
+        idempotent, only REFUSED_STATUSES are retried: after a timeout, a
+        dropped connection or a server error the request may have taken
+        effect, and ChunkUploadError is raised instead.
+        """
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                response = self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+                if response.status_code < 500 and response.status_code != 429:
+                    response.raise_for_status()
+                    return response
+                error = f"HTTP {response.status_code}: {response.text[:200]}"
+                retry_after = response.headers.get('Retry-After')
+                if on_overload is not None and response.status_code in REFUSED_STATUSES:
+                    on_overload()
+                if not idempotent and response.status_code not in REFUSED_STATUSES:
+                    raise ChunkUploadError(f"Request to {url} failed and is not safe to retry: {error}")
+            except requests.HTTPError:
+                raise
+            except requests.RequestException as e:
+                if not idempotent:
+                    raise ChunkUploadError(f"Request to {url} failed and is not safe to retry: {e}") from e
+                error = str(e)
+            if attempt < self.max_retries:
+                # An overloaded server says when to come back, otherwise back off exponentially
+                delay = self.retry_backoff * 2 ** attempt
+                if retry_after is not None and retry_after.isdigit():
+                    delay = min(int(retry_after), MAX_RETRY_AFTER)
+                logger.warning(f"Request to {url} failed ({error}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+        raise ChunkUploadError(f"Request to {url} failed after {self.max_retries + 1} attempts: {error}")
+
+    def _choose_encoding(self, server_encodings, filepath):
+        if self.compression == "none" or os.path.splitext(filepath)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+            return None
+        candidates = COMPRESSION_PREFERENCE if self.compression == "auto" else (self.compression,)
+        return next((c for c in candidates if c in COMPRESSORS and c in server_encodings), None)
+
+    @staticmethod
+    def _compress(chunk, encoding):
+        compress = COMPRESSORS[encoding]
+        sample = chunk[:COMPRESSION_SAMPLE_SIZE]
+        if len(compress(sample)) > len(sample) * MAX_COMPRESSED_RATIO:
+            return None
+        compressed = compress(chunk)
+        return compressed if len(compressed) <= len(chunk) * MAX_COMPRESSED_RATIO else None
+
+    def _put_chunks(self, view, upload_id, first, last, digests, encoding, sizer, base=0):
+        """
+        Send chunks first..last as one raw PUT, spanning several chunks when
+        last > first. view starts at chunk base.
+        """
+        chunk_size = sizer.chunk_size
+        headers = {
+            'Content-Type': 'application/octet-stream',
+            'X-Chunk-Digest': ",".join(f"sha256={digests[n]}" for n in range(first, last + 1))
+        }
+        if last > first:
+            headers['X-Chunk-Span'] = str(last - first + 1)
+        # The slice goes to socket.sendall as is, no multipart encoding copy
+        with view[(first - base) * chunk_size:(last + 1 - base) * chunk_size] as body:
+            compressed = self._compress(body, encoding) if encoding else None
+            if compressed is not None:
+                headers['Content-Encoding'] = encoding
+            response = self._send_with_retry(
+                "PUT",
+                f"{self.api_url}/api/uploads/{upload_id}/chunks/{first}",
+                on_overload=sizer.back_off,
+                data=body if compressed is None else compressed,
+                headers=headers
+            )
+            # elapsed covers sending the body up to the response headers of the attempt that succeeded
+            sizer.observe(len(body), response.elapsed.total_seconds())
+
+    def _offer_chunk(self, upload_id, chunk_number, digest, sizer):
+        """Offer a chunk by digest, True when the server already had it."""
+        response = self._send_with_retry(
+            "POST",
+            f"{self.api_url}/api/uploads/{upload_id}/chunks/{chunk_number}/dedup",
+            headers={'X-Chunk-Digest': f"sha256={digest}"}
+        )
+        sizer.observe_rtt(response.elapsed.total_seconds())
+        return response.json().get('deduplicated', False)
+
+    def _upload_run(self, view, upload_id, run, sizer, dedup, encoding, base=0):
+        """Send a run of consecutive chunks, returning their digests. view starts at chunk base."""
+        chunk_size = sizer.chunk_size
+        digests = {}
+        zeros, send = [], []
+        for chunk_number in run:
+            start = (chunk_number - base) * chunk_size
+            with view[start:start + chunk_size] as chunk:
+                digest = hashlib.sha256(chunk).hexdigest()
+                size = len(chunk)
+            digests[chunk_number] = digest
+            if digest == zero_digest(size):
+                zeros.append(chunk_number)
+            elif not (dedup and self._offer_chunk(upload_id, chunk_number, digest, sizer)):
+                send.append(chunk_number)
+        if zeros:
+            self._send_zero_ranges(upload_id, chunk_ranges(zeros))
+        for first, last in chunk_ranges(send):
+            self._put_chunks(view, upload_id, first, last, digests, encoding, sizer, base)
+        return digests
+
+    def _send_zero_ranges(self, upload_id, ranges):
+        self._send_with_retry("POST", f"{self.api_url}/api/uploads/{upload_id}/zero-ranges", json={'chunks': ranges})
+
+    @staticmethod
+    def _hole_chunks(fd, file_size, chunk_size):
+        """Inclusive ranges of chunk numbers that lie entirely in holes."""
+        total_chunks = -(-file_size // chunk_size)
+        ranges = []
+        for start, end in hole_ranges(fd, file_size):
+            first = -(-start // chunk_size)
+            last = total_chunks - 1 if end >= file_size else end // chunk_size - 1
+            if first <= last:
+                ranges.append([first, last])
+        return ranges
+
+    def _upload_chunks(self, view, upload_id, chunk_numbers, digests, sizer, parallelism, dedup=False, encoding=None):
+        # Each thread takes the next run of pending chunks sized by the sizer at that moment
+        pending = _PendingChunks(chunk_numbers)
+
+        def worker():
+            while True:
+                run = pending.take(sizer.span)
+                if not run:
+                    return
+                digests.update(self._upload_run(view, upload_id, run, sizer, dedup, encoding))
+
+        with ThreadPoolExecutor(max_workers=parallelism) as executor:
+            futures = [executor.submit(worker) for _ in range(min(parallelism, len(chunk_numbers)))]
+            try:
+                for future in futures:
+                    future.result()
+            except Exception:
+                pending.clear()
+                raise
+
+    def _init_upload(self, init_data, total_size, filename):
+        """Open an upload session and settle chunk size, request sizing, parallelism, dedup and encoding."""
+        response = self._send_with_retry(
+            "POST",
+            f"{self.api_url}/api/uploads/init",
+            idempotent=False,
+            json={**init_data, 'total_size': total_size, 'chunk_size': self.chunk_size or "auto"}
+        )
+        init_response = response.json()
+        upload_id = init_response['upload_id']
+        chunk_size = init_response.get('chunk_size') or self.chunk_size
+        sizer = ChunkSizer(
+            chunk_size,
+            span=init_response.get('recommended_chunk_size', chunk_size) // chunk_size,
+            max_span=init_response.get('max_chunk_size', chunk_size) // chunk_size if self.adaptive else 1,
+            adaptive=self.adaptive
+        )
+        sizer.observe_rtt(response.elapsed.total_seconds())
+        parallelism = self.parallelism or min(init_response.get('parallelism', DEFAULT_PARALLELISM), MAX_PARALLELISM)
+        dedup = self.dedup and init_response.get('dedup', False)
+        encoding = self._choose_encoding(init_response.get('encodings', []), filename)
+        compressed = f", {encoding} compressed" if encoding else ""
+        logger.info(
+            f"Upload {upload_id} initialized, sending {-(-total_size // chunk_size)} chunks of {chunk_size} bytes, "
+            f"{sizer.request_size} bytes per request with {parallelism} in flight{compressed}"
+        )
+        return upload_id, sizer, parallelism, dedup, encoding
+
+    def _missing_chunks(self, upload_id):
+        status = self._send_with_retry("GET", f"{self.api_url}/api/uploads/{upload_id}/status").json()
+        return [n for start, end in status.get('missing', []) for n in range(start, end + 1)]
+
+    @staticmethod
+    def _tree_checksum(digests, total_chunks):
+        tree = hashlib.sha256(b"".join(bytes.fromhex(digests[n]) for n in range(total_chunks)))
+        return f"sha256-tree:{tree.hexdigest()}"
+
+    def upload(self, filepath, init_data):
+        """
+        Initialize an upload of filepath with init_data (client_id,
+        timestamp, filename, ...) and send all of its chunks, resending any
+        the server reports missing. Returns the upload_id to finalize and the
+        whole-file checksum the server is expected to report, a sha256 over
+        the ordered chunk digests.
+        """
+        file_size = os.path.getsize(filepath)
+        upload_id, sizer, parallelism, dedup, encoding = self._init_upload(init_data, file_size, filepath)
+        chunk_size = sizer.chunk_size
+        total_chunks = -(-file_size // chunk_size)
+
+        digests = {}
+        if total_chunks == 0:
+            return upload_id, None
+
+        # Chunks are sliced straight out of the page cache, no per-chunk buffers
+        with open(filepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                holes = self._hole_chunks(f.fileno(), file_size, chunk_size)
+                if holes:
+                    self._send_zero_ranges(upload_id, holes)
+                    for first, last in holes:
+                        for chunk_number in range(first, last + 1):
+                            size = min(chunk_size, file_size - chunk_number * chunk_size)
+                            digests[chunk_number] = zero_digest(size)
+                    logger.info(f"Upload {upload_id} sent {len(digests)} chunks in holes as zero ranges")
+
+                pending = [n for n in range(total_chunks) if n not in digests]
+                self._upload_chunks(view, upload_id, pending, digests, sizer, parallelism, dedup, encoding)
+
+                missing = self._missing_chunks(upload_id)
+                if missing:
+                    logger.warning(f"Upload {upload_id} is missing {len(missing)} chunks, resending them")
+                    self._upload_chunks(view, upload_id, missing, digests, sizer, parallelism, encoding=encoding)
+            finally:
+                view.release()
+
+        if self.adaptive:
+            logger.info(f"Upload {upload_id} settled on {sizer.request_size} bytes per request")
+        return upload_id, self._tree_checksum(digests, total_chunks)
+
+    def upload_stream(self, blocks, total_size, init_data, queue_depth=None):
+        """
+        Like upload, but the content comes from an iterable of byte blocks
+        of any size (e.g. a GeneratedStream) that must add up to total_size,
+        so nothing has to be on disk. The calling thread cuts the blocks into
+        requests and hands them through a bounded queue to the upload
+        threads, so producing the next request overlaps with sending the
+        previous ones while at most queue_depth (default: parallelism)
+        requests wait in memory.
+
+        A stream can't be read twice, so chunks the server still reports
+        missing at the end fail the upload instead of being resent.
+        """
+        upload_id, sizer, parallelism, dedup, encoding = self._init_upload(
+            init_data, total_size, init_data.get('filename', '')
+        )
+        chunk_size = sizer.chunk_size
+        total_chunks = -(-total_size // chunk_size)
+
+        digests = {}
+        if total_chunks == 0:
+            return upload_id, None
+
+        runs = queue.Queue(maxsize=queue_depth or parallelism)
+        failed = threading.Event()
+
+        def put(item):
+            while not failed.is_set():
+                try:
+                    runs.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def worker():
+            try:
+                while not failed.is_set():
+                    try:
+                        item = runs.get(timeout=0.5)
+                    except queue.Empty:
+                        continue
+                    if item is None:
+                        return
+                    first, data = item
+                    last = first + -(-len(data) // chunk_size) - 1
+                    with memoryview(data) as view:
+                        digests.update(self._upload_run(
+                            view, upload_id, range(first, last + 1), sizer, dedup, encoding, base=first
+                        ))
+            except Exception:
+                failed.set()
+                raise
+
+        def produce():
+            buffer = bytearray()
+            first = 0
+            received = 0
+            for block in blocks:
+                received += len(block)
+                if received > total_size:
+                    raise ChunkUploadError(f"Stream for upload {upload_id} is longer than {total_size} bytes")
+                buffer += block
+                # Cut as many whole requests as the sizer currently asks for
+                while True:
+                    cut = sizer.span * chunk_size
+                    if len(buffer) < cut:
+                        break
+                    if not put((first, buffer[:cut])):
+                        return
+                    del buffer[:cut]
+                    first += cut // chunk_size
+            if received != total_size:
+                raise ChunkUploadError(f"Stream for upload {upload_id} ended at {received} of {total_size} bytes")
+            if buffer and not put((first, buffer)):
+                return
+            for _ in range(parallelism):
+                if not put(None):
+                    return
+
+        with ThreadPoolExecutor(max_workers=parallelism) as executor:
+            futures = [executor.submit(worker) for _ in range(parallelism)]
+            try:
+                produce()
+            except Exception:
+                failed.set()
+                raise
+            # A failed upload thread stopped the producer, its error is raised here
+            for future in futures:
+                future.result()
+
+        missing = self._missing_chunks(upload_id)
+        if missing:
+            raise ChunkUploadError(f"Upload {upload_id} is missing {len(missing)} chunks that can't be resent from a stream")
+
+        if self.adaptive:
+            logger.info(f"Upload {upload_id} settled on {sizer.request_size} bytes per request")
+        return upload_id, self._tree_checksum(digests, total_chunks)
+
+    def finalize(self, upload_id, **upload_data):
+        """
+        Finalize an upload. The server makes a repeated finalize safe: it
+        answers 409 with Retry-After while an earlier one is still running,
+        and the stored record once that one completed. So a finalize that
+        timed out is resent, and a 409 is waited out up to finalize_timeout.
+        """
+        deadline = time.monotonic() + self.finalize_timeout
+        while True:
+            try:
+                response = self._send_with_retry(
+                    "POST",
+                    f"{self.api_url}/api/uploads/finalize",
+                    timeout=self.finalize_timeout,
+                    json={'upload_id': upload_id, **upload_data}
+                )
+                return response.json()
+            except requests.HTTPError as e:
+                retry_after = e.response.headers.get('Retry-After', '')
+                if e.response.status_code != 409 or not retry_after.isdigit() or time.monotonic() >= deadline:
+                    raise
+                logger.info(f"Upload {upload_id} is still being finalized, checking again in {retry_after}s")
+                time.sleep(min(int(retry_after), MAX_RETRY_AFTER))
+
+    def close(self):
+        self.session.close()
@@ -1,44 +1,150 @@
 import os
 import uuid
+import errno
 import json
-import aiofiles
-from typing import List, Dict
+import base64
+import binascii
+from typing import Dict, List, Optional
+from itertools import islice
+from contextlib import asynccontextmanager
 from pathlib import Path
 from datetime import datetime
 from logs.logger import logger
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from fastapi.concurrency import run_in_threadpool
 from models.file_info import FileInfo
-from fastapi import APIRouter, UploadFile, File, HTTPException, BackgroundTasks, Form, Body
+from services.file_ops import assemble_chunks, preallocate, commit_file, copy_chunk, write_zeros, directory_usage, write_file_object, stored_path, remove_upload_files
+from services.chunk_bitmap import ChunkBitmap
+from services.chunk_writer import write_stream, write_bytes, tree_digest, zero_digest, ChunkSizeError, DIGEST_ALGORITHM
+from services.session_store import create_session_store
+from services.file_index import create_file_index
+from services.metadata_writer import MetadataWriter
+from services.content_store import ContentStore
+from services.compression import get_decoder, supported_encodings, DecodeError
+from services.admission import AdmissionController, Overloaded
+from services.storage_manager import StorageManager, InsufficientStorage
+from services import metrics
+from fastapi import APIRouter, UploadFile, File, HTTPException, Form, Body, Query, Request, Header
 from pydantic import BaseModel
 
 upload_router = APIRouter()
 data_router = APIRouter()
 health_router = APIRouter()
+metrics_router = APIRouter()
 
 UPLOAD_DIR = Path("storage")
 ALLOWED_EXTENSIONS = {'.txt', '.pdf', '.doc', '.docx', '.csv', '.dat', '.mp4', '.wav'}
-BUFFER_SIZE = 100 
-file_info_buffer = []
-
-active_uploads: Dict[str, dict] = {}
+# "direct" preallocates the final file and pwrites chunks in place,
+# "chunks" spools each chunk to storage/temp/<upload_id>/ and assembles on finalize
+UPLOAD_MODE = os.getenv('UPLOAD_MODE', 'direct')
+UPLOAD_MODES = ("direct", "chunks")
+
+# Worker processes serving the API (uvicorn/gunicorn read WEB_CONCURRENCY too).
+# Each keeps its own copy of this module's state, so with several workers
+# sessions must be in SQLite and the file index picks up other workers'
+# records before listing
+WORKERS = int(os.getenv('WEB_CONCURRENCY', 1))
+
+# Sessions idle for longer than SESSION_TTL seconds are dropped with their temp files
+SESSION_TTL = int(os.getenv('SESSION_TTL', 24 * 60 * 60))
+SESSION_STORE = os.getenv('SESSION_STORE', 'sqlite')
+if WORKERS > 1 and SESSION_STORE == 'memory':
+    logger.warning(f"SESSION_STORE=memory can't be shared by {WORKERS} workers, using sqlite")
+    SESSION_STORE = 'sqlite'
+session_store = create_session_store(SESSION_STORE, UPLOAD_DIR / "sessions.db")
+# "jsonl" keeps the append-only storage/file_index.json, "sqlite" upserts into storage/file_index.db
+file_index = create_file_index(os.getenv('INDEX_BACKEND', 'jsonl'), UPLOAD_DIR, shared=WORKERS > 1)
+metadata_writer = MetadataWriter(
+    file_index,
+    batch_size=int(os.getenv('INDEX_BATCH_SIZE', 100)),
+    batch_window=float(os.getenv('INDEX_BATCH_WINDOW', 0.5)),
+    fsync=os.getenv('INDEX_FSYNC', 'interval'),
+    fsync_interval=float(os.getenv('INDEX_FSYNC_INTERVAL', 1.0))
+)
+# Identical files are stored once (hardlinked), and chunks whose digest is
+# already stored are copied server-side instead of being uploaded again
+DEDUP_ENABLED = os.getenv('DEDUP_ENABLED', '0') == '1'
+content_store = ContentStore(UPLOAD_DIR / "content.db", UPLOAD_DIR / "blobs")
+# Admission limits, 0 disables one. Over a per-client limit the API answers
+# 429, over a global one 503, both with a Retry-After header. In-flight bytes
+# are counted per worker, so each gets an equal share of the byte limits
+admission = AdmissionController(
+    session_store,
+    max_inflight_bytes=int(os.getenv('MAX_INFLIGHT_CHUNK_BYTES', 512 * 1024 * 1024)) // WORKERS,
+    max_inflight_bytes_per_client=int(os.getenv('MAX_INFLIGHT_CHUNK_BYTES_PER_CLIENT', 128 * 1024 * 1024)) // WORKERS,
+    max_sessions=int(os.getenv('MAX_ACTIVE_UPLOADS', 0)),
+    max_sessions_per_client=int(os.getenv('MAX_ACTIVE_UPLOADS_PER_CLIENT', 0)),
+    chunk_retry_after=int(os.getenv('CHUNK_RETRY_AFTER', 1)),
+    session_retry_after=int(os.getenv('UPLOAD_RETRY_AFTER', 10))
+)
+# Storage maintenance (see StorageManager), 0 disables a limit. /init answers
+# 507 when an upload would go over STORAGE_QUOTA_BYTES, the client's
+# CLIENT_STORAGE_QUOTA_BYTES or leave less than MIN_FREE_DISK_BYTES free.
+# With QUOTA_EVICTION=lru the least recently accessed files are deleted
+# until usage is back under QUOTA_LOW_WATERMARK of a quota that is exceeded.
+# Completed files older than RETENTION_MAX_AGE seconds are deleted
+STORAGE_QUOTA_BYTES = int(os.getenv('STORAGE_QUOTA_BYTES', 0))
+CLIENT_STORAGE_QUOTA_BYTES = int(os.getenv('CLIENT_STORAGE_QUOTA_BYTES', 0))
+MIN_FREE_DISK_BYTES = int(os.getenv('MIN_FREE_DISK_BYTES', 1024 * 1024 * 1024))
+RETENTION_MAX_AGE = int(os.getenv('RETENTION_MAX_AGE', 0))
+# Uploads initialized with chunk_size "auto" are cut into units of
+# CHUNK_UNIT_SIZE, doubled until a file has at most MAX_UNITS_PER_UPLOAD.
+# In direct mode one request may carry several consecutive units
+# (X-Chunk-Span), up to MAX_CHUNK_SIZE bytes
+CHUNK_UNIT_SIZE = int(os.getenv('CHUNK_UNIT_SIZE', 1024 * 1024))
+MAX_CHUNK_SIZE = int(os.getenv('MAX_CHUNK_SIZE', 64 * 1024 * 1024))
+MAX_UNITS_PER_UPLOAD = 16384
+# Parallelism /init recommends to an idle server's clients, halved under load
+UPLOAD_PARALLELISM = int(os.getenv('UPLOAD_PARALLELISM', 4))
+# Single-shot uploads are written in blocks of this size, aligned to the start of the file
+SINGLE_SHOT_WRITE_SIZE = 8 * 1024 * 1024
+MAX_PAGE_SIZE = 10000
+STREAM_PAGE_SIZE = 1000
 
 def is_valid_extension(filename: str) -> bool:
     return Path(filename).suffix.lower() in ALLOWED_EXTENSIONS
 
 
-async def flush_buffer():
-    global file_info_buffer
-    if file_info_buffer:
-        async with aiofiles.open(UPLOAD_DIR / "file_index.json", "a+", buffering=8192) as f:
-            await f.write("\n".join(file_info_buffer) + "\n")
-        file_info_buffer.clear()
+def save_record(record: dict):
+    file_index.update(record)
+    metadata_writer.submit(record)
+
+
+def save_file_info(file_info: FileInfo):
+    save_record(file_info.dict())
+
+
+storage_manager = StorageManager(
+    UPLOAD_DIR,
+    session_store,
+    file_index,
+    content_store,
+    save_record,
+    session_ttl=SESSION_TTL,
+    max_age=RETENTION_MAX_AGE,
+    quota=STORAGE_QUOTA_BYTES,
+    client_quota=CLIENT_STORAGE_QUOTA_BYTES,
+    min_free=MIN_FREE_DISK_BYTES,
+    eviction=os.getenv('QUOTA_EVICTION', 'lru'),
+    low_watermark=float(os.getenv('QUOTA_LOW_WATERMARK', 0.9))
+)
 
 
-async def save_file_info(file_info: FileInfo):
-    global file_info_buffer
-    file_info_buffer.append(json.dumps(file_info.dict()))
-    if len(file_info_buffer) >= BUFFER_SIZE:
-        await flush_buffer()
+def overload_error(e: Overloaded) -> HTTPException:
+    metrics.admission_rejections.inc(1, (e.status,))
+    return HTTPException(status_code=e.status, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+
+
+def insufficient_storage_error(e: InsufficientStorage) -> HTTPException:
+    metrics.admission_rejections.inc(1, (507,))
+    headers = {"Retry-After": str(e.retry_after)} if e.retry_after is not None else None
+    return HTTPException(status_code=507, detail=e.detail, headers=headers)
+
+
+def disk_full_error(size: Optional[int]) -> HTTPException:
+    return insufficient_storage_error(
+        InsufficientStorage(f"Not enough disk space for {size} bytes" if size is not None else "Not enough disk space")
+    )
 
 
 def get_optimal_chunk_size(file_size: int) -> int:
@@ -58,93 +164,283 @@ def get_optimal_chunk_size(file_size: int) -> int:
         return min(MAX_CHUNK, max(MIN_CHUNK, file_size // 500))
 
 
+def unit_chunk_size(total_size: int) -> int:
+    unit = CHUNK_UNIT_SIZE
+    while total_size > unit * MAX_UNITS_PER_UPLOAD and unit * 2 <= MAX_CHUNK_SIZE:
+        unit *= 2
+    return unit
+
+
+def max_request_size(chunk_size: int, mode: str) -> int:
+    """Largest chunk request body for an upload: whole units up to MAX_CHUNK_SIZE in direct mode."""
+    if mode != "direct":
+        return chunk_size
+    return chunk_size * max(1, MAX_CHUNK_SIZE // chunk_size)
+
+
+async def recommend_chunking(total_size: int, chunk_size: int, mode: str) -> dict:
+    """
+    Request size and parallelism a new upload should start with. The size
+    tiers of get_optimal_chunk_size are scaled down as the server gets
+    busier, so clients send smaller requests with fewer in flight and
+    admission limits are hit less often. The client adapts from there within
+    max_chunk_size, in whole multiples of chunk_size.
+    """
+    load = await admission.load()
+    recommended = get_optimal_chunk_size(total_size)
+    parallelism = UPLOAD_PARALLELISM
+    if load >= 0.8:
+        recommended, parallelism = chunk_size, 1
+    elif load >= 0.5:
+        recommended, parallelism = recommended // 2, max(1, parallelism // 2)
+
+    max_size = max_request_size(chunk_size, mode)
+    recommended = min(max_size, max(chunk_size, recommended // chunk_size * chunk_size))
+    requests_needed = -(-total_size // recommended)
+    return {
+        "chunk_size": chunk_size,
+        "recommended_chunk_size": recommended,
+        "max_chunk_size": max_size,
+        "parallelism": max(1, min(parallelism, requests_needed))
+    }
+
+
+def single_shot_defaults(client_id, timestamp, file_creation_time, creation_duration, start_time):
+    return (
+        client_id if client_id is not None else "default_client",
+        timestamp if timestamp is not None else start_time.strftime("%Y%m%d_%H%M%S"),
+        file_creation_time if file_creation_time is not None else start_time.strftime("%Y-%m-%d %H:%M:%S"),
+        creation_duration if creation_duration is not None else 0.0
+    )
+
+
+def require_allowed_extension(filename: str):
+    if not is_valid_extension(filename):
+        logger.error(f"Invalid file extension: {filename}")
+        raise HTTPException(
+            status_code=400,
+            detail=f"File type not allowed. Allowed types: {ALLOWED_EXTENSIONS}"
+        )
+
+
+async def save_stored_file(file_info: FileInfo):
+    """
+    Save the record of a file committed to storage. Records are keyed by
+    file ID, so earlier uploads of the same filename stay listed next to it.
+    With several workers the record is written before answering, so a
+    listing served by any of them right after includes the file.
+    """
+    save_file_info(file_info)
+    if file_index.shared:
+        await metadata_writer.flush()
+
+
+async def save_single_shot(file_id: str, safe_filename: str, file_path: Path, size: int, start_time: datetime,
+                           file_creation_time: str, creation_duration: float, client_id: str,
+                           checksum: Optional[str] = None) -> JSONResponse:
+    upload_duration = (datetime.now() - start_time).total_seconds()
+    file_info = FileInfo(
+        file_id=file_id,
+        filename=safe_filename,
+        size=size,
+        storage_location=str(file_path),
+        upload_date=start_time.strftime("%Y-%m-%d %H:%M:%S"),
+        upload_duration=round(upload_duration, 2),
+        file_creation_time=file_creation_time,
+        creation_duration=creation_duration,
+        client_id=client_id,
+        checksum=checksum
+    )
+
+    await save_stored_file(file_info)
+    metrics.bytes_received.inc(size)
+
+    return JSONResponse(
+        status_code=201,
+        content={"message": "File uploaded successfully", "file_info": file_info.dict()}
+    )
+
+
 @upload_router.post("/")
 async def upload_file(
     file: UploadFile = File(...),
     client_id: str = Form(None),
     timestamp: str = Form(None),
     file_creation_time: str = Form(None),
-    creation_duration: float = Form(None),
-    background_tasks: BackgroundTasks = None
+    creation_duration: float = Form(None)
 ):
+    """
+    Multipart single-shot upload. The body has already been spooled by the
+    multipart parser, so it is copied into a part file by one threadpool job
+    in large block-aligned writes and renamed into place. PUT
+    /files/{filename} skips the spooling. Like /init, answers 507 when the
+    file would go over a storage quota or doesn't fit on disk.
+    """
     try:
         start_time = datetime.now()
-        
-        if timestamp is None:
-            timestamp = start_time.strftime("%Y%m%d_%H%M%S")
-        if client_id is None:
-            client_id = "default_client"
-        if file_creation_time is None:
-            file_creation_time = start_time.strftime("%Y-%m-%d %H:%M:%S")
-        if creation_duration is None:
-            creation_duration = 0.0
-
-        if not is_valid_extension(file.filename):
-            logger.error(f"Invalid file extension: {file.filename}")
-            raise HTTPException(
-                status_code=400,
-                detail=f"File type not allowed. Allowed types: {ALLOWED_EXTENSIONS}"
-            )
-
+        client_id, timestamp, file_creation_time, creation_duration = single_shot_defaults(
+            client_id, timestamp, file_creation_time, creation_duration, start_time
+        )
+        require_allowed_extension(file.filename)
         try:
-            file_size = file.size  
-        except AttributeError:
-            file_size = 0  
-            logger.warning("Could not determine file size, using default chunk size")
-
-        chunk_size = get_optimal_chunk_size(file_size)
-        
+            await storage_manager.check_space(client_id, file.size or 0)
+        except InsufficientStorage as e:
+            raise insufficient_storage_error(e)
 
         safe_filename = f"{timestamp}_{file.filename}"
-        file_path = UPLOAD_DIR / safe_filename
-
-        async with aiofiles.open(file_path, 'wb', buffering=8192) as f:
-            while chunk := await file.read(chunk_size):
-                await f.write(chunk)
-
-        upload_duration = (datetime.now() - start_time).total_seconds()
-
-        file_info = FileInfo(
-            filename=safe_filename,
-            size=file_path.stat().st_size,
-            storage_location=str(file_path),
-            upload_date=start_time.strftime("%Y-%m-%d %H:%M:%S"),
-            upload_duration=round(upload_duration, 2),
-            file_creation_time=file_creation_time,
-            creation_duration=creation_duration
-        )
-
-        background_tasks.add_task(save_file_info, file_info)
-        background_tasks.add_task(flush_buffer) 
-
-        return JSONResponse(
-            status_code=201,
-            content={"message": "File uploaded successfully", "file_info": file_info.dict()}
+        file_id = uuid.uuid4().hex
+        file_path = stored_path(UPLOAD_DIR, file_id, safe_filename)
+        part_path = UPLOAD_DIR / "temp" / f"{file_id}.part"
+        committed = False
+        try:
+            await run_in_threadpool(write_file_object, file.file, part_path, file.size, SINGLE_SHOT_WRITE_SIZE)
+            size = await run_in_threadpool(commit_file, part_path, file_path)
+            committed = True
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                raise disk_full_error(file.size)
+            raise
+        finally:
+            if not committed:
+                await run_in_threadpool(part_path.unlink, missing_ok=True)
+
+        return await save_single_shot(
+            file_id, safe_filename, file_path, size, start_time, file_creation_time, creation_duration, client_id
         )
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Upload failed: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@upload_router.put("/files/{filename}")
+async def put_file(
+    filename: str,
+    request: Request,
+    client_id: Optional[str] = None,
+    timestamp: Optional[str] = None,
+    file_creation_time: Optional[str] = None,
+    creation_duration: Optional[float] = None,
+    content_length: Optional[int] = Header(None)
+):
+    """
+    Raw single-shot upload: the request body is the file, with the metadata
+    of POST / as query parameters. The body is streamed into a part file,
+    preallocated from Content-Length, in large block-aligned writes and
+    hashed on the way, then synced and renamed into place. The file's
+    checksum is reported as "sha256:<hex>". Like /init, answers 507 when
+    the file would go over a storage quota or doesn't fit on disk.
+    """
+    start_time = datetime.now()
+    client_id, timestamp, file_creation_time, creation_duration = single_shot_defaults(
+        client_id, timestamp, file_creation_time, creation_duration, start_time
+    )
+    require_allowed_extension(filename)
+    try:
+        await storage_manager.check_space(client_id, content_length or 0)
+    except InsufficientStorage as e:
+        raise insufficient_storage_error(e)
+
+    safe_filename = f"{timestamp}_{filename}"
+    file_id = uuid.uuid4().hex
+    file_path = stored_path(UPLOAD_DIR, file_id, safe_filename)
+    part_path = UPLOAD_DIR / "temp" / f"{file_id}.part"
+    committed = False
+    try:
+        await run_in_threadpool(preallocate, part_path, content_length or 0)
+        written, (digest,) = await write_stream(
+            request.stream(), part_path, max_size=content_length, buffer_size=SINGLE_SHOT_WRITE_SIZE
+        )
+        if content_length is not None and written != content_length:
+            raise HTTPException(status_code=400, detail=f"Expected {content_length} bytes, got {written}")
+        size = await run_in_threadpool(commit_file, part_path, file_path)
+        committed = True
+    except ChunkSizeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            raise disk_full_error(content_length)
+        raise
+    finally:
+        if not committed:
+            await run_in_threadpool(part_path.unlink, missing_ok=True)
+
+    return await save_single_shot(
+        file_id, safe_filename, file_path, size, start_time, file_creation_time, creation_duration, client_id,
+        checksum=f"{DIGEST_ALGORITHM}:{digest}"
+    )
+
+
+def encode_cursor(key) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    # Only an (upload_date, file_id) key as encode_cursor() writes it
+    if not isinstance(key, list) or len(key) != 2 or not all(isinstance(part, str) for part in key):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    upload_date, file_id = key
+    return upload_date, file_id
+
+
 @data_router.get("/", response_model=List[FileInfo])
-async def list_files():
+async def list_files(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    client_id: Optional[str] = None,
+    status: Optional[str] = None,
+    min_size: Optional[int] = Query(None, ge=0),
+    max_size: Optional[int] = Query(None, ge=0),
+    uploaded_after: Optional[str] = None,
+    uploaded_before: Optional[str] = None,
+    format: str = Query("json", regex="^(json|ndjson)$")
+):
+    """
+    Files ordered by upload date. With `limit`, the key of the next page is
+    returned in the X-Next-Cursor header and passed back as `cursor`.
+    `format=ndjson` streams one record per line, page by page.
+    """
+    after = decode_cursor(cursor) if cursor else None
+    filters = {
+        'client_id': client_id,
+        'status': status,
+        'min_size': min_size,
+        'max_size': max_size,
+        'uploaded_after': uploaded_after,
+        'uploaded_before': uploaded_before
+    }
+
     try:
-        files = []
-        index_path = UPLOAD_DIR / "file_index.json"
-        
-        if index_path.exists():
-            async with aiofiles.open(index_path, "r", buffering=8192) as f:
-                async for line in f:
-                    if line.strip():
-                        file_info = json.loads(line)
-                        # If there's a newer version of the same file, skip the older one
-                        if not any(f['filename'] == file_info['filename'] and 
-                                 f['upload_date'] > file_info['upload_date'] for f in files):
-                            files = [f for f in files if f['filename'] != file_info['filename']]
-                            files.append(file_info)
-        
-        return files
+        await file_index.refresh()
+        if format == "ndjson":
+            # One scan for the whole stream, so each page resumes where the
+            # last one stopped instead of searching the index again
+            scan = file_index.scan(after, **filters)
+
+            async def stream_records():
+                remaining = limit
+                while remaining is None or remaining > 0:
+                    page_size = STREAM_PAGE_SIZE if remaining is None else min(remaining, STREAM_PAGE_SIZE)
+                    records = list(islice(scan, page_size))
+                    if records:
+                        yield "".join(json.dumps(record) + "\n" for record in records)
+                    if len(records) < page_size:
+                        break
+                    if remaining is not None:
+                        remaining -= len(records)
+
+            return StreamingResponse(stream_records(), media_type="application/x-ndjson")
+
+        records, next_key = file_index.query(limit=limit, after=after, **filters)
+        headers = {"X-Next-Cursor": encode_cursor(next_key)} if next_key else None
+        # Records were validated as FileInfo when saved, skip response_model re-validation
+        return JSONResponse(content=records, headers=headers)
 
     except Exception as e:
         logger.error(f"Failed to list files: {str(e)}")
@@ -152,15 +448,54 @@ async def list_files():
 
 
 @upload_router.post("/init")
-async def initialize_upload(upload_info: dict = Body(...), background_tasks: BackgroundTasks = None):
+async def initialize_upload(upload_info: dict = Body(...)):
+    mode = upload_info.get('mode', UPLOAD_MODE)
+    if mode not in UPLOAD_MODES:
+        raise HTTPException(status_code=400, detail=f"Invalid mode, expected one of {list(UPLOAD_MODES)}")
+    chunk_size = upload_info.get('chunk_size')
+    if chunk_size is not None and chunk_size != "auto" and \
+            (not isinstance(chunk_size, int) or isinstance(chunk_size, bool) or chunk_size <= 0):
+        raise HTTPException(status_code=400, detail="Invalid chunk_size, expected a positive integer or \"auto\"")
+
+    try:
+        await admission.admit_session(upload_info['client_id'])
+        await storage_manager.check_space(upload_info['client_id'], upload_info['total_size'])
+    except Overloaded as e:
+        raise overload_error(e)
+    except InsufficientStorage as e:
+        raise insufficient_storage_error(e)
+
     upload_id = str(uuid.uuid4())
     temp_dir = UPLOAD_DIR / "temp" / upload_id
-    os.makedirs(temp_dir, exist_ok=True)
+    if chunk_size == "auto":
+        chunk_size = unit_chunk_size(upload_info['total_size'])
+
+    if mode == "direct" and not chunk_size:
+        logger.warning(f"Upload {upload_id} did not send chunk_size, falling back to chunks mode")
+        mode = "chunks"
+
+    if mode == "direct":
+        await run_in_threadpool(os.makedirs, temp_dir.parent, exist_ok=True)
+        part_path = temp_dir.parent / f"{upload_id}.part"
+        try:
+            await run_in_threadpool(preallocate, part_path, upload_info['total_size'])
+        except OSError as e:
+            await run_in_threadpool(part_path.unlink, missing_ok=True)
+            if e.errno == errno.ENOSPC:
+                raise disk_full_error(upload_info['total_size'])
+            raise
+    else:
+        part_path = None
+        await run_in_threadpool(os.makedirs, temp_dir, exist_ok=True)
+
+    total_chunks = -(-upload_info['total_size'] // chunk_size) if chunk_size else None
     
+    file_id = uuid.UUID(upload_id).hex
     file_info = FileInfo(
+        file_id=file_id,
         filename=upload_info['filename'],
         size=upload_info['total_size'],
-        storage_location=str(UPLOAD_DIR / upload_info['filename']),
+        storage_location=str(stored_path(UPLOAD_DIR, file_id, upload_info['filename'])),
         upload_date=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         upload_duration=0.0,
         file_creation_time=upload_info['file_creation_time'],
@@ -168,83 +503,461 @@ async def initialize_upload(upload_info: dict = Body(...), background_tasks: Bac
         status="pending"
     )
     
-    active_uploads[upload_id] = {
+    session = {
+        'upload_id': upload_id,
+        'file_id': file_id,
         'filename': upload_info['filename'],
         'total_size': upload_info['total_size'],
-        'chunks_received': 0,
+        'received': ChunkBitmap(total_chunks),
+        'mode': mode,
+        'chunk_size': chunk_size,
         'temp_dir': temp_dir,
+        'part_path': part_path,
         'client_id': upload_info['client_id'],
         'timestamp': upload_info['timestamp'],
         'file_creation_time': upload_info['file_creation_time'],
-        'file_info': file_info
+        'upload_date': file_info.upload_date
+    }
+    try:
+        await admission.open_session(upload_id, session)
+    except Overloaded as e:
+        await run_in_threadpool(remove_upload_files, temp_dir, part_path)
+        raise overload_error(e)
+
+    save_file_info(file_info)
+
+    chunking = await recommend_chunking(upload_info['total_size'], chunk_size, mode) if chunk_size else {}
+    return {
+        "upload_id": upload_id,
+        "mode": mode,
+        "dedup": DEDUP_ENABLED,
+        "encodings": supported_encodings(),
+        **chunking
     }
-    
 
-    background_tasks.add_task(save_file_info, file_info)
-    background_tasks.add_task(flush_buffer)
-    
-    return {"upload_id": upload_id}
+
+def resolve_chunk(upload_info: dict, chunk_number: int):
+    """
+    Where a chunk goes for this upload: (path, offset, expected_size).
+    expected_size is None when the client never declared a chunk size.
+    """
+    chunk_size = upload_info['chunk_size']
+    total_chunks = upload_info['received'].total_chunks
+    if chunk_number < 0 or (total_chunks is not None and chunk_number >= total_chunks):
+        raise HTTPException(status_code=400, detail=f"Invalid chunk number {chunk_number}")
+
+    expected_size = None
+    if chunk_size:
+        expected_size = min(chunk_size, upload_info['total_size'] - chunk_number * chunk_size)
+
+    if upload_info['mode'] == "direct":
+        return upload_info['part_path'], chunk_number * chunk_size, expected_size
+    return upload_info['temp_dir'] / f"chunk_{chunk_number}", 0, expected_size
+
+
+def parse_digest(value: str) -> str:
+    """Hex value of a client digest sent as "sha256=<hex>" or bare hex."""
+    algorithm, _, digest = value.rpartition("=")
+    if algorithm and algorithm.lower() != DIGEST_ALGORITHM:
+        raise HTTPException(status_code=400, detail=f"Unsupported digest algorithm {algorithm}, use {DIGEST_ALGORITHM}")
+    return digest.lower()
+
+
+def verify_digest(chunk_number: int, expected: Optional[str], actual: str):
+    """Check a client digest against the written data."""
+    if expected is not None and parse_digest(expected) != actual:
+        raise HTTPException(status_code=422, detail=f"Chunk {chunk_number} digest mismatch")
+
+
+@asynccontextmanager
+async def overwrites_chunks(upload_id: str, chunk_numbers: List[int]):
+    """
+    Wrap writing chunks in place. If the block fails (bad digest, wrong
+    size, broken body) the bytes of these chunks may already be overwritten,
+    so they are marked missing again, even if an earlier copy was accepted.
+    """
+    try:
+        yield
+    except Exception:
+        await session_store.unmark_chunks(upload_id, chunk_numbers)
+        raise
 
 
 @upload_router.post("/chunk")
 async def upload_chunk(
     chunk: bytes = File(...),
     chunk_number: int = Form(...),
-    upload_id: str = Form(...)
+    upload_id: str = Form(...),
+    chunk_digest: str = Form(None)
 ):
-    if upload_id not in active_uploads:
+    upload_info = await session_store.get(upload_id)
+    if upload_info is None:
+        raise HTTPException(status_code=400, detail="Invalid upload ID")
+    path, offset, expected_size = resolve_chunk(upload_info, chunk_number)
+    if expected_size is not None and len(chunk) != expected_size:
+        raise HTTPException(status_code=400, detail=f"Chunk {chunk_number} must be {expected_size} bytes")
+
+    metrics.chunks_in_flight.inc()
+    try:
+        with admission.chunk(upload_info['client_id'], len(chunk)):
+            async with overwrites_chunks(upload_id, [chunk_number]):
+                digest = await run_in_threadpool(write_bytes, path, chunk, offset, upload_info['mode'] != "direct")
+                metrics.bytes_received.inc(len(chunk))
+                verify_digest(chunk_number, chunk_digest, digest)
+    except Overloaded as e:
+        raise overload_error(e)
+    finally:
+        metrics.chunks_in_flight.dec()
+    if not await session_store.mark_chunk(upload_id, chunk_number, digest):
         raise HTTPException(status_code=400, detail="Invalid upload ID")
-    upload_info = active_uploads[upload_id]
-    chunk_path = upload_info['temp_dir'] / f"chunk_{chunk_number}"
-    async with aiofiles.open(chunk_path, 'wb') as f:
-        await f.write(chunk)
-    upload_info['chunks_received'] += 1
+    metrics.chunks_stored.inc(1, ("upload",))
     return {"status": "success"}
 
 
+@upload_router.put("/{upload_id}/chunks/{chunk_number}")
+async def put_chunk(
+    upload_id: str,
+    chunk_number: int,
+    request: Request,
+    x_chunk_digest: Optional[str] = Header(None),
+    x_chunk_span: int = Header(1),
+    content_encoding: Optional[str] = Header(None)
+):
+    """
+    Raw application/octet-stream chunk upload. The body is streamed straight
+    into the target file (or chunk file) without multipart parsing, and
+    hashed as it is written. An X-Chunk-Digest header is verified against it.
+    A Content-Encoding listed in the /init response is decompressed on the
+    way to disk; size and digest refer to the decompressed bytes.
+
+    In direct mode X-Chunk-Span: k sends chunks chunk_number .. chunk_number
+    + k - 1 in one body of at most max_chunk_size bytes. Each chunk is still
+    hashed and recorded on its own, and X-Chunk-Digest then lists the k
+    digests separated by commas.
+    """
+    upload_info = await session_store.get(upload_id)
+    if upload_info is None:
+        raise HTTPException(status_code=404, detail="Invalid upload ID")
+    path, offset, expected_size = resolve_chunk(upload_info, chunk_number)
+    if x_chunk_span != 1:
+        chunk_size = upload_info['chunk_size']
+        if x_chunk_span < 1 or upload_info['mode'] != "direct" or not chunk_size:
+            raise HTTPException(status_code=400, detail="X-Chunk-Span needs a direct mode upload with a chunk_size")
+        _, end_offset, end_size = resolve_chunk(upload_info, chunk_number + x_chunk_span - 1)
+        expected_size = end_offset + end_size - offset
+        if expected_size > max_request_size(chunk_size, "direct"):
+            raise HTTPException(
+                status_code=413,
+                detail=f"Chunk span is larger than {max_request_size(chunk_size, 'direct')} bytes"
+            )
+
+    decoder = None
+    if content_encoding and content_encoding.strip().lower() != "identity":
+        try:
+            decoder = get_decoder(content_encoding)
+        except KeyError:
+            raise HTTPException(
+                status_code=415,
+                detail=f"Unsupported Content-Encoding {content_encoding}, use one of {supported_encodings()}"
+            )
+
+    content_length = request.headers.get('content-length')
+    if content_length is not None and not content_length.strip().isdigit():
+        raise HTTPException(status_code=400, detail="Invalid Content-Length")
+
+    max_size = expected_size
+    if max_size is None:
+        # Without a declared chunk size a chunk is still no larger than the
+        # upload, and what a small compressed body can expand to is bounded too
+        max_size = upload_info['total_size'] if decoder is None else min(MAX_CHUNK_SIZE, upload_info['total_size'])
+
+    # Reserve before reading the body, so a rejected chunk costs no memory or
+    # disk. Without a chunk size, that is the body's length when it is sent
+    # uncompressed with one, and otherwise the most it may hold
+    if expected_size is not None:
+        reserve = expected_size
+    elif decoder is None and content_length is not None:
+        reserve = min(int(content_length), max_size)
+    else:
+        reserve = max_size
+    metrics.chunks_in_flight.inc()
+    try:
+        with admission.chunk(upload_info['client_id'], reserve):
+            async with overwrites_chunks(upload_id, list(range(chunk_number, chunk_number + x_chunk_span))):
+                written, digests = await write_stream(
+                    request.stream(),
+                    path,
+                    offset=offset,
+                    max_size=max_size,
+                    truncate=upload_info['mode'] != "direct",
+                    decoder=decoder,
+                    unit_size=upload_info['chunk_size']
+                )
+                metrics.bytes_received.inc(written)
+
+                if expected_size is not None and written != expected_size:
+                    raise HTTPException(
+                        status_code=400, detail=f"Chunk {chunk_number} must be {expected_size} bytes, got {written}"
+                    )
+                expected_digests = x_chunk_digest.split(",") if x_chunk_digest else [None] * len(digests)
+                if len(expected_digests) != len(digests):
+                    raise HTTPException(status_code=400, detail=f"X-Chunk-Digest must list {len(digests)} digests")
+                for n, (expected, digest) in enumerate(zip(expected_digests, digests)):
+                    verify_digest(chunk_number + n, expected, digest)
+    except Overloaded as e:
+        raise overload_error(e)
+    except ChunkSizeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except DecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Chunk {chunk_number}: {str(e)}")
+    finally:
+        metrics.chunks_in_flight.dec()
+
+    if not await session_store.mark_chunks(upload_id, {chunk_number + n: d for n, d in enumerate(digests)}):
+        raise HTTPException(status_code=404, detail="Invalid upload ID")
+    metrics.chunks_stored.inc(len(digests), ("upload",))
+    return {
+        "status": "success",
+        "chunk_number": chunk_number,
+        "span": len(digests),
+        "size": written,
+        "digest": digests[0],
+        "digests": digests
+    }
+
+
+def write_zero_chunks(upload_info: dict, ranges: List[List[int]]) -> Dict[int, str]:
+    """
+    Materialize inclusive chunk ranges as zeros, punched as holes in the
+    part file or written as sparse chunk files. Returns their digests.
+    """
+    digests = {}
+    for start, end in ranges:
+        if upload_info['mode'] == "direct":
+            # One contiguous span of the part file per range
+            path, offset, _ = resolve_chunk(upload_info, start)
+            _, end_offset, end_size = resolve_chunk(upload_info, end)
+            write_zeros(path, offset, end_offset + end_size - offset)
+        for chunk_number in range(start, end + 1):
+            path, offset, size = resolve_chunk(upload_info, chunk_number)
+            if upload_info['mode'] != "direct":
+                write_zeros(path, offset, size, truncate=True)
+            digests[chunk_number] = zero_digest(size)
+    return digests
+
+
+@upload_router.post("/{upload_id}/zero-ranges")
+async def upload_zero_ranges(upload_id: str, body: dict = Body(...)):
+    """
+    Mark chunks as all zeros without sending their bytes. The body lists
+    inclusive chunk ranges, e.g. {"chunks": [[0, 3], [9, 9]]}, the same
+    shape the status endpoint uses for missing chunks.
+    """
+    upload_info = await session_store.get(upload_id)
+    if upload_info is None:
+        raise HTTPException(status_code=404, detail="Invalid upload ID")
+    if not upload_info['chunk_size']:
+        raise HTTPException(status_code=400, detail="Zero ranges need a chunk_size declared at init")
+    try:
+        ranges = [(int(start), int(end)) for start, end in body['chunks']]
+    except (KeyError, TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Expected {\"chunks\": [[start, end], ...]}")
+    for start, end in ranges:
+        if start > end:
+            raise HTTPException(status_code=400, detail="Chunk ranges must have start <= end")
+        resolve_chunk(upload_info, start)
+        resolve_chunk(upload_info, end)
+
+    digests = await run_in_threadpool(write_zero_chunks, upload_info, ranges)
+    if not await session_store.mark_chunks(upload_id, digests):
+        raise HTTPException(status_code=404, detail="Invalid upload ID")
+    metrics.chunks_stored.inc(len(digests), ("zero",))
+    return {"status": "success", "chunks": len(digests)}
+
+
+@upload_router.post("/{upload_id}/chunks/{chunk_number}/dedup")
+async def dedup_chunk(upload_id: str, chunk_number: int, x_chunk_digest: str = Header(...)):
+    """
+    Offer a chunk by digest before sending it. If the same bytes were already
+    received for this upload or are stored in a completed file, they are
+    copied server-side, the chunk is marked received and `deduplicated` is
+    true. Otherwise the client uploads the chunk as usual.
+    """
+    upload_info = await session_store.get(upload_id)
+    if upload_info is None:
+        raise HTTPException(status_code=404, detail="Invalid upload ID")
+    path, offset, expected_size = resolve_chunk(upload_info, chunk_number)
+    digest = parse_digest(x_chunk_digest)
+    if not DEDUP_ENABLED or expected_size is None:
+        return {"deduplicated": False}
+
+    same_upload_chunk = await session_store.find_chunk(upload_id, digest)
+    if same_upload_chunk == chunk_number:
+        return {"deduplicated": True}
+    if same_upload_chunk is not None:
+        source = resolve_chunk(upload_info, same_upload_chunk)
+    else:
+        source = await content_store.lookup_chunk(digest)
+    if source is None or source[2] != expected_size:
+        return {"deduplicated": False}
+
+    src_path, src_offset, _ = source
+    try:
+        await run_in_threadpool(
+            copy_chunk, src_path, src_offset, expected_size, path, offset, upload_info['mode'] != "direct"
+        )
+    except FileNotFoundError:
+        # The source went away between lookup and copy, let the client send it
+        return {"deduplicated": False}
+    if not await session_store.mark_chunk(upload_id, chunk_number, digest):
+        raise HTTPException(status_code=404, detail="Invalid upload ID")
+    metrics.chunks_stored.inc(1, ("dedup",))
+    return {"deduplicated": True}
+
+
+@upload_router.get("/{upload_id}/status")
+async def upload_status(upload_id: str):
+    upload_info = await session_store.get(upload_id)
+    if upload_info is None:
+        raise HTTPException(status_code=404, detail="Invalid upload ID")
+    received = upload_info['received']
+    return {
+        "upload_id": upload_id,
+        "mode": upload_info['mode'],
+        "chunk_size": upload_info['chunk_size'],
+        "total_chunks": received.total_chunks,
+        "chunks_received": received.count,
+        "missing": received.missing_ranges(),
+        "complete": received.is_complete()
+    }
+
+
+
+def finalized_response(file_info: dict) -> JSONResponse:
+    return JSONResponse(
+        status_code=201,
+        content={"message": "File uploaded successfully", "file_info": json.dumps(file_info)}
+    )
+
+
+async def finalized_upload(upload_id: str) -> JSONResponse:
+    """
+    Answer a finalize of an upload whose session is gone with its stored
+    record, as the first finalize did, or 400 if it was never completed.
+    """
+    try:
+        file_id = uuid.UUID(upload_id).hex
+    except (ValueError, TypeError, AttributeError):
+        raise HTTPException(status_code=400, detail="Invalid upload ID")
+    await file_index.refresh()
+    record = file_index.get(file_id)
+    if record is None or record['status'] != "completed":
+        raise HTTPException(status_code=400, detail="Invalid upload ID")
+    return finalized_response(record)
+
 
 @upload_router.post("/finalize")
 async def finalize_upload(
-    upload_data: dict = Body(...),
-    background_tasks: BackgroundTasks = None
+    upload_data: dict = Body(...)
 ):
+    """
+    Assemble or commit a complete upload. The session is claimed first, so
+    a repeated or retried finalize gets 409 while one is in progress and
+    the stored record once it has completed.
+    """
     upload_id = upload_data['upload_id']
-    if upload_id not in active_uploads:
-        raise HTTPException(status_code=400, detail="Invalid upload ID")
-    
-    upload_info = active_uploads[upload_id]
-    final_path = UPLOAD_DIR / upload_info['filename']
+    upload_info = await session_store.get(upload_id)
+    if upload_info is None:
+        return await finalized_upload(upload_id)
     
-    async with aiofiles.open(final_path, 'wb') as final_file:
-        chunk_files = sorted(upload_info['temp_dir'].glob("chunk_*"))
-        for chunk_path in chunk_files:
-            async with aiofiles.open(chunk_path, 'rb') as chunk_file:
-                await final_file.write(await chunk_file.read())
-            os.remove(chunk_path) 
-    
-    os.rmdir(upload_info['temp_dir'])
+    final_path = stored_path(UPLOAD_DIR, uuid.UUID(upload_id).hex, upload_info['filename'])
+    received = upload_info['received']
+
+    if not received.is_complete():
+        raise HTTPException(
+            status_code=409,
+            detail={"message": "Upload is missing chunks", "missing": received.missing_ranges()}
+        )
+
+    digests = await session_store.get_digests(upload_id)
+    expected_chunks = received.expected_chunks()
+    checksum = None
+    if len(digests) == expected_chunks:
+        checksum = tree_digest([digests[n] for n in range(expected_chunks)])
+    if upload_data.get('checksum') and upload_data['checksum'] != checksum:
+        raise HTTPException(
+            status_code=422,
+            detail={"message": "File checksum mismatch", "checksum": checksum}
+        )
+
+    claimed = await session_store.claim_finalize(upload_id)
+    if claimed is None:
+        return await finalized_upload(upload_id)
+    if not claimed:
+        raise HTTPException(status_code=409, detail="Upload is already being finalized", headers={"Retry-After": "1"})
+    try:
+        return await finalize_claimed(upload_id, upload_info, upload_data, checksum, digests, final_path)
+    except Exception:
+        await session_store.release_finalize(upload_id)
+        raise
+
+
+async def finalize_claimed(upload_id: str, upload_info: dict, upload_data: dict, checksum: Optional[str],
+                           digests: Dict[int, str], final_path: Path) -> JSONResponse:
+    expected_chunks = upload_info['received'].expected_chunks()
+    try:
+        with metrics.finalize_duration.time((upload_info['mode'],)):
+            if upload_info['mode'] == "direct":
+                final_size = await run_in_threadpool(commit_file, upload_info['part_path'], final_path)
+            else:
+                # Assembled next to the chunks, then renamed into place like a direct upload
+                part_path = UPLOAD_DIR / "temp" / f"{upload_id}.part"
+                await run_in_threadpool(assemble_chunks, upload_info['temp_dir'], expected_chunks, part_path)
+                final_size = await run_in_threadpool(commit_file, part_path, final_path)
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            raise disk_full_error(upload_info['total_size'])
+        raise
+    # Chunks are only removed once the file is committed, so a failed finalize can be retried
+    await run_in_threadpool(remove_upload_files, upload_info['temp_dir'], None)
+
+    if DEDUP_ENABLED and checksum is not None:
+        try:
+            if await content_store.store_file(
+                final_path, checksum, upload_info['chunk_size'], [digests[n] for n in range(expected_chunks)]
+            ):
+                logger.info(f"Upload {upload_id} duplicates stored content, linked {final_path} to it")
+        except Exception as e:
+            logger.error(f"Failed to register {final_path} in the content store: {str(e)}")
     
     file_info = FileInfo(
+        file_id=upload_info.get('file_id'),
         filename=upload_info['filename'],
-        size=os.path.getsize(final_path),
+        size=final_size,
         storage_location=str(final_path),
-        upload_date=upload_info['file_info'].upload_date,  
+        upload_date=upload_info['upload_date'],
         upload_duration=upload_data.get('upload_duration', 0),
         file_creation_time=upload_info['file_creation_time'],
         client_id=upload_info['client_id'],
-        status="completed"
+        status="completed",
+        checksum=checksum
     )
     
-    background_tasks.add_task(save_file_info, file_info)
-    background_tasks.add_task(flush_buffer)
+    await save_stored_file(file_info)
     
-    del active_uploads[upload_id]
+    await session_store.delete(upload_id)
     
-    return JSONResponse(
-        status_code=201,
-        content={"message": "File uploaded successfully", "file_info": json.dumps(file_info.dict())}
-    )
+    return finalized_response(file_info.dict())
+
+
 
+@metrics_router.get("")
+async def get_metrics():
+    """Prometheus text exposition of this worker's metrics."""
+    metrics.uploads_active.set(await session_store.count())
+    metrics.temp_disk_usage.set(await run_in_threadpool(directory_usage, UPLOAD_DIR / "temp"))
+    metrics.stored_bytes.set(file_index.stored_bytes())
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
 
 
 @health_router.get("")
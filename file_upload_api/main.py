@@ -1,27 +1,46 @@
+import os
+import socket
 import uvicorn
+from uvicorn.supervisors import Multiprocess
 from pathlib import Path
 from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
 from contextlib import asynccontextmanager
 from logs.logger import logger
 from fastapi.middleware.cors import CORSMiddleware
-from api.api import upload_router, data_router, health_router
+from services.metrics import MetricsMiddleware
+from api.api import upload_router, data_router, health_router, metrics_router, session_store, file_index, metadata_writer, storage_manager, WORKERS
 
 
 UPLOAD_DIR = Path("storage")
+# Seconds between storage maintenance passes (SESSION_CLEANUP_INTERVAL is the older name)
+MAINTENANCE_INTERVAL = int(os.getenv('MAINTENANCE_INTERVAL', os.getenv('SESSION_CLEANUP_INTERVAL', 10 * 60)))
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """
     Lifecycle manager for the FastAPI application.
-    Creates necessary directories and performs startup checks.
+    Creates necessary directories, loads the file index and runs the
+    metadata writer and storage maintenance (expired sessions, orphaned
+    temp files, retention and quotas) for the lifetime of the app. The
+    writer is drained on shutdown so no records are lost.
     """
-    UPLOAD_DIR.mkdir(exist_ok=True)
+    for directory in (UPLOAD_DIR, UPLOAD_DIR / "temp", UPLOAD_DIR / "files"):
+        await run_in_threadpool(directory.mkdir, exist_ok=True)
     logger.info("Storage directory initialized")
+    indexed = await file_index.load()
+    logger.info(f"File index loaded with {indexed} files")
+    await metadata_writer.start()
+    await storage_manager.start(MAINTENANCE_INTERVAL)
     
     yield
     
     logger.info("Shutting down application")
+    await storage_manager.stop()
+    await metadata_writer.stop()
+    logger.info("File index writer drained")
+    session_store.close()
 
 app = FastAPI(
     title="File Upload Service",
@@ -37,15 +56,39 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
 
 app.include_router(upload_router, prefix="/api/uploads", tags=["uploads"])
 app.include_router(data_router, prefix="/api/data", tags=["data"])
 app.include_router(health_router, prefix="/api/health", tags=["health"])
+app.include_router(metrics_router, prefix="/api/metrics", tags=["metrics"])
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    """
+    Listening socket shared by the worker processes. uvicorn's own is
+    created without a protocol number, and asyncio only enables TCP_NODELAY
+    on connections accepted from an IPPROTO_TCP socket, which leaves
+    keep-alive responses waiting on delayed ACKs.
+    """
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.set_inheritable(True)
+    return sock
+
 
 if __name__ == "__main__":
-    uvicorn.run(
-        "main:app",
-        host="0.0.0.0",
-        port=8000,
-        reload=True
-    )
\ No newline at end of file
+    # WEB_CONCURRENCY worker processes share sessions, the file index and the
+    # content store through files under storage/. Auto-reload is for local
+    # development and only works with a single worker.
+    host = os.getenv('HOST', "0.0.0.0")
+    port = int(os.getenv('PORT', 8000))
+    reload = os.getenv('RELOAD', '0') == '1'
+    if WORKERS > 1:
+        if reload:
+            logger.warning("RELOAD=1 needs a single worker, starting without reload")
+        config = uvicorn.Config("main:app", host=host, port=port, workers=WORKERS)
+        Multiprocess(config, target=uvicorn.Server(config).run, sockets=[bind_socket(host, port)]).run()
+    else:
+        uvicorn.run("main:app", host=host, port=port, reload=reload)
@@ -12,3 +12,5 @@ class FileInfo(BaseModel):
     file_creation_time: str
     client_id: Optional[str] = None
     status: str = "completed"
+    checksum: Optional[str] = None
+    file_id: Optional[str] = None
@@ -0,0 +1,117 @@
+from contextlib import contextmanager
+from typing import Dict, Optional
+from services.session_store import SessionStore, SessionLimitReached
+
+
+class Overloaded(Exception):
+    """
+    Raised when a request is over an admission limit. status is 429 when the
+    client exceeded its own share and 503 when the server as a whole is
+    full; retry_after is the suggested wait in seconds.
+    """
+
+    def __init__(self, status: int, retry_after: int, detail: str):
+        super().__init__(detail)
+        self.status = status
+        self.retry_after = retry_after
+        self.detail = detail
+
+
+class AdmissionController:
+    """
+    Bounds the chunk bytes being written at once and the number of open
+    upload sessions, globally and per client. A limit of 0 disables it.
+
+    In-flight bytes are a non-blocking counting semaphore: a chunk either
+    gets its bytes reserved immediately or is rejected with Retry-After, so
+    overload turns into client backoff instead of queued memory and disk
+    writes. The counters live on the event loop thread and are per worker;
+    session counts come from the session store and are shared.
+    """
+
+    def __init__(
+        self,
+        session_store: SessionStore,
+        max_inflight_bytes: int = 0,
+        max_inflight_bytes_per_client: int = 0,
+        max_sessions: int = 0,
+        max_sessions_per_client: int = 0,
+        chunk_retry_after: int = 1,
+        session_retry_after: int = 10
+    ):
+        self.session_store = session_store
+        self.max_inflight_bytes = max_inflight_bytes
+        self.max_inflight_bytes_per_client = max_inflight_bytes_per_client
+        self.max_sessions = max_sessions
+        self.max_sessions_per_client = max_sessions_per_client
+        self.chunk_retry_after = chunk_retry_after
+        self.session_retry_after = session_retry_after
+        self.inflight_bytes = 0
+        self._client_bytes: Dict[Optional[str], int] = {}
+
+    @contextmanager
+    def chunk(self, client_id: Optional[str], size: int):
+        """Reserve size in-flight bytes for client_id for the duration of the block."""
+        client_bytes = self._client_bytes.get(client_id, 0)
+        # A request is always admitted when nothing else is in flight, so a
+        # chunk larger than a limit can't be locked out forever
+        if self.max_inflight_bytes_per_client and client_bytes and \
+                client_bytes + size > self.max_inflight_bytes_per_client:
+            raise Overloaded(429, self.chunk_retry_after, f"Client {client_id} has too many chunk bytes in flight")
+        if self.max_inflight_bytes and self.inflight_bytes and \
+                self.inflight_bytes + size > self.max_inflight_bytes:
+            raise Overloaded(503, self.chunk_retry_after, "Server has too many chunk bytes in flight")
+
+        self.inflight_bytes += size
+        self._client_bytes[client_id] = client_bytes + size
+        try:
+            yield
+        finally:
+            self.inflight_bytes -= size
+            remaining = self._client_bytes[client_id] - size
+            if remaining:
+                self._client_bytes[client_id] = remaining
+            else:
+                del self._client_bytes[client_id]
+
+    async def admit_session(self, client_id: Optional[str]) -> None:
+        """
+        Raise Overloaded if another upload session can't be opened now. A
+        cheap early check before any work is done for a new upload;
+        open_session() enforces the limits.
+        """
+        if self.max_sessions_per_client and \
+                await self.session_store.count(client_id) >= self.max_sessions_per_client:
+            raise self._session_overload(client_id, per_client=True)
+        if self.max_sessions and await self.session_store.count() >= self.max_sessions:
+            raise self._session_overload(client_id, per_client=False)
+
+    async def open_session(self, upload_id: str, session: dict) -> None:
+        """
+        Add a session to the store, checking the session limits in the same
+        transaction, so concurrent /init requests on any worker can't go
+        over them. Raises Overloaded when one is full.
+        """
+        try:
+            await self.session_store.create(
+                upload_id, session, max_sessions=self.max_sessions, max_sessions_per_client=self.max_sessions_per_client
+            )
+        except SessionLimitReached as e:
+            raise self._session_overload(session['client_id'], e.per_client)
+
+    def _session_overload(self, client_id: Optional[str], per_client: bool) -> Overloaded:
+        if per_client:
+            return Overloaded(429, self.session_retry_after, f"Client {client_id} has too many active uploads")
+        return Overloaded(503, self.session_retry_after, "Server has too many active uploads")
+
+    async def load(self) -> float:
+        """
+        How busy the server is, from 0 to 1: the larger of the in-flight
+        byte and session fractions of their global limits (0 when unlimited).
+        """
+        fractions = [0.0]
+        if self.max_inflight_bytes:
+            fractions.append(self.inflight_bytes / self.max_inflight_bytes)
+        if self.max_sessions:
+            fractions.append(await self.session_store.count() / self.max_sessions)
+        return min(1.0, max(fractions))
@@ -0,0 +1,89 @@
+from typing import List, Optional
+
+
+class ChunkBitmap:
+    """
+    One bit per chunk of an upload, set once the chunk has been written.
+    Backed by a bytearray so a multi-GB upload costs a few hundred bytes
+    and completeness checks run a byte at a time.
+    """
+
+    def __init__(self, total_chunks: Optional[int] = None, data: Optional[bytes] = None):
+        self.total_chunks = total_chunks
+        size = (total_chunks + 7) // 8 if total_chunks else 0
+        self._bits = bytearray(data) if data is not None else bytearray(size)
+        self.count = sum(bin(byte).count("1") for byte in self._bits) if data else 0
+
+    def __contains__(self, chunk_number: int) -> bool:
+        index = chunk_number >> 3
+        return index < len(self._bits) and bool(self._bits[index] & (1 << (chunk_number & 7)))
+
+    def add(self, chunk_number: int) -> bool:
+        """Mark a chunk as received. Returns False if it already was."""
+        index = chunk_number >> 3
+        if index >= len(self._bits):
+            self._bits.extend(bytes(index + 1 - len(self._bits)))
+        mask = 1 << (chunk_number & 7)
+        if self._bits[index] & mask:
+            return False
+        self._bits[index] |= mask
+        self.count += 1
+        return True
+
+    def discard(self, chunk_number: int) -> bool:
+        """Mark a chunk as not received. Returns False if it wasn't."""
+        if chunk_number not in self:
+            return False
+        self._bits[chunk_number >> 3] &= ~(1 << (chunk_number & 7)) & 0xFF
+        self.count -= 1
+        return True
+
+    def expected_chunks(self) -> int:
+        """Total chunk count, or one past the highest chunk seen when unknown."""
+        if self.total_chunks is not None:
+            return self.total_chunks
+        for index in range(len(self._bits) - 1, -1, -1):
+            if self._bits[index]:
+                return index * 8 + self._bits[index].bit_length()
+        return 0
+
+    def is_complete(self) -> bool:
+        expected = self.expected_chunks()
+        full_bytes, tail_bits = divmod(expected, 8)
+        if self._bits[:full_bytes].count(0xFF) != full_bytes:
+            return False
+        if tail_bits:
+            mask = (1 << tail_bits) - 1
+            return self._bits[full_bytes] & mask == mask
+        return True
+
+    def missing_ranges(self) -> List[List[int]]:
+        """Inclusive [start, end] ranges of chunks not yet received."""
+        ranges = []
+        start = None
+        expected = self.expected_chunks()
+        chunk_number = 0
+        while chunk_number < expected:
+            byte = self._bits[chunk_number >> 3] if (chunk_number >> 3) < len(self._bits) else 0
+            if chunk_number & 7 == 0 and byte in (0x00, 0xFF) and chunk_number + 8 <= expected:
+                # Whole byte is uniform, step over all eight chunks at once
+                if byte == 0xFF and start is not None:
+                    ranges.append([start, chunk_number - 1])
+                    start = None
+                elif byte == 0x00 and start is None:
+                    start = chunk_number
+                chunk_number += 8
+                continue
+            received = bool(byte & (1 << (chunk_number & 7)))
+            if received and start is not None:
+                ranges.append([start, chunk_number - 1])
+                start = None
+            elif not received and start is None:
+                start = chunk_number
+            chunk_number += 1
+        if start is not None:
+            ranges.append([start, expected - 1])
+        return ranges
+
+    def to_bytes(self) -> bytes:
+        return bytes(self._bits)
@@ -0,0 +1,162 @@
+import os
+import hashlib
+from functools import lru_cache
+from pathlib import Path
+from typing import AsyncIterator, List, Optional, Tuple
+from fastapi.concurrency import run_in_threadpool
+
+# Request body pieces are coalesced up to this size before each pwrite,
+# so an 8 MB chunk costs a handful of threadpool hops instead of hundreds
+WRITE_BUFFER_SIZE = 1024 * 1024
+DIGEST_ALGORITHM = "sha256"
+
+
+class ChunkSizeError(ValueError):
+    pass
+
+
+class UnitHasher:
+    """
+    Hashes a byte stream as consecutive units of unit_size bytes, so a
+    request carrying several chunks yields the same per-chunk digests as
+    sending them one at a time. Without unit_size the whole stream is one unit.
+    """
+
+    def __init__(self, unit_size: Optional[int] = None):
+        self.unit_size = unit_size
+        self._hasher = hashlib.new(DIGEST_ALGORITHM)
+        self._filled = 0
+        self._digests: List[str] = []
+
+    def update(self, data) -> None:
+        view = memoryview(data)
+        while len(view):
+            take = len(view) if self.unit_size is None else min(len(view), self.unit_size - self._filled)
+            self._hasher.update(view[:take])
+            self._filled += take
+            view = view[take:]
+            if self._filled == self.unit_size:
+                self._digests.append(self._hasher.hexdigest())
+                self._hasher = hashlib.new(DIGEST_ALGORITHM)
+                self._filled = 0
+
+    def hexdigests(self) -> List[str]:
+        if self._filled or not self._digests:
+            return self._digests + [self._hasher.hexdigest()]
+        return list(self._digests)
+
+
+def _pwrite_all(fd: int, data, offset: int, hasher=None) -> None:
+    # Hashing happens in the same threadpool job as the write, and hashlib
+    # releases the GIL on large buffers, so neither blocks the event loop
+    if hasher is not None:
+        hasher.update(data)
+    view = memoryview(data)
+    written = 0
+    while written < len(view):
+        written += os.pwrite(fd, view[written:], offset + written)
+
+
+def _write_block(fd: int, data, offset: int, hasher, decoder, limit: Optional[int], final: bool) -> int:
+    # Decompression runs here, in the threadpool, together with the write
+    if decoder is not None:
+        # Asking for one byte past the limit bounds the output of a hostile stream
+        data = decoder.decompress(data, limit + 1) if data else b""
+        if final and len(data) <= limit:
+            data += decoder.flush()
+    if limit is not None and len(data) > limit:
+        raise ChunkSizeError(f"Chunk is larger than {limit} bytes")
+    _pwrite_all(fd, data, offset, hasher)
+    return len(data)
+
+
+def write_bytes(path: Path, data: bytes, offset: int = 0, truncate: bool = False) -> str:
+    """Write data into path at offset and return its hex digest."""
+    flags = os.O_WRONLY | (os.O_CREAT | os.O_TRUNC if truncate else 0)
+    fd = os.open(path, flags, 0o644)
+    try:
+        hasher = hashlib.new(DIGEST_ALGORITHM)
+        _pwrite_all(fd, data, offset, hasher)
+        return hasher.hexdigest()
+    finally:
+        os.close(fd)
+
+
+@lru_cache(maxsize=16)
+def zero_digest(size: int) -> str:
+    """Hex digest of size zero bytes, for chunks that arrive as zero ranges."""
+    hasher = hashlib.new(DIGEST_ALGORITHM)
+    zeros = bytes(min(size, WRITE_BUFFER_SIZE))
+    remaining = size
+    while remaining > 0:
+        hasher.update(zeros[:remaining])
+        remaining -= len(zeros)
+    return hasher.hexdigest()
+
+
+def tree_digest(chunk_digests: List[str]) -> str:
+    """
+    Whole-file digest computed from the ordered chunk digests alone, so it
+    needs no extra pass over the data: sha256 over the concatenated raw
+    chunk digests. Formatted as "sha256-tree:<hex>".
+    """
+    hasher = hashlib.new(DIGEST_ALGORITHM)
+    for digest in chunk_digests:
+        hasher.update(bytes.fromhex(digest))
+    return f"{DIGEST_ALGORITHM}-tree:{hasher.hexdigest()}"
+
+
+async def write_stream(
+    stream: AsyncIterator[bytes],
+    path: Path,
+    offset: int = 0,
+    max_size: Optional[int] = None,
+    truncate: bool = False,
+    decoder=None,
+    unit_size: Optional[int] = None,
+    buffer_size: int = WRITE_BUFFER_SIZE
+) -> Tuple[int, List[str]]:
+    """
+    Write an async byte stream (e.g. request.stream()) into path starting at
+    offset, in writes of whole multiples of buffer_size (only the tail may
+    be shorter), so an aligned offset stays aligned. With
+    truncate the file is created or emptied first, otherwise it must exist.
+    A decoder from services.compression decompresses the stream on the way,
+    and then max_size is required, as it is what bounds the decompressed
+    output. Raises ChunkSizeError once more than max_size bytes would be
+    written.
+    Returns the number of bytes written and their hex digests, one per
+    unit_size bytes (a single one without unit_size).
+    """
+    if decoder is not None and max_size is None:
+        raise ValueError("Decoding a stream needs a max_size")
+    flags = os.O_WRONLY | (os.O_CREAT | os.O_TRUNC if truncate else 0)
+    fd = await run_in_threadpool(os.open, path, flags, 0o644)
+    try:
+        hasher = UnitHasher(unit_size)
+        buffer = bytearray()
+        written = 0
+        async for piece in stream:
+            if decoder is None and max_size is not None and written + len(buffer) + len(piece) > max_size:
+                raise ChunkSizeError(f"Chunk is larger than {max_size} bytes")
+            buffer += piece
+            if len(buffer) >= buffer_size:
+                limit = max_size - written if max_size is not None else None
+                # Decompressed output has no alignment to keep, so it is written whole
+                cut = len(buffer) if decoder is not None else len(buffer) - len(buffer) % buffer_size
+                block = memoryview(buffer)[:cut]
+                try:
+                    written += await run_in_threadpool(
+                        _write_block, fd, block, offset + written, hasher, decoder, limit, False
+                    )
+                finally:
+                    block.release()
+                del buffer[:cut]
+        if buffer or decoder is not None:
+            limit = max_size - written if max_size is not None else None
+            written += await run_in_threadpool(
+                _write_block, fd, buffer, offset + written, hasher, decoder, limit, True
+            )
+        return written, hasher.hexdigests()
+    finally:
+        await run_in_threadpool(os.close, fd)
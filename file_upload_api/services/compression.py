@@ -0,0 +1,109 @@
+import zlib
+from typing import List
+
+# zstd and lz4 are optional, the API only advertises the codecs it can decode
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+
+class DecodeError(ValueError):
+    pass
+
+
+class _DeflateDecoder:
+    """zlib-wrapped deflate, the HTTP "deflate" content coding."""
+
+    def __init__(self):
+        self._decompressor = zlib.decompressobj()
+
+    def decompress(self, data: bytes, max_length: int = 0) -> bytes:
+        try:
+            return self._decompressor.decompress(data, max_length)
+        except zlib.error as e:
+            raise DecodeError(f"Invalid deflate data: {str(e)}")
+
+    def flush(self) -> bytes:
+        data = self._decompressor.flush()
+        if not self._decompressor.eof:
+            raise DecodeError("Truncated deflate stream")
+        return data
+
+
+class _ZstdDecoder:
+    # zstd has no output cap per call, but a block decodes to at most 128 KB
+    # and takes at least 4 bytes of input, so input is fed in slices small
+    # enough that one call can't return much more than what is still allowed
+    MAX_RATIO = 128 * 1024 // 4
+    MIN_SLICE = 64
+
+    def __init__(self):
+        self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+        self._received = False
+
+    def decompress(self, data: bytes, max_length: int = 0) -> bytes:
+        self._received = self._received or bool(data)
+        view = memoryview(data)
+        output = []
+        produced = 0
+        try:
+            while len(view) and not (max_length and produced >= max_length):
+                size = max(self.MIN_SLICE, (max_length - produced) // self.MAX_RATIO) if max_length else len(view)
+                piece = self._decompressor.decompress(view[:size])
+                view = view[size:]
+                output.append(piece)
+                produced += len(piece)
+        except zstandard.ZstdError as e:
+            raise DecodeError(f"Invalid zstd data: {str(e)}")
+        data = b"".join(output)
+        return data[:max_length] if max_length else data
+
+    def flush(self) -> bytes:
+        if self._received and not getattr(self._decompressor, 'eof', True):
+            raise DecodeError("Truncated zstd stream")
+        return b""
+
+
+class _Lz4Decoder:
+    def __init__(self):
+        self._decompressor = lz4_frame.LZ4FrameDecompressor()
+
+    def decompress(self, data: bytes, max_length: int = 0) -> bytes:
+        try:
+            return self._decompressor.decompress(data, max_length or -1)
+        except RuntimeError as e:
+            raise DecodeError(f"Invalid lz4 data: {str(e)}")
+
+    def flush(self) -> bytes:
+        if not self._decompressor.eof:
+            raise DecodeError("Truncated lz4 stream")
+        return b""
+
+
+DECODERS = {"deflate": _DeflateDecoder}
+if zstandard is not None:
+    DECODERS["zstd"] = _ZstdDecoder
+if lz4_frame is not None:
+    DECODERS["lz4"] = _Lz4Decoder
+
+
+def supported_encodings() -> List[str]:
+    return list(DECODERS)
+
+
+def get_decoder(encoding: str):
+    """
+    Streaming decoder for a Content-Encoding value: decompress(data,
+    max_length) takes the body piece by piece and returns at most max_length
+    bytes when it is non-zero, without holding much more than that in
+    memory, flush() returns the tail and checks the stream ended cleanly.
+    Callers decoding untrusted input always pass a max_length. Raises
+    KeyError for encodings the API can't decode.
+    """
+    return DECODERS[encoding.strip().lower()]()
@@ -0,0 +1,144 @@
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import List, Optional, Tuple
+from fastapi.concurrency import run_in_threadpool
+from logs.logger import logger
+
+
+class ContentStore:
+    """
+    Content-addressed layer over stored uploads, kept in a local SQLite
+    database so every worker process shares it.
+
+    Whole files are keyed by their tree checksum: the first copy is
+    hardlinked into blobs/<xx>/<hex>, and later uploads of the same content
+    are replaced by a hardlink to that blob. Each chunk digest maps to a
+    (blob, offset, size) location that later uploads can copy from
+    server-side instead of receiving the bytes again. Locations remember the
+    blob's inode and mtime and are ignored once the file has changed.
+
+    A blob and every stored file linked to it are one inode, so stored
+    files are only ever replaced by renaming a new file over them, never
+    rewritten in place.
+    """
+
+    def __init__(self, db_path: Path, blob_dir: Path):
+        self.db_path = db_path
+        self.blob_dir = blob_dir
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.db_path), timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS blobs ("
+                "checksum TEXT PRIMARY KEY, path TEXT NOT NULL, inode INTEGER NOT NULL, mtime_ns INTEGER NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunks ("
+                "digest TEXT PRIMARY KEY, path TEXT NOT NULL, offset INTEGER NOT NULL, size INTEGER NOT NULL, "
+                "inode INTEGER NOT NULL, mtime_ns INTEGER NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS chunks_path ON chunks (path)")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _unchanged(path: str, inode: int, mtime_ns: int) -> bool:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return False
+        return st.st_ino == inode and st.st_mtime_ns == mtime_ns
+
+    def _lookup_chunk(self, digest: str) -> Optional[Tuple[Path, int, int]]:
+        row = self._connection().execute(
+            "SELECT path, offset, size, inode, mtime_ns FROM chunks WHERE digest = ?", (digest,)
+        ).fetchone()
+        if row is None or not self._unchanged(row[0], row[3], row[4]):
+            return None
+        return Path(row[0]), row[1], row[2]
+
+    def _store_file(self, final_path: Path, checksum: str, chunk_size: Optional[int], digests: List[str]) -> bool:
+        conn = self._connection()
+        hex_digest = checksum.split(":", 1)[-1]
+        row = conn.execute("SELECT path, inode, mtime_ns FROM blobs WHERE checksum = ?", (checksum,)).fetchone()
+
+        if row is not None and self._unchanged(*row):
+            # Swap the freshly written copy for a link to the existing blob
+            link_path = final_path.with_name(f".{final_path.name}.dedup")
+            os.link(row[0], link_path)
+            os.replace(link_path, final_path)
+            return True
+
+        blob_path = self.blob_dir / hex_digest[:2] / hex_digest
+        blob_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.unlink(blob_path)
+        except FileNotFoundError:
+            pass
+        try:
+            os.link(final_path, blob_path)
+        except OSError as e:
+            logger.warning(f"Could not link {final_path} into the content store: {str(e)}")
+            return False
+
+        st = os.stat(blob_path)
+        size = st.st_size
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO blobs (checksum, path, inode, mtime_ns) VALUES (?, ?, ?, ?)",
+                (checksum, str(blob_path), st.st_ino, st.st_mtime_ns)
+            )
+            if chunk_size:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO chunks (digest, path, offset, size, inode, mtime_ns) VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (digest, str(blob_path), n * chunk_size, min(chunk_size, size - n * chunk_size),
+                         st.st_ino, st.st_mtime_ns)
+                        for n, digest in enumerate(digests)
+                    ]
+                )
+        return False
+
+    def _collect_garbage(self) -> int:
+        conn = self._connection()
+        freed = 0
+        for checksum, path in conn.execute("SELECT checksum, path FROM blobs").fetchall():
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                st = None
+            if st is not None:
+                if st.st_nlink > 1:
+                    continue
+                os.unlink(path)
+                freed += st.st_blocks * 512
+            with conn:
+                conn.execute("DELETE FROM blobs WHERE checksum = ?", (checksum,))
+                conn.execute("DELETE FROM chunks WHERE path = ?", (path,))
+        return freed
+
+    async def lookup_chunk(self, digest: str) -> Optional[Tuple[Path, int, int]]:
+        """Location (path, offset, size) of stored bytes with this digest, if any."""
+        return await run_in_threadpool(self._lookup_chunk, digest)
+
+    async def store_file(self, final_path: Path, checksum: str, chunk_size: Optional[int], digests: List[str]) -> bool:
+        """
+        Register a completed file. Returns True when identical content was
+        already stored and final_path now links to it.
+        """
+        return await run_in_threadpool(self._store_file, final_path, checksum, chunk_size, digests)
+
+    async def collect_garbage(self) -> int:
+        """
+        Drop blobs that no stored file links to any more (link count 1) with
+        their chunk locations. Returns the disk space freed. A dedup racing
+        with this finds the blob gone and keeps its own copy.
+        """
+        return await run_in_threadpool(self._collect_garbage)
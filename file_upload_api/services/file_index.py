@@ -0,0 +1,378 @@
+import os
+import json
+import asyncio
+import fcntl
+import sqlite3
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+from fastapi.concurrency import run_in_threadpool
+
+
+class JsonlIndexBackend:
+    """
+    Append-only file_index.json with one FileInfo record per line. Appends
+    hold an exclusive flock, so batches from several worker processes never
+    interleave, and read() can resume from a byte offset to pick up records
+    other workers appended since.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    def read(self, position: int = 0) -> Tuple[List[dict], int]:
+        """Records appended after byte position, and the position to resume from."""
+        try:
+            f = open(self.path, "rb", buffering=1024 * 1024)
+        except FileNotFoundError:
+            return [], position
+        with f:
+            if os.fstat(f.fileno()).st_size < position:
+                position = 0  # the file was replaced, start over
+            f.seek(position)
+            records = []
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # an append still in progress, picked up next time
+                position += len(line)
+                if line.strip():
+                    records.append(json.loads(line))
+        return records, position
+
+    def write_batch(self, records: List[dict], fsync: bool = False) -> None:
+        with open(self.path, "a", buffering=1024 * 1024) as f:
+            # Released when the file is closed, after the buffer is flushed
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            f.write("".join(json.dumps(record) + "\n" for record in records))
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def sync(self) -> None:
+        """fsync records appended without it."""
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except FileNotFoundError:
+            return
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+# Order of the records of one upload, whichever worker wrote them first
+STATUS_RANK = {"pending": 0, "completed": 1, "expired": 2, "deleted": 3}
+
+
+def record_id(record: dict) -> str:
+    """The upload a record belongs to, its filename for records from before file IDs."""
+    return record.get('file_id') or record['filename']
+
+
+def record_version(record: dict) -> tuple:
+    """
+    Compared to decide whether a record replaces the known one of its
+    upload. All records of an upload share its upload_date, so it only
+    orders records from before file IDs, keyed by filename.
+    """
+    rank = STATUS_RANK.get(record['status'], 0)
+    return (rank,) if record.get('file_id') else (record['upload_date'], rank)
+
+
+def _sql_rank(table: str) -> str:
+    return (
+        f"CASE json_extract({table}.record, '$.status') "
+        + " ".join(f"WHEN '{status}' THEN {rank}" for status, rank in STATUS_RANK.items())
+        + " ELSE 0 END"
+    )
+
+
+class SQLiteIndexBackend:
+    """
+    Latest record per upload, upserted into a local SQLite table. Every
+    upsert stamps the row with the next seq, so read() can fetch just the
+    rows changed since a given seq, whichever worker wrote them.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.path), timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            "id TEXT PRIMARY KEY, upload_date TEXT NOT NULL, record TEXT NOT NULL, seq INTEGER NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS records_seq ON records (seq)")
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'files'").fetchone():
+            self._migrate(conn)
+        return conn
+
+    @staticmethod
+    def _migrate(conn: sqlite3.Connection) -> None:
+        """Move rows of the old per-filename table over to the per-upload one."""
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Checked again under the write lock, another worker may have migrated it first
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'files'").fetchone():
+                columns = [row[1] for row in conn.execute("PRAGMA table_info(files)")]
+                seq = "seq" if "seq" in columns else "rowid"
+                conn.execute(
+                    "INSERT OR IGNORE INTO records (id, upload_date, record, seq) "
+                    f"SELECT COALESCE(json_extract(record, '$.file_id'), filename), upload_date, record, {seq} "
+                    "FROM files"
+                )
+                conn.execute("DROP TABLE files")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def read(self, position: int = 0) -> Tuple[List[dict], int]:
+        """Records upserted after seq position, and the seq to resume from."""
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT record, seq FROM records WHERE seq > ? ORDER BY seq", (position,)).fetchall()
+        finally:
+            conn.close()
+        return [json.loads(record) for record, _ in rows], rows[-1][1] if rows else position
+
+    def write_batch(self, records: List[dict], fsync: bool = False) -> None:
+        conn = self._connect()
+        try:
+            # In WAL mode NORMAL only survives process crashes, FULL also syncs each commit
+            conn.execute(f"PRAGMA synchronous={'FULL' if fsync else 'NORMAL'}")
+            with conn:
+                # Same rule as record_version(), so every worker keeps the same
+                # record whichever got its batch written first
+                new_rank, old_rank = _sql_rank("excluded"), _sql_rank("records")
+                conn.executemany(
+                    "INSERT INTO records (id, upload_date, record, seq) "
+                    "VALUES (?, ?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM records)) "
+                    "ON CONFLICT(id) DO UPDATE SET "
+                    "upload_date = excluded.upload_date, record = excluded.record, seq = excluded.seq "
+                    f"WHERE CASE WHEN json_extract(excluded.record, '$.file_id') IS NOT NULL THEN {new_rank} >= {old_rank} "
+                    f"ELSE excluded.upload_date > records.upload_date "
+                    f"OR (excluded.upload_date = records.upload_date AND {new_rank} >= {old_rank}) END",
+                    [(record_id(r), r['upload_date'], json.dumps(r)) for r in records]
+                )
+        finally:
+            conn.close()
+
+    def sync(self) -> None:
+        """fsync commits made with synchronous=NORMAL, which only reach the WAL."""
+        for path in (self.path, self.path.with_name(self.path.name + "-wal")):
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+
+class FileIndex:
+    """
+    In-memory view of the latest FileInfo record per upload, keyed by file
+    ID, so uploads sharing a filename are all kept. Loaded once from the
+    backend at startup and kept current by update(), so listing never
+    re-reads or re-parses the index file.
+
+    Records are ordered by their (upload_date, file ID) key. The key list
+    of all records, one per client and one per status are kept sorted, and
+    a size-sorted list covers size ranges, so query() starts from the most
+    selective one instead of scanning. Bytes of completed files are totalled
+    as records come and go, for quotas.
+    """
+
+    def __init__(self, backend, shared: bool = False):
+        self.backend = backend
+        self.shared = shared
+        self._position = 0
+        self._refresh_lock: Optional[asyncio.Lock] = None
+        self._files: Dict[str, dict] = {}
+        self._by_date: List[Tuple[str, str]] = []
+        self._by_size: List[Tuple[int, str]] = []
+        self._by_client: Dict[Optional[str], List[Tuple[str, str]]] = defaultdict(list)
+        self._by_status: Dict[str, List[Tuple[str, str]]] = defaultdict(list)
+        self._stored_bytes = 0
+        self._stored_by_client: Dict[Optional[str], int] = defaultdict(int)
+
+    @staticmethod
+    def _key(record: dict) -> Tuple[str, str]:
+        return record['upload_date'], record_id(record)
+
+    @staticmethod
+    def _remove_sorted(items: list, key: tuple) -> None:
+        index = bisect_left(items, key)
+        if index < len(items) and items[index] == key:
+            del items[index]
+
+    def _unindex(self, record: dict) -> None:
+        key = self._key(record)
+        self._remove_sorted(self._by_date, key)
+        self._remove_sorted(self._by_size, (record['size'], key[1]))
+        self._remove_sorted(self._by_client[record.get('client_id')], key)
+        self._remove_sorted(self._by_status[record['status']], key)
+        if record['status'] == "completed":
+            self._stored_bytes -= record['size']
+            self._stored_by_client[record.get('client_id')] -= record['size']
+            if not self._stored_by_client[record.get('client_id')]:
+                del self._stored_by_client[record.get('client_id')]
+
+    def _index(self, record: dict) -> None:
+        key = self._key(record)
+        insort(self._by_date, key)
+        insort(self._by_size, (record['size'], key[1]))
+        insort(self._by_client[record.get('client_id')], key)
+        insort(self._by_status[record['status']], key)
+        if record['status'] == "completed":
+            self._stored_bytes += record['size']
+            self._stored_by_client[record.get('client_id')] += record['size']
+
+    def update(self, record: dict) -> bool:
+        """
+        Apply a record unless a later one of the same upload is known, going
+        by record_version() rather than arrival order, as records from
+        different workers may arrive in any order.
+        """
+        current = self._files.get(record_id(record))
+        if current is not None:
+            if record_version(current) > record_version(record):
+                return False
+            self._unindex(current)
+        self._files[record_id(record)] = record
+        self._index(record)
+        return True
+
+    def _load(self) -> int:
+        records, self._position = self.backend.read(self._position)
+        for record in records:
+            self.update(record)
+        return len(self._files)
+
+    async def load(self) -> int:
+        return await run_in_threadpool(self._load)
+
+    async def refresh(self) -> None:
+        """
+        Apply records that other worker processes persisted since the last
+        load or refresh. A no-op unless the index is shared. The backend is
+        read in the threadpool, the records are applied on the event loop.
+        Concurrent calls wait their turn rather than return early, so each
+        caller sees every record persisted before it called.
+        """
+        if not self.shared:
+            return
+        if self._refresh_lock is None:
+            # Created here so it binds to the running loop on Python 3.8
+            self._refresh_lock = asyncio.Lock()
+        async with self._refresh_lock:
+            records, self._position = await run_in_threadpool(self.backend.read, self._position)
+            for record in records:
+                self.update(record)
+
+    async def persist(self, records: List[dict], fsync: bool = False) -> None:
+        await run_in_threadpool(self.backend.write_batch, records, fsync)
+
+    async def sync(self) -> None:
+        await run_in_threadpool(self.backend.sync)
+
+    def get(self, file_id: str) -> Optional[dict]:
+        return self._files.get(file_id)
+
+    def stored_bytes(self, client_id: Optional[str] = None) -> int:
+        """Total size of completed files, of one client or of all."""
+        if client_id is None:
+            return self._stored_bytes
+        return self._stored_by_client.get(client_id, 0)
+
+    def client_usage(self) -> Dict[Optional[str], int]:
+        """Bytes of completed files per client."""
+        return dict(self._stored_by_client)
+
+    def list(self) -> List[dict]:
+        return [self._files[file_id] for _, file_id in self._by_date]
+
+    def scan(
+        self,
+        after: Optional[Tuple[str, str]] = None,
+        client_id: Optional[str] = None,
+        status: Optional[str] = None,
+        min_size: Optional[int] = None,
+        max_size: Optional[int] = None,
+        uploaded_after: Optional[str] = None,
+        uploaded_before: Optional[str] = None
+    ) -> Iterator[dict]:
+        """
+        Lazily yield the records matching the filters in key order, strictly
+        after the `after` key. Dates compare as "%Y-%m-%d %H:%M:%S" strings,
+        uploaded_after is inclusive and uploaded_before exclusive.
+
+        Each step bisects past the last key yielded, so the generator can be
+        consumed a page at a time while records keep changing. Only a size
+        range has to be sorted by key first, once per scan; records added to
+        it after that are not seen.
+        """
+        # Walk the smallest key-sorted list among the available indexes
+        keys: List[Tuple[str, str]] = self._by_date
+        if client_id is not None and len(self._by_client.get(client_id, ())) < len(keys):
+            keys = self._by_client.get(client_id, [])
+        if status is not None and len(self._by_status.get(status, ())) < len(keys):
+            keys = self._by_status.get(status, [])
+        if min_size is not None or max_size is not None:
+            size_lo = bisect_left(self._by_size, (min_size,)) if min_size is not None else 0
+            size_hi = bisect_left(self._by_size, (max_size + 1,)) if max_size is not None else len(self._by_size)
+            if size_hi - size_lo < len(keys):
+                keys = sorted(self._key(self._files[file_id]) for _, file_id in self._by_size[size_lo:size_hi])
+
+        last = tuple(after) if after is not None else None
+        if uploaded_after is not None and (last is None or last < (uploaded_after,)):
+            last = (uploaded_after,)
+        index = bisect_right(keys, last) if last is not None else 0
+        while index < len(keys):
+            key = keys[index]
+            if uploaded_before is not None and key[0] >= uploaded_before:
+                return
+            record = self._files.get(key[1])
+            if record is not None and self._key(record) == key and \
+                    (client_id is None or record.get('client_id') == client_id) and \
+                    (status is None or record['status'] == status) and \
+                    (min_size is None or record['size'] >= min_size) and \
+                    (max_size is None or record['size'] <= max_size):
+                yield record
+            last = key
+            index = bisect_right(keys, last)
+
+    def query(
+        self,
+        limit: Optional[int] = None,
+        after: Optional[Tuple[str, str]] = None,
+        **filters
+    ) -> Tuple[List[dict], Optional[Tuple[str, str]]]:
+        """
+        Return up to limit records of scan(after, **filters), plus the key
+        to resume from when more records match.
+        """
+        records = self.scan(after, **filters)
+        if limit is None:
+            return list(records), None
+        results = list(islice(records, limit + 1))
+        if len(results) > limit:
+            return results[:limit], self._key(results[limit - 1])
+        return results, None
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+
+def create_file_index(backend: str, upload_dir: Path, shared: bool = False) -> FileIndex:
+    if backend == "jsonl":
+        return FileIndex(JsonlIndexBackend(upload_dir / "file_index.json"), shared)
+    if backend == "sqlite":
+        return FileIndex(SQLiteIndexBackend(upload_dir / "file_index.db"), shared)
+    raise ValueError(f"Unknown file index backend: {backend}")
@@ -0,0 +1,354 @@
+import os
+import stat
+import errno
+import ctypes
+import ctypes.util
+import shutil
+from pathlib import Path
+from typing import Optional
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Errors meaning "this kernel/filesystem can't do it", not "the copy failed"
+_UNSUPPORTED_ERRNOS = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP}
+
+_copy_file_range_supported = hasattr(os, "copy_file_range")
+_sendfile_supported = hasattr(os, "sendfile")
+_seek_data_supported = hasattr(os, "SEEK_DATA")
+
+# fallocate(2) flags, not exposed by the os module
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+_fallocate = None
+_punch_hole_supported = True
+
+
+def _copy_with_copy_file_range(src_fd: int, src_offset: int, size: int, dst_fd: int, dst_offset: int) -> int:
+    copied = 0
+    while copied < size:
+        sent = os.copy_file_range(src_fd, dst_fd, size - copied, src_offset + copied, dst_offset + copied)
+        if sent == 0:
+            break
+        copied += sent
+    return copied
+
+
+def _copy_with_sendfile(src_fd: int, src_offset: int, size: int, dst_fd: int, dst_offset: int) -> int:
+    os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+    copied = 0
+    while copied < size:
+        sent = os.sendfile(dst_fd, src_fd, src_offset + copied, size - copied)
+        if sent == 0:
+            break
+        copied += sent
+    return copied
+
+
+def _copy_with_buffer(src_fd: int, src_offset: int, size: int, dst_fd: int, dst_offset: int) -> int:
+    buffer = bytearray(min(COPY_BUFFER_SIZE, max(size, 1)))
+    view = memoryview(buffer)
+    copied = 0
+    while copied < size:
+        read = os.preadv(src_fd, [view[:min(len(view), size - copied)]], src_offset + copied)
+        if read == 0:
+            break
+        written = 0
+        while written < read:
+            written += os.pwrite(dst_fd, view[written:read], dst_offset + copied + written)
+        copied += read
+    return copied
+
+
+def _copy_segment(src_fd: int, src_offset: int, size: int, dst_fd: int, dst_offset: int) -> int:
+    global _copy_file_range_supported, _sendfile_supported
+
+    if _copy_file_range_supported:
+        try:
+            return _copy_with_copy_file_range(src_fd, src_offset, size, dst_fd, dst_offset)
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+            _copy_file_range_supported = False
+
+    if _sendfile_supported:
+        try:
+            return _copy_with_sendfile(src_fd, src_offset, size, dst_fd, dst_offset)
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+            _sendfile_supported = False
+
+    return _copy_with_buffer(src_fd, src_offset, size, dst_fd, dst_offset)
+
+
+def _copy_data_segments(src_fd: int, src_offset: int, size: int, dst_fd: int, dst_offset: int) -> int:
+    global _seek_data_supported
+
+    end = src_offset + size
+    position = src_offset
+    while position < end:
+        try:
+            data = os.lseek(src_fd, position, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                break  # only a hole left
+            if e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+            _seek_data_supported = False
+            _copy_segment(src_fd, position, end - position, dst_fd, dst_offset + position - src_offset)
+            break
+        if data >= end:
+            break
+        hole = min(os.lseek(src_fd, data, os.SEEK_HOLE), end)
+        _copy_segment(src_fd, data, hole - data, dst_fd, dst_offset + data - src_offset)
+        position = hole
+    return size
+
+
+def copy_range(src_path: Path, src_offset: int, size: int, dst_fd: int, dst_offset: int, sparse: bool = False) -> int:
+    """
+    Copy size bytes at src_offset of src_path into dst_fd at dst_offset
+    without pulling them through Python memory where the kernel allows it.
+    Falls back from copy_file_range (which reflinks on filesystems that
+    support it) to sendfile to a bounded-buffer copy.
+
+    With sparse, holes in the source are skipped rather than written out as
+    zeros, so the destination range must already read as zeros.
+    """
+    src_fd = os.open(src_path, os.O_RDONLY)
+    try:
+        if sparse and _seek_data_supported:
+            return _copy_data_segments(src_fd, src_offset, size, dst_fd, dst_offset)
+        return _copy_segment(src_fd, src_offset, size, dst_fd, dst_offset)
+    finally:
+        os.close(src_fd)
+
+
+def copy_into(src_path: Path, dst_fd: int, offset: int, sparse: bool = False) -> int:
+    """Copy the whole of src_path into dst_fd at the given offset."""
+    return copy_range(src_path, 0, os.path.getsize(src_path), dst_fd, offset, sparse)
+
+
+def copy_chunk(src_path: Path, src_offset: int, size: int, dst_path: Path, dst_offset: int, truncate: bool = False) -> int:
+    """Copy a stored byte range into an upload's part file or chunk file."""
+    flags = os.O_WRONLY | (os.O_CREAT | os.O_TRUNC if truncate else 0)
+    dst_fd = os.open(dst_path, flags, 0o644)
+    try:
+        return copy_range(src_path, src_offset, size, dst_fd, dst_offset)
+    finally:
+        os.close(dst_fd)
+
+
+def _create_new(path: Path) -> int:
+    """
+    Open path for writing as a new, empty file. Whatever was there is
+    unlinked rather than truncated: stored files share their inode with
+    content store blobs and deduplicated copies, and rewriting one in place
+    would change all of them. Files are written under temp/ and renamed
+    into place with commit_file().
+    """
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+
+
+def assemble_chunks(temp_dir: Path, total_chunks: int, part_path: Path) -> int:
+    """
+    Concatenate chunk_0 .. chunk_<total_chunks - 1> from temp_dir into a new
+    part_path in numeric order. Meant to run as a single threadpool job so
+    the event loop is never blocked by the copy itself. Returns the size of
+    the assembled file.
+
+    The chunks are left in place, to be removed once the assembled file is
+    committed: if assembly fails, e.g. on a full disk, the partial file is
+    removed and the upload can still be finalized again.
+    """
+    dst_fd = _create_new(part_path)
+    try:
+        try:
+            offset = 0
+            for chunk_number in range(total_chunks):
+                chunk_path = temp_dir / f"chunk_{chunk_number}"
+                # The file starts empty, so holes in the chunks stay holes
+                offset += copy_into(chunk_path, dst_fd, offset, sparse=True)
+            os.ftruncate(dst_fd, offset)
+        finally:
+            os.close(dst_fd)
+    except BaseException:
+        part_path.unlink(missing_ok=True)
+        raise
+    return offset
+
+
+def preallocate(path: Path, size: int) -> None:
+    """
+    Create path as a new file with size bytes reserved on disk so positional
+    chunk writes never extend the file. Filesystems without fallocate
+    support get a plain (sparse) truncate instead.
+    """
+    fd = _create_new(path)
+    try:
+        _reserve(fd, size)
+    finally:
+        os.close(fd)
+
+
+def _reserve(fd: int, size: int) -> None:
+    if size > 0:
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+            os.ftruncate(fd, size)
+
+
+def write_file_object(src, path: Path, size: Optional[int] = None, block_size: int = COPY_BUFFER_SIZE) -> int:
+    """
+    Copy a readable binary file object (e.g. a spooled multipart upload)
+    from its start into a new file at path, preallocating size bytes when
+    known, in block_size writes at block-aligned offsets. Meant to run as a
+    single threadpool job. Returns the number of bytes written.
+    """
+    src.seek(0)
+    fd = _create_new(path)
+    try:
+        _reserve(fd, size or 0)
+        written = 0
+        while True:
+            block = src.read(block_size)
+            if not block:
+                break
+            view = memoryview(block)
+            done = 0
+            while done < len(view):
+                done += os.pwrite(fd, view[done:], written + done)
+            written += done
+        if size and written != size:
+            os.ftruncate(fd, written)
+    finally:
+        os.close(fd)
+    return written
+
+
+def _punch_hole(fd: int, offset: int, size: int) -> bool:
+    global _fallocate, _punch_hole_supported
+
+    if not _punch_hole_supported:
+        return False
+    if _fallocate is None:
+        try:
+            fallocate = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True).fallocate
+        except (OSError, AttributeError):
+            _punch_hole_supported = False
+            return False
+        fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        _fallocate = fallocate
+
+    if _fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, size) != 0:
+        err = ctypes.get_errno()
+        if err not in _UNSUPPORTED_ERRNOS:
+            raise OSError(err, os.strerror(err))
+        _punch_hole_supported = False
+        return False
+    return True
+
+
+def write_zeros(path: Path, offset: int, size: int, truncate: bool = False) -> None:
+    """
+    Make size bytes at offset of path read as zeros, as a hole where the
+    filesystem allows it. With truncate the file is recreated as a sparse
+    file of offset + size bytes, otherwise it must exist.
+    """
+    flags = os.O_WRONLY | (os.O_CREAT | os.O_TRUNC if truncate else 0)
+    fd = os.open(path, flags, 0o644)
+    try:
+        if truncate:
+            os.ftruncate(fd, offset + size)
+        elif size > 0 and not _punch_hole(fd, offset, size):
+            zeros = bytes(min(COPY_BUFFER_SIZE, size))
+            written = 0
+            while written < size:
+                written += os.pwrite(fd, zeros[:size - written], offset + written)
+    finally:
+        os.close(fd)
+
+
+def stored_path(upload_dir: Path, file_id: str, filename: str) -> Path:
+    """
+    Where a stored file lives: files/<id[:2]>/<id[2:4]>/<id>_<name> under
+    upload_dir, for a random hex file_id (e.g. an upload's UUID). The two
+    shard levels keep directories small at millions of files, and the ID
+    makes names unique, so uploads of the same filename never collide.
+    Only the last component of filename is used.
+    """
+    name = os.path.basename(filename.replace("\\", "/")) or "file"
+    return upload_dir / "files" / file_id[:2] / file_id[2:4] / f"{file_id}_{name}"
+
+
+def _fsync_directory(path: Path) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def commit_file(part_path: Path, final_path: Path) -> int:
+    """
+    fsync a fully written file and atomically rename it into place,
+    creating its shard directories, then fsync the directory so the rename
+    is durable too. Returns the size of the committed file.
+    """
+    fd = os.open(part_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        size = os.fstat(fd).st_size
+    finally:
+        os.close(fd)
+    final_path.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(part_path, final_path)
+    _fsync_directory(final_path.parent)
+    return size
+
+
+def directory_usage(path: Path) -> int:
+    """Bytes actually allocated on disk under path, so sparse files count what they use."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def remove_path(path: Path) -> int:
+    """
+    Delete a file or directory tree, returning the disk space that frees.
+    A file with other hardlinks frees nothing until the last one goes.
+    """
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return 0
+    if stat.S_ISDIR(st.st_mode):
+        freed = directory_usage(path)
+        shutil.rmtree(path, ignore_errors=True)
+        return freed
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        return 0
+    return st.st_blocks * 512 if st.st_nlink == 1 else 0
+
+
+def remove_upload_files(temp_dir: Path, part_path: Optional[Path]) -> int:
+    """Delete whatever an abandoned upload left behind, returning the disk space freed."""
+    freed = remove_path(temp_dir)
+    if part_path is not None:
+        freed += remove_path(Path(part_path))
+    return freed
@@ -0,0 +1,161 @@
+import time
+import asyncio
+from typing import List, Optional
+from logs.logger import logger
+from services.file_index import FileIndex
+from services.metrics import index_flush_duration, index_flush_batch_size
+
+FSYNC_POLICIES = ("always", "interval", "never")
+
+
+class MetadataWriter:
+    """
+    Background task that persists FileInfo records for the file index.
+    Records are queued by submit() and written in group commits of up to
+    batch_size records, or whatever arrived within batch_window seconds of
+    the first one. flush() waits for the records submitted so far to be
+    written, for readers in other worker processes. stop() drains the
+    queue before returning.
+
+    fsync policy: "always" syncs every batch, "interval" at most once per
+    fsync_interval seconds, and no later than fsync_interval seconds after
+    an unsynced batch even if nothing else arrives, "never" leaves it to
+    the OS.
+    """
+
+    def __init__(
+        self,
+        file_index: FileIndex,
+        batch_size: int = 100,
+        batch_window: float = 0.5,
+        fsync: str = "interval",
+        fsync_interval: float = 1.0
+    ):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        self.file_index = file_index
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self._last_fsync = 0.0
+        # When the oldest batch written without fsync was committed
+        self._unsynced_since: Optional[float] = None
+        # Records submitted, written (or dropped), and to be written without waiting for a full batch
+        self._submitted = 0
+        self._committed = 0
+        self._flush_to = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._batch_ready: Optional[asyncio.Event] = None
+        self._commit_done: Optional[asyncio.Condition] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        # Created here so they bind to the running loop on Python 3.8
+        self._queue = asyncio.Queue()
+        self._batch_ready = asyncio.Event()
+        self._commit_done = asyncio.Condition()
+        self._task = asyncio.create_task(self._run())
+
+    def submit(self, record: dict) -> None:
+        if self._task is None or self._task.done():
+            raise RuntimeError("Metadata writer is not running")
+        self._queue.put_nowait(record)
+        self._submitted += 1
+        if self._queue.qsize() >= self.batch_size:
+            self._batch_ready.set()
+
+    async def flush(self) -> None:
+        """Write the records submitted so far now, and wait until they are."""
+        target = self._submitted
+        if self._committed >= target:
+            return
+        self._flush_to = max(self._flush_to, target)
+        self._batch_ready.set()
+        async with self._commit_done:
+            await self._commit_done.wait_for(lambda: self._committed >= target)
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        self._batch_ready.set()
+        await self._task
+        self._task = None
+
+    async def _run(self) -> None:
+        closing = False
+        while not closing:
+            try:
+                record = await asyncio.wait_for(self._queue.get(), self._sync_delay())
+            except asyncio.TimeoutError:
+                await self._sync()
+                continue
+            closing = record is None
+            batch = [] if closing else [record]
+
+            if not closing and self._queue.qsize() + 1 < self.batch_size and self._flush_to <= self._committed:
+                self._batch_ready.clear()
+                try:
+                    await asyncio.wait_for(self._batch_ready.wait(), self.batch_window)
+                except asyncio.TimeoutError:
+                    pass
+
+            while not closing and len(batch) < self.batch_size and not self._queue.empty():
+                record = self._queue.get_nowait()
+                if record is None:
+                    closing = True
+                else:
+                    batch.append(record)
+
+            if batch:
+                await self._commit(batch, closing)
+                self._committed += len(batch)
+                async with self._commit_done:
+                    self._commit_done.notify_all()
+
+    def _should_fsync(self) -> bool:
+        if self.fsync == "always":
+            return True
+        if self.fsync == "interval":
+            return time.monotonic() - self._last_fsync >= self.fsync_interval
+        return False
+
+    def _sync_delay(self) -> Optional[float]:
+        """Seconds until unsynced batches are due for an fsync, None if there are none."""
+        if self._unsynced_since is None:
+            return None
+        return max(0.0, self._unsynced_since + self.fsync_interval - time.monotonic())
+
+    async def _sync(self) -> None:
+        try:
+            await self.file_index.sync()
+        except Exception as e:
+            logger.error(f"File index fsync failed, retrying in {self.fsync_interval:.1f}s: {str(e)}")
+            self._unsynced_since = time.monotonic()
+            return
+        self._last_fsync = time.monotonic()
+        self._unsynced_since = None
+
+    async def _commit(self, batch: List[dict], closing: bool) -> None:
+        attempt = 0
+        while True:
+            fsync = closing or self._should_fsync()
+            try:
+                with index_flush_duration.time():
+                    await self.file_index.persist(batch, fsync=fsync)
+                index_flush_batch_size.observe(len(batch))
+                if fsync:
+                    self._last_fsync = time.monotonic()
+                    self._unsynced_since = None
+                elif self.fsync == "interval" and self._unsynced_since is None:
+                    self._unsynced_since = time.monotonic()
+                return
+            except Exception as e:
+                attempt += 1
+                if closing and attempt >= 3:
+                    logger.error(f"Dropping {len(batch)} file index records after {attempt} failed writes: {str(e)}")
+                    return
+                delay = min(0.1 * 2 ** attempt, 5.0)
+                logger.error(f"File index write of {len(batch)} records failed, retrying in {delay:.1f}s: {str(e)}")
+                await asyncio.sleep(delay)
@@ -0,0 +1,162 @@
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Dict, List, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Metrics are only ever updated from the event loop thread (handlers, the
+# middleware and the metadata writer task), so updates are plain dict and
+# float operations with no locking on the chunk path. Values are per process.
+_registry: List["_Metric"] = []
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BATCH_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+def _format_labels(names: Sequence[str], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric(ABC):
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        _registry.append(self)
+
+    @abstractmethod
+    def samples(self) -> List[str]:
+        ...
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(lines + self.samples())
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, labels: Tuple = ()) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, labels: Tuple = ()) -> None:
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+    def set(self, value: float, labels: Tuple = ()) -> None:
+        self._values[labels] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        # Per label set: [count per bucket (last one is +Inf)], sum
+        self._values: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, labels: Tuple = ()) -> None:
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def time(self, labels: Tuple = ()) -> "_Timer":
+        return _Timer(self, labels)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: Tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, self.labels)
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+http_request_duration = Histogram(
+    "http_request_duration_seconds", "Request latency by route", ("method", "route")
+)
+http_requests = Counter("http_requests_total", "Requests by route and status", ("method", "route", "status"))
+bytes_received = Counter("upload_bytes_received_total", "Upload bytes written from request bodies, after decompression")
+chunks_stored = Counter("upload_chunks_total", "Chunks stored, by how their bytes arrived", ("source",))
+admission_rejections = Counter("upload_admission_rejections_total", "Requests turned away by admission limits", ("status",))
+chunks_in_flight = Gauge("upload_chunks_in_flight", "Chunk requests currently being written")
+uploads_active = Gauge("uploads_active", "Chunked upload sessions not yet finalized")
+temp_disk_usage = Gauge("upload_temp_disk_usage_bytes", "Disk space allocated under storage/temp")
+stored_bytes = Gauge("storage_stored_bytes", "Bytes of completed files in the file index")
+storage_reclaimed = Counter("storage_reclaimed_bytes_total", "Disk space freed by storage maintenance", ("reason",))
+finalize_duration = Histogram("upload_finalize_duration_seconds", "Time to commit or assemble a finalized upload", ("mode",))
+index_flush_duration = Histogram("index_flush_duration_seconds", "File index batch write latency")
+index_flush_batch_size = Histogram("index_flush_batch_size", "Records per file index batch write", buckets=BATCH_BUCKETS)
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware timing every HTTP request by its route template
+    (e.g. /api/uploads/{upload_id}/chunks/{chunk_number}), so request bodies
+    keep streaming untouched.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            method = scope["method"]
+            http_request_duration.observe(time.perf_counter() - start, (method, path))
+            http_requests.inc(1, (method, path, status[0]))
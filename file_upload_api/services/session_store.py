@@ -0,0 +1,453 @@
+import json
+import time
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Dict, List, Optional
+from fastapi.concurrency import run_in_threadpool
+from services.chunk_bitmap import ChunkBitmap
+
+
+class SessionLimitReached(Exception):
+    """Raised by create() when a session limit is full; per_client tells which one."""
+
+    def __init__(self, per_client: bool):
+        super().__init__("client session limit reached" if per_client else "session limit reached")
+        self.per_client = per_client
+
+
+class SessionStore(ABC):
+    """
+    Storage for in-flight chunked upload sessions. A session is a plain dict
+    keyed by field name, with a ChunkBitmap under 'received' and Paths under
+    'temp_dir' and 'part_path'.
+    """
+
+    @abstractmethod
+    async def create(self, upload_id: str, session: dict, max_sessions: int = 0,
+                     max_sessions_per_client: int = 0) -> None:
+        """
+        Add a session. With a limit (0 disables it) the open sessions, of
+        the session's client for max_sessions_per_client, are counted in the
+        same transaction as the insert, and SessionLimitReached is raised
+        instead when the limit is full.
+        """
+
+    @abstractmethod
+    async def get(self, upload_id: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def mark_chunk(self, upload_id: str, chunk_number: int, digest: Optional[str] = None) -> bool:
+        """Record a received chunk and its digest. Returns False if the session is gone."""
+
+    @abstractmethod
+    async def mark_chunks(self, upload_id: str, digests: Dict[int, str]) -> bool:
+        """Record several received chunks at once, keyed by chunk number."""
+
+    @abstractmethod
+    async def unmark_chunks(self, upload_id: str, chunk_numbers: List[int]) -> None:
+        """Forget received chunks and their digests, e.g. after they were overwritten by bad data."""
+
+    @abstractmethod
+    async def get_digests(self, upload_id: str) -> Dict[int, str]:
+        """Digests of the received chunks, keyed by chunk number."""
+
+    @abstractmethod
+    async def find_chunk(self, upload_id: str, digest: str) -> Optional[int]:
+        """Number of an already received chunk of this upload with the given digest."""
+
+    @abstractmethod
+    async def claim_finalize(self, upload_id: str) -> Optional[bool]:
+        """
+        Mark the session as being finalized, in one step so only one caller
+        can win. Returns False if it already is, None if the session is gone.
+        """
+
+    @abstractmethod
+    async def release_finalize(self, upload_id: str) -> None:
+        """Clear the mark set by claim_finalize(), after a finalize that failed."""
+
+    @abstractmethod
+    async def delete(self, upload_id: str) -> None:
+        ...
+
+    @abstractmethod
+    async def expire(self, ttl: float) -> List[dict]:
+        """Remove and return sessions not touched for ttl seconds."""
+
+    @abstractmethod
+    async def count(self, client_id: Optional[str] = None) -> int:
+        """Number of open sessions, optionally only those of one client."""
+
+    @abstractmethod
+    async def pending_bytes(self, client_id: Optional[str] = None, mode: Optional[str] = None) -> int:
+        """Total size declared by open sessions, optionally of one client or upload mode."""
+
+    def close(self) -> None:
+        pass
+
+
+class MemorySessionStore(SessionStore):
+    """Process-local store, only suitable for a single worker."""
+
+    def __init__(self):
+        self._sessions: Dict[str, dict] = {}
+
+    async def create(self, upload_id: str, session: dict, max_sessions: int = 0,
+                     max_sessions_per_client: int = 0) -> None:
+        # count() never suspends, so counting and inserting happen in one step on the loop
+        if max_sessions_per_client and await self.count(session['client_id']) >= max_sessions_per_client:
+            raise SessionLimitReached(per_client=True)
+        if max_sessions and await self.count() >= max_sessions:
+            raise SessionLimitReached(per_client=False)
+        session['updated_at'] = time.time()
+        session['digests'] = {}
+        self._sessions[upload_id] = session
+
+    async def get(self, upload_id: str) -> Optional[dict]:
+        return self._sessions.get(upload_id)
+
+    async def mark_chunk(self, upload_id: str, chunk_number: int, digest: Optional[str] = None) -> bool:
+        session = self._sessions.get(upload_id)
+        if session is None:
+            return False
+        session['received'].add(chunk_number)
+        if digest is not None:
+            session['digests'][chunk_number] = digest
+        session['updated_at'] = time.time()
+        return True
+
+    async def mark_chunks(self, upload_id: str, digests: Dict[int, str]) -> bool:
+        session = self._sessions.get(upload_id)
+        if session is None:
+            return False
+        for chunk_number in digests:
+            session['received'].add(chunk_number)
+        session['digests'].update(digests)
+        session['updated_at'] = time.time()
+        return True
+
+    async def unmark_chunks(self, upload_id: str, chunk_numbers: List[int]) -> None:
+        session = self._sessions.get(upload_id)
+        if session is None:
+            return
+        for chunk_number in chunk_numbers:
+            session['received'].discard(chunk_number)
+            session['digests'].pop(chunk_number, None)
+        session['updated_at'] = time.time()
+
+    async def get_digests(self, upload_id: str) -> Dict[int, str]:
+        session = self._sessions.get(upload_id)
+        return dict(session['digests']) if session else {}
+
+    async def find_chunk(self, upload_id: str, digest: str) -> Optional[int]:
+        session = self._sessions.get(upload_id)
+        if session is None:
+            return None
+        return next((n for n, d in session['digests'].items() if d == digest), None)
+
+    async def claim_finalize(self, upload_id: str) -> Optional[bool]:
+        session = self._sessions.get(upload_id)
+        if session is None:
+            return None
+        if session.get('finalizing'):
+            return False
+        session['finalizing'] = True
+        session['updated_at'] = time.time()
+        return True
+
+    async def release_finalize(self, upload_id: str) -> None:
+        session = self._sessions.get(upload_id)
+        if session is not None:
+            session['finalizing'] = False
+
+    async def delete(self, upload_id: str) -> None:
+        self._sessions.pop(upload_id, None)
+
+    async def expire(self, ttl: float) -> List[dict]:
+        cutoff = time.time() - ttl
+        stale = [upload_id for upload_id, session in self._sessions.items() if session['updated_at'] < cutoff]
+        return [self._sessions.pop(upload_id) for upload_id in stale]
+
+    async def count(self, client_id: Optional[str] = None) -> int:
+        if client_id is None:
+            return len(self._sessions)
+        return sum(1 for session in self._sessions.values() if session['client_id'] == client_id)
+
+    async def pending_bytes(self, client_id: Optional[str] = None, mode: Optional[str] = None) -> int:
+        return sum(
+            session['total_size'] for session in self._sessions.values()
+            if (client_id is None or session['client_id'] == client_id) and (mode is None or session['mode'] == mode)
+        )
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Sessions persisted in a local SQLite database in WAL mode, so they
+    survive restarts and can be shared by several worker processes.
+    Every lookup and chunk update is a single primary-key access.
+    """
+
+    _PATH_KEYS = ('temp_dir', 'part_path')
+
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.db_path), timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS upload_sessions ("
+                "upload_id TEXT PRIMARY KEY, data TEXT NOT NULL, total_chunks INTEGER, "
+                "bitmap BLOB NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS upload_sessions_updated ON upload_sessions (updated_at)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunk_digests ("
+                "upload_id TEXT NOT NULL, chunk_number INTEGER NOT NULL, digest TEXT NOT NULL, "
+                "PRIMARY KEY (upload_id, chunk_number))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS chunk_digests_digest ON chunk_digests (upload_id, digest)")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _encode(self, session: dict) -> str:
+        data = {k: v for k, v in session.items() if k not in ('received', 'updated_at')}
+        for key in self._PATH_KEYS:
+            if data.get(key) is not None:
+                data[key] = str(data[key])
+        return json.dumps(data)
+
+    def _decode(self, data: str, total_chunks: Optional[int], bitmap: bytes, updated_at: float) -> dict:
+        session = json.loads(data)
+        for key in self._PATH_KEYS:
+            if session.get(key) is not None:
+                session[key] = Path(session[key])
+        session['received'] = ChunkBitmap(total_chunks, bitmap)
+        session['updated_at'] = updated_at
+        return session
+
+    def _create(self, upload_id: str, session: dict, max_sessions: int, max_sessions_per_client: int) -> None:
+        received = session['received']
+        conn = self._connection()
+        # IMMEDIATE so no other worker can open a session between the count and the insert
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if max_sessions_per_client and self._count(session['client_id']) >= max_sessions_per_client:
+                raise SessionLimitReached(per_client=True)
+            if max_sessions and self._count(None) >= max_sessions:
+                raise SessionLimitReached(per_client=False)
+            conn.execute(
+                "INSERT INTO upload_sessions (upload_id, data, total_chunks, bitmap, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (upload_id, self._encode(session), received.total_chunks, received.to_bytes(), time.time())
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _get(self, upload_id: str) -> Optional[dict]:
+        row = self._connection().execute(
+            "SELECT data, total_chunks, bitmap, updated_at FROM upload_sessions WHERE upload_id = ?",
+            (upload_id,)
+        ).fetchone()
+        return self._decode(*row) if row else None
+
+    def _mark_chunks(self, upload_id: str, chunks: Dict[int, Optional[str]]) -> bool:
+        conn = self._connection()
+        # IMMEDIATE takes the write lock up front so concurrent workers
+        # setting bits in the same bitmap serialize instead of losing updates
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT total_chunks, bitmap FROM upload_sessions WHERE upload_id = ?", (upload_id,)
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return False
+            received = ChunkBitmap(row[0], row[1])
+            for chunk_number in chunks:
+                received.add(chunk_number)
+            conn.execute(
+                "UPDATE upload_sessions SET bitmap = ?, updated_at = ? WHERE upload_id = ?",
+                (received.to_bytes(), time.time(), upload_id)
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO chunk_digests (upload_id, chunk_number, digest) VALUES (?, ?, ?)",
+                [(upload_id, chunk_number, digest) for chunk_number, digest in chunks.items() if digest is not None]
+            )
+            conn.execute("COMMIT")
+            return True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _unmark_chunks(self, upload_id: str, chunk_numbers: List[int]) -> None:
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT total_chunks, bitmap FROM upload_sessions WHERE upload_id = ?", (upload_id,)
+            ).fetchone()
+            if row is not None:
+                received = ChunkBitmap(row[0], row[1])
+                for chunk_number in chunk_numbers:
+                    received.discard(chunk_number)
+                conn.execute(
+                    "UPDATE upload_sessions SET bitmap = ?, updated_at = ? WHERE upload_id = ?",
+                    (received.to_bytes(), time.time(), upload_id)
+                )
+                conn.executemany(
+                    "DELETE FROM chunk_digests WHERE upload_id = ? AND chunk_number = ?",
+                    [(upload_id, chunk_number) for chunk_number in chunk_numbers]
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _get_digests(self, upload_id: str) -> Dict[int, str]:
+        return dict(self._connection().execute(
+            "SELECT chunk_number, digest FROM chunk_digests WHERE upload_id = ?", (upload_id,)
+        ))
+
+    def _find_chunk(self, upload_id: str, digest: str) -> Optional[int]:
+        row = self._connection().execute(
+            "SELECT chunk_number FROM chunk_digests WHERE upload_id = ? AND digest = ? LIMIT 1", (upload_id, digest)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _set_finalizing(self, upload_id: str, finalizing: bool) -> Optional[bool]:
+        conn = self._connection()
+        # IMMEDIATE so two workers finalizing the same upload can't both see it unclaimed
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT data FROM upload_sessions WHERE upload_id = ?", (upload_id,)).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            data = json.loads(row[0])
+            if finalizing and data.get('finalizing'):
+                conn.execute("COMMIT")
+                return False
+            data['finalizing'] = finalizing
+            conn.execute(
+                "UPDATE upload_sessions SET data = ?, updated_at = ? WHERE upload_id = ?",
+                (json.dumps(data), time.time(), upload_id)
+            )
+            conn.execute("COMMIT")
+            return True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _delete(self, upload_id: str) -> None:
+        conn = self._connection()
+        conn.execute("BEGIN")
+        try:
+            conn.execute("DELETE FROM upload_sessions WHERE upload_id = ?", (upload_id,))
+            conn.execute("DELETE FROM chunk_digests WHERE upload_id = ?", (upload_id,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _expire(self, ttl: float) -> List[dict]:
+        conn = self._connection()
+        cutoff = time.time() - ttl
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT data, total_chunks, bitmap, updated_at FROM upload_sessions WHERE updated_at < ?",
+                (cutoff,)
+            ).fetchall()
+            conn.execute(
+                "DELETE FROM chunk_digests WHERE upload_id IN "
+                "(SELECT upload_id FROM upload_sessions WHERE updated_at < ?)",
+                (cutoff,)
+            )
+            conn.execute("DELETE FROM upload_sessions WHERE updated_at < ?", (cutoff,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return [self._decode(*row) for row in rows]
+
+    def _count(self, client_id: Optional[str]) -> int:
+        if client_id is None:
+            return self._connection().execute("SELECT COUNT(*) FROM upload_sessions").fetchone()[0]
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM upload_sessions WHERE json_extract(data, '$.client_id') = ?", (client_id,)
+        ).fetchone()[0]
+
+    def _pending_bytes(self, client_id: Optional[str], mode: Optional[str]) -> int:
+        return self._connection().execute(
+            "SELECT COALESCE(SUM(json_extract(data, '$.total_size')), 0) FROM upload_sessions "
+            "WHERE (? IS NULL OR json_extract(data, '$.client_id') = ?) AND (? IS NULL OR json_extract(data, '$.mode') = ?)",
+            (client_id, client_id, mode, mode)
+        ).fetchone()[0]
+
+    async def create(self, upload_id: str, session: dict, max_sessions: int = 0,
+                     max_sessions_per_client: int = 0) -> None:
+        await run_in_threadpool(self._create, upload_id, session, max_sessions, max_sessions_per_client)
+
+    async def get(self, upload_id: str) -> Optional[dict]:
+        return await run_in_threadpool(self._get, upload_id)
+
+    async def mark_chunk(self, upload_id: str, chunk_number: int, digest: Optional[str] = None) -> bool:
+        return await run_in_threadpool(self._mark_chunks, upload_id, {chunk_number: digest})
+
+    async def mark_chunks(self, upload_id: str, digests: Dict[int, str]) -> bool:
+        return await run_in_threadpool(self._mark_chunks, upload_id, digests)
+
+    async def unmark_chunks(self, upload_id: str, chunk_numbers: List[int]) -> None:
+        await run_in_threadpool(self._unmark_chunks, upload_id, chunk_numbers)
+
+    async def get_digests(self, upload_id: str) -> Dict[int, str]:
+        return await run_in_threadpool(self._get_digests, upload_id)
+
+    async def find_chunk(self, upload_id: str, digest: str) -> Optional[int]:
+        return await run_in_threadpool(self._find_chunk, upload_id, digest)
+
+    async def claim_finalize(self, upload_id: str) -> Optional[bool]:
+        return await run_in_threadpool(self._set_finalizing, upload_id, True)
+
+    async def release_finalize(self, upload_id: str) -> None:
+        await run_in_threadpool(self._set_finalizing, upload_id, False)
+
+    async def delete(self, upload_id: str) -> None:
+        await run_in_threadpool(self._delete, upload_id)
+
+    async def expire(self, ttl: float) -> List[dict]:
+        return await run_in_threadpool(self._expire, ttl)
+
+    async def count(self, client_id: Optional[str] = None) -> int:
+        return await run_in_threadpool(self._count, client_id)
+
+    async def pending_bytes(self, client_id: Optional[str] = None, mode: Optional[str] = None) -> int:
+        return await run_in_threadpool(self._pending_bytes, client_id, mode)
+
+    def close(self) -> None:
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+
+def create_session_store(backend: str, db_path: Path) -> SessionStore:
+    if backend == "memory":
+        return MemorySessionStore()
+    if backend == "sqlite":
+        return SQLiteSessionStore(db_path)
+    raise ValueError(f"Unknown session store backend: {backend}")
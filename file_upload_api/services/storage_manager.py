@@ -0,0 +1,284 @@
+import os
+import fcntl
+import shutil
+import asyncio
+from pathlib import Path
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+from fastapi.concurrency import run_in_threadpool
+from logs.logger import logger
+from services.session_store import SessionStore
+from services.file_index import FileIndex
+from services.content_store import ContentStore
+from services.file_ops import remove_path, remove_upload_files
+from services import metrics
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+EVICTION_POLICIES = ("lru", "none")
+
+
+class InsufficientStorage(Exception):
+    """
+    Raised when an upload of the requested size can't be stored. retry_after
+    is set when eviction is expected to make room, in seconds.
+    """
+
+    def __init__(self, detail: str, retry_after: Optional[int] = None):
+        super().__init__(detail)
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class StorageManager:
+    """
+    Keeps storage/ within bounds. check_space() turns an upload away at
+    /init when it wouldn't fit, and a background pass every interval:
+
+    - expires sessions idle for session_ttl and removes their temp files
+    - removes entries under temp/ no session owns, left by crashed workers
+    - deletes completed files older than max_age seconds
+    - with eviction "lru", deletes the least recently accessed files of a
+      client (or of everyone) over its quota, down to low_watermark of it.
+      An upload turned away by a quota wakes the task, which then also
+      makes room for it, so the client's retry gets in
+    - drops content store blobs no stored file links to any more
+
+    Removed files stay in the file index with status "expired" (sessions)
+    or "deleted". A limit of 0 disables it. Every worker runs the task, but
+    a pass only runs in the one holding the flock on lock_path.
+    """
+
+    def __init__(
+        self,
+        upload_dir: Path,
+        session_store: SessionStore,
+        file_index: FileIndex,
+        content_store: ContentStore,
+        save_record: Callable[[dict], None],
+        session_ttl: float,
+        max_age: float = 0,
+        quota: int = 0,
+        client_quota: int = 0,
+        min_free: int = 0,
+        eviction: str = "lru",
+        low_watermark: float = 0.9,
+        min_pass_gap: float = 5.0
+    ):
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError(f"Unknown eviction policy: {eviction}")
+        self.upload_dir = upload_dir
+        self.temp_dir = upload_dir / "temp"
+        self.lock_path = upload_dir / "maintenance.lock"
+        self.session_store = session_store
+        self.file_index = file_index
+        self.content_store = content_store
+        self.save_record = save_record
+        self.session_ttl = session_ttl
+        self.max_age = max_age
+        self.quota = quota
+        self.client_quota = client_quota
+        self.min_free = min_free
+        self.eviction = eviction
+        self.low_watermark = low_watermark
+        self.min_pass_gap = min_pass_gap
+        # Largest upload turned away by a quota since the last pass, per
+        # client; None is the global quota
+        self._demand: Dict[Optional[str], int] = {}
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def check_space(self, client_id: Optional[str], size: int) -> None:
+        """
+        Raise InsufficientStorage if an upload of size bytes would go over a
+        quota or leave less than min_free bytes on disk. Open sessions count
+        with their whole declared size, and chunks mode ones as not yet on
+        disk, since their files are only allocated as chunks arrive.
+        """
+        if self.quota or self.client_quota:
+            await self.file_index.refresh()
+        if self.quota and \
+                self.file_index.stored_bytes() + await self.session_store.pending_bytes() + size > self.quota:
+            raise self._over_quota(None, size, "Storage quota exceeded")
+        if self.client_quota and client_id is not None and self.file_index.stored_bytes(client_id) + \
+                await self.session_store.pending_bytes(client_id) + size > self.client_quota:
+            raise self._over_quota(client_id, size, f"Client {client_id} is over its storage quota")
+
+        free = (await run_in_threadpool(shutil.disk_usage, self.upload_dir)).free
+        unallocated = await self.session_store.pending_bytes(mode="chunks")
+        if free - unallocated - self.min_free < size:
+            raise InsufficientStorage(f"Not enough disk space for {size} bytes")
+
+    def _over_quota(self, client_id: Optional[str], size: int, detail: str) -> InsufficientStorage:
+        if self.eviction == "none":
+            return InsufficientStorage(detail)
+        self._demand[client_id] = max(self._demand.get(client_id, 0), size)
+        self.wake()
+        return InsufficientStorage(detail, retry_after=int(self.min_pass_gap) + 1)
+
+    async def start(self, interval: float) -> None:
+        # Created here so it binds to the running loop on Python 3.8
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run(interval))
+
+    def wake(self) -> None:
+        """Run the next pass now instead of at the end of the interval."""
+        if self._wake is not None:
+            self._wake.set()
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self, interval: float) -> None:
+        while True:
+            try:
+                reclaimed = await self.run_once()
+                if any(reclaimed.values()):
+                    logger.info(f"Storage maintenance freed {reclaimed}")
+            except Exception as e:
+                logger.error(f"Storage maintenance failed: {str(e)}")
+            await asyncio.sleep(self.min_pass_gap)
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), max(interval - self.min_pass_gap, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    def _try_lock(self) -> Optional[int]:
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    async def run_once(self) -> Dict[str, int]:
+        """One maintenance pass, returning the disk space freed by each step."""
+        lock = await run_in_threadpool(self._try_lock)
+        if lock is None:
+            return {}  # another worker is running a pass
+        try:
+            await self.file_index.refresh()
+            reclaimed = {
+                'sessions': await self._expire_sessions(),
+                'orphans': await self._remove_orphans(),
+                'age': await self._apply_max_age(),
+                'quota': await self._enforce_quotas(),
+                'blobs': await self.content_store.collect_garbage()
+            }
+        finally:
+            await run_in_threadpool(os.close, lock)
+        for reason, freed in reclaimed.items():
+            if freed:
+                metrics.storage_reclaimed.inc(freed, (reason,))
+        return reclaimed
+
+    async def _expire_sessions(self) -> int:
+        freed = 0
+        for session in await self.session_store.expire(self.session_ttl):
+            freed += await run_in_threadpool(remove_upload_files, session['temp_dir'], session['part_path'])
+            record = self.file_index.get(session.get('file_id') or session['filename'])
+            if record is not None and record['upload_date'] == session['upload_date'] and record['status'] == "pending":
+                self.save_record({**record, 'status': "expired"})
+            logger.info(f"Expired stale upload {session['upload_id']} ({session['filename']})")
+        return freed
+
+    def _stale_temp_entries(self) -> List[Path]:
+        cutoff = datetime.now().timestamp() - self.session_ttl
+        try:
+            entries = list(os.scandir(self.temp_dir))
+        except FileNotFoundError:
+            return []
+        stale = []
+        for entry in entries:
+            try:
+                if entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                    stale.append(Path(entry.path))
+            except FileNotFoundError:
+                pass
+        return stale
+
+    async def _remove_orphans(self) -> int:
+        # temp/<upload_id>/ (chunks mode), temp/<upload_id>.part (direct mode)
+        # or temp/<uuid>.part (single-shot PUT, which has no session)
+        freed = 0
+        for path in await run_in_threadpool(self._stale_temp_entries):
+            upload_id = path.name[:-len(".part")] if path.name.endswith(".part") else path.name
+            if await self.session_store.get(upload_id) is not None:
+                continue
+            freed += await run_in_threadpool(remove_path, path)
+            logger.info(f"Removed orphaned temp entry {path}")
+        return freed
+
+    def _remove_stored(self, storage_location: str) -> int:
+        path = Path(storage_location)
+        # Only ever delete inside storage/, whatever the record says
+        if self.upload_dir.resolve() not in path.resolve().parents:
+            logger.warning(f"Not deleting {path}, it is outside {self.upload_dir}")
+            return 0
+        return remove_path(path)
+
+    async def _delete(self, records: List[dict], reason: str) -> int:
+        freed = 0
+        for record in records:
+            freed += await run_in_threadpool(self._remove_stored, record['storage_location'])
+            self.save_record({**record, 'status': "deleted"})
+            logger.info(f"Deleted {record['filename']} ({reason})")
+        return freed
+
+    async def _apply_max_age(self) -> int:
+        if not self.max_age:
+            return 0
+        cutoff = (datetime.now() - timedelta(seconds=self.max_age)).strftime(DATE_FORMAT)
+        records, _ = self.file_index.query(status="completed", uploaded_before=cutoff)
+        return await self._delete(records, "age")
+
+    @staticmethod
+    def _access_times(paths: List[str]) -> List[float]:
+        times = []
+        for path in paths:
+            try:
+                times.append(os.stat(path).st_atime)
+            except FileNotFoundError:
+                times.append(0.0)  # already gone, evicting it costs nothing
+        return times
+
+    async def _evict(self, client_id: Optional[str], excess: int) -> int:
+        records, _ = self.file_index.query(client_id=client_id, status="completed")
+        times = await run_in_threadpool(self._access_times, [r['storage_location'] for r in records])
+        victims = []
+        for _, record in sorted(zip(times, records), key=lambda pair: pair[0]):
+            if excess <= 0:
+                break
+            victims.append(record)
+            excess -= record['size']
+        return await self._delete(victims, "quota" if client_id is None else f"quota of {client_id}")
+
+    async def _enforce_quota(self, client_id: Optional[str], used: int, quota: int, demand: int) -> int:
+        if used + demand <= quota:
+            return 0
+        return await self._evict(client_id, used + demand - int(quota * self.low_watermark))
+
+    async def _enforce_quotas(self) -> int:
+        if self.eviction == "none":
+            return 0
+        # Uploads turned away from now on count towards the next pass
+        demand, self._demand = self._demand, {}
+        freed = 0
+        if self.quota:
+            freed += await self._enforce_quota(None, self.file_index.stored_bytes(), self.quota, demand.get(None, 0))
+        if self.client_quota:
+            usage = self.file_index.client_usage()
+            for client_id in set(usage) | set(demand):
+                if client_id is not None:
+                    freed += await self._enforce_quota(
+                        client_id, usage.get(client_id, 0), self.client_quota, demand.get(client_id, 0)
+                    )
+        return freed
@@ -0,0 +1,28 @@
+import os
+import pytest
+import requests
+from typing import Generator
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+@pytest.fixture
+def api_url() -> str:
+    return os.getenv('API_URL', 'http://localhost:8000')
+
+@pytest.fixture
+def client_url() -> str:
+    return os.getenv('CLIENT_URL', 'http://localhost:5000')
+
+@pytest.fixture
+def session() -> Generator[requests.Session, None, None]:
+
+    session = requests.Session()
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[500, 502, 503, 504]
+    )
+    adapter = HTTPAdapter(max_retries=retry)
+    session.mount('http://', adapter)
+    yield session
+    session.close()
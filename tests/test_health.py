@@ -1,31 +1,7 @@
-import os
+import json
+import base64
 import pytest
 import requests
-from typing import Generator
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-
-@pytest.fixture
-def api_url() -> str:
-    return os.getenv('API_URL', 'http://localhost:8000')
-
-@pytest.fixture
-def client_url() -> str:
-    return os.getenv('CLIENT_URL', 'http://localhost:5000')
-
-@pytest.fixture
-def session() -> Generator[requests.Session, None, None]:
-
-    session = requests.Session()
-    retry = Retry(
-        total=3,
-        backoff_factor=0.5,
-        status_forcelist=[500, 502, 503, 504]
-    )
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    yield session
-    session.close()
 
 
 def test_api_health(session: requests.Session, api_url: str):
@@ -42,6 +18,16 @@ def test_client_health(session: requests.Session, client_url: str):
     assert response.json()['status'] == 'healthy'
 
 
+def test_client_jobs(session: requests.Session, client_url: str):
+    response = session.get(f"{client_url}/jobs/0123456789abcdef")
+    assert response.status_code == 404
+
+    # Job IDs naming hosts that aren't client containers are never forwarded to
+    for owner in ("127.0.0.1:5000", "localhost:5000", "example.com:80"):
+        response = session.get(f"{client_url}/jobs/0123456789abcdef@{owner}", timeout=5)
+        assert response.status_code == 404
+
+
 def test_file_extensions(session: requests.Session, api_url: str):
 
     allowed_files = {
@@ -108,3 +94,48 @@ def test_api_data_file_schema(session: requests.Session, api_url: str):
 
 
 
+
+
+def test_api_data_pagination(session: requests.Session, api_url: str):
+    everything = session.get(f"{api_url}/api/data/").json()
+    if len(everything) < 2:
+        pytest.skip("Not enough files to paginate")
+
+    paged = []
+    params = {'limit': 1}
+    while True:
+        response = session.get(f"{api_url}/api/data/", params=params)
+        assert response.status_code == 200
+        page = response.json()
+        assert len(page) <= 1
+        paged.extend(page)
+        if 'X-Next-Cursor' not in response.headers:
+            break
+        params['cursor'] = response.headers['X-Next-Cursor']
+
+    assert [f['filename'] for f in paged] == [f['filename'] for f in everything]
+
+
+@pytest.mark.parametrize("key", [[1, 2], ["2024-01-01 00:00:00"], {"a": "b"}, "x", None])
+def test_api_data_rejects_bad_cursor(session: requests.Session, api_url: str, key):
+    cursor = base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+    for params in ({'cursor': cursor}, {'cursor': "not base64!"}):
+        response = session.get(f"{api_url}/api/data/", params={**params, 'limit': 1})
+        assert response.status_code == 400
+
+
+def test_api_data_ndjson(session: requests.Session, api_url: str):
+    response = session.get(f"{api_url}/api/data/", params={'format': 'ndjson', 'status': 'completed'})
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('application/x-ndjson')
+    for line in response.text.splitlines():
+        assert json.loads(line)['status'] == 'completed'
+
+
+def test_api_metrics(session: requests.Session, api_url: str):
+    session.get(f"{api_url}/api/health")
+    response = session.get(f"{api_url}/api/metrics")
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith("text/plain")
+    assert 'http_requests_total{method="GET",route="/api/health",status="200"}' in response.text
+    assert "# TYPE upload_chunks_in_flight gauge" in response.text
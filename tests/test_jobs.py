@@ -0,0 +1,56 @@
+import os
+import sys
+import time
+import threading
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "client"))
+from jobs import JobRegistry
+
+
+def wait_for(registry: JobRegistry, job_id: str) -> dict:
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        job = registry.get(job_id)
+        if job['status'] != 'running':
+            return job
+        time.sleep(0.01)
+    pytest.fail(f"Job {job_id} did not finish")
+
+
+def test_job_lifecycle():
+    release = threading.Event()
+
+    def upload(size):
+        release.wait(5)
+        return {'file_size': size}
+
+    registry = JobRegistry("10.0.0.2:5000")
+    job = registry.submit('upload', upload, 1024)
+    assert job['status'] == 'running'
+    assert registry.get(job['job_id'])['status'] == 'running'
+    assert JobRegistry.owner_of(job['job_id']) == "10.0.0.2:5000"
+
+    release.set()
+    job = wait_for(registry, job['job_id'])
+    assert job['status'] == 'succeeded'
+    assert job['result'] == {'file_size': 1024}
+    assert job['finished_at'] >= job['created_at']
+
+
+def test_failed_job():
+    def fail():
+        raise RuntimeError("disk full")
+
+    registry = JobRegistry("10.0.0.2:5000")
+    job = wait_for(registry, registry.submit('upload', fail)['job_id'])
+    assert job['status'] == 'failed'
+    assert job['error'] == "disk full"
+
+
+def test_finished_jobs_are_forgotten():
+    registry = JobRegistry("10.0.0.2:5000", max_jobs=2)
+    job_ids = [wait_for(registry, registry.submit('upload', lambda: None)['job_id'])['job_id'] for _ in range(3)]
+    assert registry.get(job_ids[0]) is None
+    assert all(registry.get(job_id) is not None for job_id in job_ids[1:])
+    assert JobRegistry.owner_of("0123456789abcdef") is None
@@ -0,0 +1,387 @@
+import os
+import hashlib
+import json
+import time
+import zlib
+import pytest
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def init_upload(session: requests.Session, api_url: str, data: bytes, **extra) -> str:
+    response = session.post(f"{api_url}/api/uploads/init", json={
+        'client_id': 'pytest',
+        'timestamp': str(time.time()),
+        'file_creation_time': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'filename': f"pytest_{time.time_ns()}.dat",
+        'total_size': len(data),
+        'chunk_size': CHUNK_SIZE,
+        **extra
+    })
+    assert response.status_code == 200
+    return response.json()['upload_id']
+
+
+def send_chunk(session: requests.Session, api_url: str, upload_id: str, data: bytes, chunk_number: int):
+    chunk = data[chunk_number * CHUNK_SIZE:(chunk_number + 1) * CHUNK_SIZE]
+    response = session.post(
+        f"{api_url}/api/uploads/chunk",
+        files={'chunk': chunk},
+        data={'chunk_number': chunk_number, 'upload_id': upload_id}
+    )
+    assert response.status_code == 200
+
+
+@pytest.mark.parametrize("mode", ["direct", "chunks"])
+def test_chunked_upload_out_of_order(session: requests.Session, api_url: str, mode: str):
+    data = os.urandom(CHUNK_SIZE * 12 + 100)
+    upload_id = init_upload(session, api_url, data, mode=mode)
+
+    for chunk_number in reversed(range(13)):
+        send_chunk(session, api_url, upload_id, data, chunk_number)
+
+    response = session.post(f"{api_url}/api/uploads/finalize", json={'upload_id': upload_id})
+    assert response.status_code == 201
+    file_info = json.loads(response.json()['file_info'])
+    assert file_info['size'] == len(data)
+    digests = [hashlib.sha256(data[n * CHUNK_SIZE:(n + 1) * CHUNK_SIZE]).digest() for n in range(13)]
+    assert file_info['checksum'] == "sha256-tree:" + hashlib.sha256(b"".join(digests)).hexdigest()
+
+
+def test_upload_status_reports_missing_ranges(session: requests.Session, api_url: str):
+    data = os.urandom(CHUNK_SIZE * 20)
+    upload_id = init_upload(session, api_url, data)
+
+    for chunk_number in [0, 1, 2, 5, 6, 19]:
+        send_chunk(session, api_url, upload_id, data, chunk_number)
+
+    status = session.get(f"{api_url}/api/uploads/{upload_id}/status").json()
+    assert status['total_chunks'] == 20
+    assert status['chunks_received'] == 6
+    assert status['missing'] == [[3, 4], [7, 18]]
+    assert status['complete'] is False
+
+    response = session.post(f"{api_url}/api/uploads/finalize", json={'upload_id': upload_id})
+    assert response.status_code == 409
+
+
+@pytest.mark.parametrize("mode", ["direct", "chunks"])
+def test_raw_chunk_upload(session: requests.Session, api_url: str, mode: str):
+    data = os.urandom(CHUNK_SIZE * 3 + 7)
+    upload_id = init_upload(session, api_url, data, mode=mode)
+
+    response = session.put(f"{api_url}/api/uploads/{upload_id}/chunks/0", data=data[:CHUNK_SIZE + 1])
+    assert response.status_code == 413
+
+    for chunk_number in range(4):
+        response = session.put(
+            f"{api_url}/api/uploads/{upload_id}/chunks/{chunk_number}",
+            data=data[chunk_number * CHUNK_SIZE:(chunk_number + 1) * CHUNK_SIZE],
+            headers={'Content-Type': 'application/octet-stream'}
+        )
+        assert response.status_code == 200
+
+    response = session.post(f"{api_url}/api/uploads/finalize", json={'upload_id': upload_id})
+    assert response.status_code == 201
+    assert json.loads(response.json()['file_info'])['size'] == len(data)
+
+
+def test_streamed_chunk_without_chunk_size(session: requests.Session, api_url: str):
+    data = os.urandom(CHUNK_SIZE + 7)
+    upload_id = init_upload(session, api_url, data, mode='chunks', chunk_size=None)
+
+    # Sent with chunked transfer encoding, so the server only knows the upload's size
+    response = session.put(f"{api_url}/api/uploads/{upload_id}/chunks/0", data=iter([data, b"x"]))
+    assert response.status_code == 413
+    response = session.put(f"{api_url}/api/uploads/{upload_id}/chunks/0", data=iter([data]))
+    assert response.status_code == 200
+
+    response = session.post(f"{api_url}/api/uploads/finalize", json={'upload_id': upload_id})
+    assert response.status_code == 201
+    assert json.loads(response.json()['file_info'])['size'] == len(data)
+
+
+def test_chunk_digest_verification(session: requests.Session, api_url: str):
+    data = os.urandom(CHUNK_SIZE * 2)
+    upload_id = init_upload(session, api_url, data)
+    chunks = [data[:CHUNK_SIZE], data[CHUNK_SIZE:]]
+
+    response = session.put(
+        f"{api_url}/api/uploads/{upload_id}/chunks/0",
+        data=chunks[0],
+        headers={'X-Chunk-Digest': f"sha256={hashlib.sha256(chunks[1]).hexdigest()}"}
+    )
+    assert response.status_code == 422
+    assert session.get(f"{api_url}/api/uploads/{upload_id}/status").json()['missing'] == [[0, 1]]
+
+    digests = [hashlib.sha256(chunk).hexdigest() for chunk in chunks]
+    for chunk_number, chunk in enumerate(chunks):
+        response = session.put(
+            f"{api_url}/api/uploads/{upload_id}/chunks/{chunk_number}",
+            data=chunk,
+            headers={'X-Chunk-Digest': f"sha256={digests[chunk_number]}"}
+        )
+        assert response.status_code == 200
+
+    checksum = "sha256-tree:" + hashlib.sha256(b"".join(bytes.fromhex(d) for d in digests)).hexdigest()
+    response = session.post(f"{api_url}/api/uploads/finalize", json={'upload_id': upload_id, 'checksum': checksum})
+    assert response.status_code == 201
+    assert json.loads(response.json()['file_info'])['checksum'] == checksum
+
+
+@pytest.mark.parametrize("mode", ["direct", "chunks"])
+def test_corrupt_resend_marks_chunk_missing(session: requests.Session, api_url: str, mode: str):
+    data = os.urandom(CHUNK_SIZE * 2)
+    upload_id = init_upload(session, api_url, data, mode=mode)
+    for chunk_number in range(2):
+        send_chunk(session, api_url, upload_id, data, chunk_number)
+
+    # A bad resend of an acknowledged chunk has overwritten its bytes
+    response = session.put(
+        f"{api_url}/api/uploads/{upload_id}/chunks/0",
+        data=os.urandom(CHUNK_SIZE),
+        headers={'X-Chunk-Digest': hashlib.sha256(data[:CHUNK_SIZE]).hexdigest()}
+    )
+    assert response.status_code == 422
+    assert session.get(f"{api_url}/api/uploads/{upload_id}/status").json()['missing'] == [[0, 0]]
+    response = session.post(f"{api_url}/api/uploads/finalize", json={'upload_id': upload_id})
+    assert response.status_code == 409
+
+    send_chunk(session, api_url, upload_id, data, 0)
+    digests = [hashlib.sha256(data[n * CHUNK_SIZE:(n + 1) * CHUNK_SIZE]).digest() for n in range(2)]
+    checksum = "sha256-tree:" + hashlib.sha256(b"".join(digests)).hexdigest()
+    response = session.post(f"{api_url}/api/uploads/finalize", json={'upload_id': upload_id, 'checksum': checksum})
+    assert response.status_code == 201
+
+
+def test_chunk_dedup(session: requests.Session, api_url: str):
+    block = os.urandom(CHUNK_SIZE)
+    data = block * 2 + os.urandom(CHUNK_SIZE)
+    digests = [hashlib.sha256(data[n * CHUNK_SIZE:(n + 1) * CHUNK_SIZE]).hexdigest() for n in range(3)]
+    checksum = "sha256-tree:" + hashlib.sha256(b"".join(bytes.fromhex(d) for d in digests)).hexdigest()
+
+    def offer(upload_id, chunk_number):
+        response = session.post(
+            f"{api_url}/api/uploads/{upload_id}/chunks/{chunk_number}/dedup",
+            headers={'X-Chunk-Digest': f"sha256={digests[chunk_number]}"}
+        )
+        assert response.status_code == 200
+        return response.json()['deduplicated']
+
+    upload_id = init_upload(session, api_url, data)
+    assert offer(upload_id, 0) is False
+    send_chunk(session, api_url, upload_id, data, 0)
+    if not offer(upload_id, 1):
+        pytest.skip("Server runs without DEDUP_ENABLED")
+    send_chunk(session, api_url, upload_id, data, 2)
+    response = session.post(f"{api_url}/api/uploads/finalize", json={'upload_id': upload_id, 'checksum': checksum})
+    assert response.status_code == 201
+
+    # A second upload of the same content is assembled entirely server-side
+    upload_id = init_upload(session, api_url, data)
+    assert all(offer(upload_id, n) for n in range(3))
+    response = session.post(f"{api_url}/api/uploads/finalize", json={'upload_id': upload_id, 'checksum': checksum})
+    assert response.status_code == 201
+
+
+@pytest.mark.parametrize("mode", ["direct", "chunks"])
+def test_zero_ranges(session: requests.Session, api_url: str, mode: str):
+    data = bytes(CHUNK_SIZE * 5) + os.urandom(CHUNK_SIZE) + bytes(100)
+    upload_id = init_upload(session, api_url, data, mode=mode)
+
+    response = session.post(f"{api_url}/api/uploads/{upload_id}/zero-ranges", json={'chunks': [[0, 4], [6, 6]]})
+    assert response.status_code == 200
+    assert session.get(f"{api_url}/api/uploads/{upload_id}/status").json()['missing'] == [[5, 5]]
+    send_chunk(session, api_url, upload_id, data, 5)
+
+    digests = [hashlib.sha256(data[n * CHUNK_SIZE:(n + 1) * CHUNK_SIZE]).hexdigest() for n in range(7)]
+    checksum = "sha256-tree:" + hashlib.sha256(b"".join(bytes.fromhex(d) for d in digests)).hexdigest()
+    response = session.post(f"{api_url}/api/uploads/finalize", json={'upload_id': upload_id, 'checksum': checksum})
+    assert response.status_code == 201
+    assert json.loads(response.json()['file_info'])['size'] == len(data)
+
+
+def test_compressed_chunk_upload(session: requests.Session, api_url: str):
+    data = b"".join(f"{n},client_{n % 7},{n * 31 % 1000}\n".encode() for n in range(20000))[:CHUNK_SIZE * 2 + 5]
+    upload_id = init_upload(session, api_url, data)
+    chunks = [data[n * CHUNK_SIZE:(n + 1) * CHUNK_SIZE] for n in range(3)]
+
+    response = session.put(
+        f"{api_url}/api/uploads/{upload_id}/chunks/0",
+        data=zlib.compress(chunks[0])[:-10],
+        headers={'Content-Encoding': 'deflate'}
+    )
+    assert response.status_code == 400
+    response = session.put(
+        f"{api_url}/api/uploads/{upload_id}/chunks/0", data=chunks[0], headers={'Content-Encoding': 'br'}
+    )
+    assert response.status_code == 415
+
+    for chunk_number, chunk in enumerate(chunks):
+        response = session.put(
+            f"{api_url}/api/uploads/{upload_id}/chunks/{chunk_number}",
+            data=zlib.compress(chunk),
+            headers={'Content-Encoding': 'deflate', 'X-Chunk-Digest': hashlib.sha256(chunk).hexdigest()}
+        )
+        assert response.status_code == 200
+        assert response.json()['size'] == len(chunk)
+
+    response = session.post(f"{api_url}/api/uploads/finalize", json={'upload_id': upload_id})
+    assert response.status_code == 201
+
+
+@pytest.mark.parametrize("chunk_size", [CHUNK_SIZE, None])
+def test_compressed_chunk_output_is_capped(session: requests.Session, api_url: str, chunk_size):
+    upload_id = init_upload(session, api_url, bytes(CHUNK_SIZE * 4), chunk_size=chunk_size, mode="chunks")
+    # Without a chunk size the cap is the server's MAX_CHUNK_SIZE (64 MB by default)
+    bomb = zlib.compress(bytes(65 * 1024 * 1024), 9)
+    response = session.put(
+        f"{api_url}/api/uploads/{upload_id}/chunks/0", data=bomb, headers={'Content-Encoding': 'deflate'}
+    )
+    assert response.status_code == 413
+
+
+def test_chunk_span_upload(session: requests.Session, api_url: str):
+    data = os.urandom(CHUNK_SIZE * 5 + 17)
+    upload_id = init_upload(session, api_url, data)
+    digests = [hashlib.sha256(data[n * CHUNK_SIZE:(n + 1) * CHUNK_SIZE]).hexdigest() for n in range(6)]
+
+    # Chunks 1..5 in one request, the last one short
+    response = session.put(
+        f"{api_url}/api/uploads/{upload_id}/chunks/1",
+        data=data[CHUNK_SIZE:],
+        headers={'X-Chunk-Span': '5', 'X-Chunk-Digest': ",".join(f"sha256={d}" for d in digests[1:])}
+    )
+    assert response.status_code == 200
+    assert response.json()['digests'] == digests[1:]
+    assert session.get(f"{api_url}/api/uploads/{upload_id}/status").json()['missing'] == [[0, 0]]
+
+    response = session.put(
+        f"{api_url}/api/uploads/{upload_id}/chunks/0", data=data[:CHUNK_SIZE * 3], headers={'X-Chunk-Span': '3'}
+    )
+    assert response.status_code == 200
+
+    checksum = "sha256-tree:" + hashlib.sha256(b"".join(bytes.fromhex(d) for d in digests)).hexdigest()
+    response = session.post(f"{api_url}/api/uploads/finalize", json={'upload_id': upload_id, 'checksum': checksum})
+    assert response.status_code == 201
+
+
+def test_init_recommends_chunking(session: requests.Session, api_url: str):
+    response = session.post(f"{api_url}/api/uploads/init", json={
+        'client_id': 'pytest',
+        'timestamp': str(time.time()),
+        'file_creation_time': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'filename': f"pytest_{time.time_ns()}.dat",
+        'total_size': 64 * 1024 * 1024,
+        'chunk_size': 'auto',
+        'mode': 'direct'
+    })
+    assert response.status_code == 200
+    init = response.json()
+    assert init['chunk_size'] <= init['recommended_chunk_size'] <= init['max_chunk_size']
+    assert init['recommended_chunk_size'] % init['chunk_size'] == 0
+    assert init['parallelism'] >= 1
+
+
+@pytest.mark.parametrize("extra", [
+    {'mode': 'bogus'}, {'mode': None},
+    {'chunk_size': "1000"}, {'chunk_size': 0}, {'chunk_size': -1}, {'chunk_size': 1.5}, {'chunk_size': True}
+])
+def test_init_rejects_invalid_parameters(session: requests.Session, api_url: str, extra: dict):
+    response = session.post(f"{api_url}/api/uploads/init", json={
+        'client_id': 'pytest',
+        'timestamp': str(time.time()),
+        'file_creation_time': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'filename': f"pytest_{time.time_ns()}.dat",
+        'total_size': 1024,
+        'chunk_size': CHUNK_SIZE,
+        **extra
+    })
+    assert response.status_code == 400
+
+
+def test_single_shot_upload(session: requests.Session, api_url: str):
+    data = os.urandom(3 * 1024 * 1024 + 7)
+    filename = f"pytest_{time.time_ns()}.dat"
+
+    response = session.post(f"{api_url}/api/uploads/", files={'file': (filename, data)}, data={'client_id': 'pytest'})
+    assert response.status_code == 201
+    assert response.json()['file_info']['size'] == len(data)
+
+    response = session.put(f"{api_url}/api/uploads/files/{filename}", data=data, params={'client_id': 'pytest'})
+    assert response.status_code == 201
+    file_info = response.json()['file_info']
+    assert file_info['size'] == len(data)
+    assert file_info['checksum'] == f"sha256:{hashlib.sha256(data).hexdigest()}"
+
+    response = session.put(f"{api_url}/api/uploads/files/pytest.exe", data=data)
+    assert response.status_code == 400
+
+
+def test_init_rejects_upload_that_cannot_fit(session: requests.Session, api_url: str):
+    response = session.post(f"{api_url}/api/uploads/init", json={
+        'client_id': 'pytest',
+        'timestamp': str(time.time()),
+        'file_creation_time': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'filename': f"pytest_{time.time_ns()}.dat",
+        'total_size': 2 ** 60,
+        'chunk_size': 'auto'
+    })
+    assert response.status_code == 507
+
+
+def test_single_shot_rejects_upload_that_cannot_fit(session: requests.Session, api_url: str):
+    response = session.put(
+        f"{api_url}/api/uploads/files/pytest_{time.time_ns()}.dat",
+        data=iter([b"x"]),
+        headers={'Content-Length': str(2 ** 60)},
+        params={'client_id': 'pytest'}
+    )
+    assert response.status_code == 507
+
+
+def test_reupload_keeps_both_uploads(session: requests.Session, api_url: str):
+    client_id = f"pytest_{time.time_ns()}"
+    filename = f"{client_id}.dat"
+    locations = []
+    for _ in range(2):
+        data = os.urandom(CHUNK_SIZE + 1)
+        upload_id = init_upload(session, api_url, data, client_id=client_id, filename=filename)
+        for chunk_number in range(2):
+            send_chunk(session, api_url, upload_id, data, chunk_number)
+        response = session.post(f"{api_url}/api/uploads/finalize", json={'upload_id': upload_id})
+        assert response.status_code == 201
+        locations.append(json.loads(response.json()['file_info'])['storage_location'])
+
+    assert locations[0] != locations[1]
+    assert f"/files/{upload_id[:2]}/" in locations[1].replace("\\", "/")
+    records = session.get(f"{api_url}/api/data/", params={'client_id': client_id}).json()
+    assert sorted(record['storage_location'] for record in records) == sorted(locations)
+    assert all(record['filename'] == filename and record['status'] == "completed" for record in records)
+
+
+
+@pytest.mark.parametrize("mode", ["direct", "chunks"])
+def test_concurrent_finalize_stores_file_once(session: requests.Session, api_url: str, mode: str):
+    data = os.urandom(CHUNK_SIZE * 200 + 7)
+    upload_id = init_upload(session, api_url, data, mode=mode)
+    for chunk_number in range(201):
+        send_chunk(session, api_url, upload_id, data, chunk_number)
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        responses = list(pool.map(
+            lambda _: requests.post(f"{api_url}/api/uploads/finalize", json={'upload_id': upload_id}), range(4)
+        ))
+    assert {response.status_code for response in responses} <= {201, 409}
+    finalized = [json.loads(response.json()['file_info']) for response in responses if response.status_code == 201]
+    assert finalized and all(file_info['size'] == len(data) for file_info in finalized)
+
+    # Once completed, a repeated finalize answers with the stored record
+    response = session.post(f"{api_url}/api/uploads/finalize", json={'upload_id': upload_id})
+    assert response.status_code == 201
+    file_info = json.loads(response.json()['file_info'])
+    assert file_info['storage_location'] == finalized[0]['storage_location']
+    assert file_info['size'] == len(data)